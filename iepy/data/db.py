@@ -7,31 +7,67 @@ the chosen database engine and ORM and the IEPY core and tools.
 
 from collections import defaultdict, namedtuple
 from functools import lru_cache
+from itertools import islice
 from random import shuffle
 import logging
+import time
 
 import iepy
 iepy.setup()
 
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F, Max, Q
+
 from iepy.data.models import (
     IEDocument, IEDocumentMetadata,
     TextSegment, Relation,
     Entity, EntityKind, EntityOccurrence,
-    EvidenceLabel, EvidenceCandidate
+    EvidenceLabel, EvidenceCandidate, IN_LOOKUP_SIZE
 )
 
 from iepy.preprocess import segmenter
-from iepy.preprocess.pipeline import PreProcessSteps
+from iepy.preprocess.pipeline import PreProcessSteps, STEP_DEPENDENCIES
 
 
 IEPYDBConnector = namedtuple('IEPYDBConnector', 'segments documents')
+BulkDocumentsReport = namedtuple('BulkDocumentsReport', 'created updated skipped elapsed')
+BulkCandidatesReport = namedtuple('BulkCandidatesReport', 'segments created elapsed')
 
 # Number of entities that will be cached on get_entity function.
 ENTITY_CACHE_SIZE = 20  # reasonable compromise
 
+# Number of documents loaded per query when walking candidate evidences.
+DOCUMENTS_CHUNK_SIZE = 100
+
 logger = logging.getLogger(__name__)
 
 
+def _update_by_id(model, field_name, values):
+    """Sets field_name on the rows of model given by values, a dict
+    id -> new value, with one UPDATE ... CASE query every few hundred rows."""
+    if not values:
+        return
+    field = model._meta.get_field(field_name)
+    connection = connections[model.objects.db]
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    items = list(values.items())
+    # 3 parameters per row, kept below the 999 allowed by sqlite
+    chunk_size = IN_LOOKUP_SIZE // 2
+    with connection.cursor() as cursor:
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i:i + chunk_size]
+            sql = "UPDATE {} SET {} = CASE {} {} END WHERE {} IN ({})".format(
+                qn(model._meta.db_table), qn(field.column), pk_column,
+                " ".join(["WHEN %s THEN %s"] * len(chunk)),
+                pk_column, ", ".join(["%s"] * len(chunk)))
+            params = []
+            for pk, value in chunk:
+                params.extend([pk, field.get_db_prep_save(value, connection)])
+            params.extend(pk for pk, _ in chunk)
+            cursor.execute(sql, params)
+
+
 class DocumentManager(object):
     """Wrapper to the db-access, so it's not that impossible to switch
     from current ORM to something else if desired.
@@ -73,9 +109,141 @@ class DocumentManager(object):
 
         return doc
 
+    def bulk_create_documents(self, documents, batch_size=2000, update_mode=False):
+        """Same as create_document, but for an iterable of tuples
+        (identifier, text, metadata) that is consumed in batches: for each batch,
+        existent identifiers are looked up with a few queries and the missing
+        documents (with their metadata) are created using bulk inserts, all inside
+        a single transaction.
+
+        If an identifier is repeated on the same batch, only its first
+        occurrence is considered. With update_mode enabled, existent documents
+        whose text and metadata didn't change are not written, and counted as
+        skipped.
+        Returns a BulkDocumentsReport with the amount of created, updated and
+        skipped documents, and the elapsed seconds.
+
+        Note: metadata rows are matched with their documents relying on ids being
+        assigned incrementally, so avoid having other processes creating documents
+        at the same time.
+        """
+        created = updated = skipped = 0
+        start = time.time()
+        documents = iter(documents)
+        while True:
+            batch = list(islice(documents, batch_size))
+            if not batch:
+                break
+            with transaction.atomic():
+                b_created, b_updated = self._store_documents_batch(batch, update_mode)
+            created += b_created
+            updated += b_updated
+            skipped += len(batch) - b_created - b_updated
+            elapsed = time.time() - start
+            logger.info(
+                'Stored %i documents (%i created, %i updated, %i skipped), %.1f docs/sec',
+                created + updated + skipped, created, updated, skipped,
+                (created + updated + skipped) / elapsed if elapsed else 0
+            )
+        return BulkDocumentsReport(created, updated, skipped, time.time() - start)
+
+    def _store_documents_batch(self, batch, update_mode):
+        unique = {}
+        for identifier, text, metadata in batch:
+            if identifier not in unique:
+                unique[identifier] = (text, metadata or {})
+
+        identifiers = list(unique)
+        existent = {}
+        for i in range(0, len(identifiers), IN_LOOKUP_SIZE):
+            rows = IEDocument.objects.filter(
+                human_identifier__in=identifiers[i:i + IN_LOOKUP_SIZE]
+            ).values_list('human_identifier', 'id', 'metadata_id')
+            existent.update((ident, (doc_id, mtd_id)) for ident, doc_id, mtd_id in rows)
+
+        updated = 0
+        if update_mode and existent:
+            updated = self._update_documents(
+                {ident: (doc_id, mtd_id) + unique[ident]
+                 for ident, (doc_id, mtd_id) in existent.items()})
+
+        missing = [i for i in identifiers if i not in existent]
+        if not missing:
+            return 0, updated
+        last_metadata_id = IEDocumentMetadata.objects.aggregate(
+            last=Max('id'))['last'] or 0
+        IEDocumentMetadata.objects.bulk_create(
+            [IEDocumentMetadata(items=unique[i][1]) for i in missing])
+        metadata_ids = list(IEDocumentMetadata.objects.filter(
+            id__gt=last_metadata_id).order_by('id').values_list('id', flat=True))
+        if len(metadata_ids) != len(missing):
+            raise RuntimeError('Metadata rows were created concurrently, '
+                               'could not match them with their documents')
+        IEDocument.objects.bulk_create([
+            IEDocument(human_identifier=i, text=unique[i][0], metadata_id=mtd_id)
+            for i, mtd_id in zip(missing, metadata_ids)
+        ])
+        return len(missing), updated
+
+    def _update_documents(self, documents):
+        # documents is a dict identifier -> (document id, metadata id, text,
+        # metadata). Only texts and metadata that changed are written, with a
+        # few queries for all of them. Returns the amount of documents changed.
+        doc_ids = [doc_id for doc_id, _, _, _ in documents.values()]
+        metadata_ids = [mtd_id for _, mtd_id, _, _ in documents.values()]
+        current_texts = {}
+        current_metadata = {}
+        for i in range(0, len(doc_ids), IN_LOOKUP_SIZE):
+            current_texts.update(IEDocument.objects.filter(
+                id__in=doc_ids[i:i + IN_LOOKUP_SIZE]).values_list('id', 'text'))
+            current_metadata.update(
+                (m.id, m.items) for m in IEDocumentMetadata.objects.filter(
+                    id__in=metadata_ids[i:i + IN_LOOKUP_SIZE]).only('id', 'items'))
+
+        new_texts = {}
+        new_metadata = {}
+        changed = set()
+        for identifier, (doc_id, mtd_id, text, metadata) in documents.items():
+            if current_texts.get(doc_id) != text:
+                new_texts[doc_id] = text
+                changed.add(identifier)
+            if current_metadata.get(mtd_id) != metadata:
+                new_metadata[mtd_id] = metadata
+                changed.add(identifier)
+        _update_by_id(IEDocument, 'text', new_texts)
+        _update_by_id(IEDocumentMetadata, 'items', new_metadata)
+        return len(changed)
+
     def __iter__(self):
         return iter(IEDocument.objects.all())
 
+    def __len__(self):
+        return IEDocument.objects.count()
+
+    def get_documents_ids(self):
+        """Returns an iterator of the ids of all the documents, sorted."""
+        return IEDocument.objects.order_by('id').values_list('id', flat=True).iterator()
+
+    def get_documents_by_ids(self, ids, lacking=None, outdated=None):
+        """Returns an iterator of the documents with the given ids, sorted by
+        id. If a preprocess step is given as "lacking", only those that shall
+        be processed on such step are returned. If it's given as "outdated",
+        only those with an outdated result on it (see
+        get_documents_outdated_preprocess)."""
+        if lacking is not None:
+            docs = self.get_documents_lacking_preprocess(lacking)
+        elif outdated is not None:
+            docs = self.get_documents_outdated_preprocess(outdated)
+        else:
+            docs = IEDocument.objects.order_by('id')
+        return docs.filter(id__in=list(ids))
+
+    def close_connection(self):
+        """Closes the database connections of the current process. A new one
+        is opened when needed. Useful before forking processes."""
+        for connection in connections.all():
+            connection.close()
+
     def get_raw_documents(self):
         """returns an interator of documents that lack the text field, or it's
         empty.
@@ -91,6 +259,19 @@ class DocumentManager(object):
             return IEDocument.objects.filter(**query).order_by('id')
         return IEDocument.objects.none()
 
+    def get_documents_outdated_preprocess(self, step):
+        """Returns an iterator of documents lacking the given step, or with a
+        result on it older than the result of any of the steps it depends on.
+        """
+        if step in PreProcessSteps:
+            flag_field_name = "%s_done_at" % step.name
+            query = Q(**{"%s__isnull" % flag_field_name: True})
+            for dependency in STEP_DEPENDENCIES.get(step, []):
+                newer = F("%s_done_at" % dependency.name)
+                query |= Q(**{"%s__lt" % flag_field_name: newer})
+            return IEDocument.objects.filter(query).order_by('id')
+        return IEDocument.objects.none()
+
 
 class TextSegmentManager(object):
 
@@ -156,6 +337,9 @@ class CandidateEvidenceManager(object):
 
     @classmethod
     def hydrate(cls, ev, document=None):
+        # For hydrating several evidences, the entity occurrences of their
+        # segments can be loaded in bulk first with
+        # TextSegment.prefetch_entity_occurrences
         ev.evidence = ev.segment.hydrate(document)
         ev.right_entity_occurrence.hydrate_for_segment(ev.segment)
         ev.left_entity_occurrence.hydrate_for_segment(ev.segment)
@@ -165,10 +349,13 @@ class CandidateEvidenceManager(object):
 
     @classmethod
     def candidates_for_relation(cls, relation, construct_missing_candidates=True,
-                                seg_limit=-1, shuffle_segs=False):
+                                seg_limit=-1, shuffle_segs=False,
+                                doc_chunk_size=DOCUMENTS_CHUNK_SIZE):
         # Wraps the actual database lookup of evidence, hydrating them so
         # in theory, no extra db access shall be done
         # The idea here is simple, but with some tricks for improving performance
+        # Documents are loaded "doc_chunk_size" at a time, and released once
+        # their evidences were yielded.
         logger.info("Loading candidate evidence from database...")
         hydrate = cls.hydrate
         segments_per_document = defaultdict(list)
@@ -184,6 +371,9 @@ class CandidateEvidenceManager(object):
                 break
             raw_segments[s.id] = s
 
+        if construct_missing_candidates:
+            cls.bulk_create_candidates_for_relation(relation, list(raw_segments))
+
         for s in raw_segments.values():
             segments_per_document[s.document_id].append(s)
         doc_ids = segments_per_document.keys()
@@ -192,25 +382,107 @@ class CandidateEvidenceManager(object):
             right_entity_occurrence__entity__kind=relation.right_entity_kind,
             segment__in=raw_segments.keys()
         ).select_related(
-            'left_entity_occurrence', 'right_entity_occurrence', 'segment'
+            'left_entity_occurrence__entity__kind',
+            'right_entity_occurrence__entity__kind',
         )
         existent_ec_per_segment = defaultdict(list)
         for ec in existent_ec:
+            # sharing segment instances, so they are hydrated only once
+            ec.segment = raw_segments[ec.segment_id]
             existent_ec_per_segment[ec.segment_id].append(ec)
 
         _doc_ids = list(doc_ids)
-        while _doc_ids:
-            _id = _doc_ids.pop()
-            document = IEDocument.objects.get(id=_id)
-            for segment in segments_per_document[document.id]:
-                _existent = existent_ec_per_segment[segment.pk]
-                if construct_missing_candidates:
-                    seg_ecs = segment.get_evidences_for_relation(relation, _existent)
-                else:
-                    seg_ecs = _existent
-
-                for evidence in seg_ecs:
-                    yield hydrate(evidence, document)
+        for i in range(0, len(_doc_ids), doc_chunk_size):
+            documents = IEDocument.objects.in_bulk(_doc_ids[i:i + doc_chunk_size])
+            TextSegment.prefetch_entity_occurrences(
+                s for d_id in documents for s in segments_per_document[d_id])
+            for document in documents.values():
+                for segment in segments_per_document[document.id]:
+                    _existent = existent_ec_per_segment[segment.pk]
+                    if construct_missing_candidates:
+                        seg_ecs = segment.get_evidences_for_relation(relation, _existent)
+                    else:
+                        seg_ecs = _existent
+
+                    for evidence in seg_ecs:
+                        yield hydrate(evidence, document)
+
+    @classmethod
+    def bulk_create_candidates_for_relation(cls, relation, segment_ids=None,
+                                            batch_size=IN_LOOKUP_SIZE):
+        """Creates all the missing EvidenceCandidates of the relation, working
+        on batches of "batch_size" segments with a fixed amount of queries each.
+        If segment_ids is not provided, all the segments matching the relation
+        are processed.
+        Candidates created concurrently by somebody else are tolerated.
+        Returns a BulkCandidatesReport.
+        """
+        start = time.time()
+        if segment_ids is None:
+            segment_ids = relation._matching_text_segments().values_list(
+                'id', flat=True)
+        segment_ids = list(segment_ids)
+        created = 0
+        for i in range(0, len(segment_ids), batch_size):
+            batch = segment_ids[i:i + batch_size]
+            created += cls._create_candidates_batch(relation, batch)
+            logger.debug("Candidates for %s segments out of %s processed",
+                         i + len(batch), len(segment_ids))
+        return BulkCandidatesReport(len(segment_ids), created, time.time() - start)
+
+    @classmethod
+    def _missing_candidates(cls, relation, segment_ids):
+        lkind = relation.left_entity_kind_id
+        rkind = relation.right_entity_kind_id
+        SegmentOccurrence = EntityOccurrence.segments.through
+        occurrences = SegmentOccurrence.objects.filter(
+            textsegment_id__in=segment_ids,
+            entityoccurrence__entity__kind__in=[lkind, rkind]
+        ).values_list('textsegment_id', 'entityoccurrence_id',
+                      'entityoccurrence__entity__kind')
+        left, right = defaultdict(list), defaultdict(list)
+        for segment_id, eo_id, kind_id in occurrences:
+            if kind_id == lkind:
+                left[segment_id].append(eo_id)
+            if kind_id == rkind:
+                right[segment_id].append(eo_id)
+
+        existent = set(EvidenceCandidate.objects.filter(
+            segment_id__in=segment_ids
+        ).values_list('left_entity_occurrence_id', 'right_entity_occurrence_id',
+                      'segment_id'))
+        missing = []
+        for segment_id in segment_ids:
+            for l_eo in left[segment_id]:
+                for r_eo in right[segment_id]:
+                    if l_eo != r_eo and (l_eo, r_eo, segment_id) not in existent:
+                        missing.append((l_eo, r_eo, segment_id))
+        return missing
+
+    @classmethod
+    def _create_candidates_batch(cls, relation, segment_ids):
+        missing = cls._missing_candidates(relation, segment_ids)
+        if not missing:
+            return 0
+        try:
+            with transaction.atomic():
+                EvidenceCandidate.objects.bulk_create([
+                    EvidenceCandidate(left_entity_occurrence_id=l_eo,
+                                      right_entity_occurrence_id=r_eo,
+                                      segment_id=segment_id)
+                    for l_eo, r_eo, segment_id in missing
+                ])
+            return len(missing)
+        except IntegrityError:
+            # Some were created meanwhile. Slow path, one at a time.
+            created = 0
+            for l_eo, r_eo, segment_id in cls._missing_candidates(relation, segment_ids):
+                _, was_created = EvidenceCandidate.objects.get_or_create(
+                    left_entity_occurrence_id=l_eo,
+                    right_entity_occurrence_id=r_eo,
+                    segment_id=segment_id)
+                created += int(was_created)
+            return created
 
     @classmethod
     def value_labeled_candidates_count_for_relation(cls, relation):
@@ -227,8 +499,11 @@ class CandidateEvidenceManager(object):
     def labels_for(cls, relation, evidences, conflict_solver=None):
         """Returns a dict with the form evidence->[True|False|None]"""
         # Given a relation and a sequence of candidate-evidences, compute its
-        # labels
+        # labels. Labels are handled as plain values, indexed by candidate id.
+        # Only when a conflict needs to be solved, the EvidenceLabel instances
+        # are loaded for the solver.
         candidates = {e: None for e in evidences}
+        candidate_ids = set(e.pk for e in candidates)
 
         logger.info("Getting labels from DB")
         labels = EvidenceLabel.objects.filter(
@@ -236,37 +511,42 @@ class CandidateEvidenceManager(object):
             label__in=[EvidenceLabel.NORELATION, EvidenceLabel.YESRELATION, EvidenceLabel.NONSENSE],
             labeled_by_machine=False
         )
-        logger.info("Sorting labels them by evidence")
+        if len(candidate_ids) <= IN_LOOKUP_SIZE:
+            labels = labels.filter(evidence_candidate_id__in=candidate_ids)
+        # else, it's cheaper to get all the labels of the relation, and ignore the others
         labels_per_ev = defaultdict(list)
-        for l in labels:
-            labels_per_ev[l.evidence_candidate].append(l)
+        for label_id, ev_id, label in labels.values_list(
+                'id', 'evidence_candidate_id', 'label').order_by('id'):
+            if ev_id in candidate_ids:
+                labels_per_ev[ev_id].append((label_id, label))
 
         logger.info("Labels conflict solving")
-        for e in candidates:
-            answers = labels_per_ev[e]
-            if not answers:
-                continue
-            if len(answers) == 1:
-                lbl = answers[0].label
-            elif len(set([a.label for a in answers])) == 1:
-                # several answers, all the same. Just pick the first one
-                lbl = answers[0].label
+        chosen = {}
+        conflicts = {}
+        for ev_id, answers in labels_per_ev.items():
+            if len(set(lbl for _, lbl in answers)) == 1:
+                # one answer, or several all the same
+                chosen[ev_id] = answers[0][1]
             elif conflict_solver:
-                preferred = conflict_solver(answers)
-                if preferred is None:
-                    # unsolvable conflict
-                    continue
-                lbl = preferred.label
-            else:
-                continue
-            # Ok, we have a choosen answer. Lets see if it's informative
-            if lbl == EvidenceLabel.NONSENSE:
-                # too bad, not informative
-                continue
-            elif lbl == EvidenceLabel.NORELATION:
-                candidates[e] = False
-            elif lbl == EvidenceLabel.YESRELATION:
-                candidates[e] = True
+                conflicts[ev_id] = [label_id for label_id, _ in answers]
+        if conflicts:
+            conflicting_ids = [l_id for ids in conflicts.values() for l_id in ids]
+            conflicting_labels = {}
+            for i in range(0, len(conflicting_ids), IN_LOOKUP_SIZE):
+                conflicting_labels.update(
+                    EvidenceLabel.objects.in_bulk(conflicting_ids[i:i + IN_LOOKUP_SIZE]))
+            for ev_id, label_ids in conflicts.items():
+                preferred = conflict_solver([conflicting_labels[l_id] for l_id in label_ids])
+                if preferred is not None:
+                    chosen[ev_id] = preferred.label
+                # else, unsolvable conflict
+
+        # Ok, we have choosen answers. Lets see which are informative
+        informative = {EvidenceLabel.NORELATION: False, EvidenceLabel.YESRELATION: True}
+        for e in candidates:
+            lbl = chosen.get(e.pk)
+            if lbl in informative:
+                candidates[e] = informative[lbl]
         return candidates
 
     @classmethod
@@ -1,24 +1,43 @@
 # This module is the nexus/connection between the UI definitions (django models)
 # and the IEPY models. Modifications of this file should be done with the
 # awareness of this dual-impact.
+from copy import copy
 from datetime import datetime
 import itertools
 import logging
 from operator import attrgetter
 from collections import namedtuple, defaultdict
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
+from iepy.preprocess.pipeline import STEP_DEPENDENCIES
 from iepy.utils import unzip
-from corpus.fields import ListField, ListSyntacticTreeField
+from corpus.fields import (
+    PackedStringListField, PackedIntListField, ListSyntacticTreeField
+)
 import jsonfield
 
 CHAR_MAX_LENGHT = 256
+# Max amount of values sent on a single "IN" lookup. Keeps us below the
+# sqlite limit of variables per query.
+IN_LOOKUP_SIZE = 500
 
 logger = logging.getLogger(__name__)
 RichToken = namedtuple("RichToken", "token lemma pos eo_ids eo_kinds offset")
 
 
+def _occurrences_per_token(length, spans):
+    """Returns, for each of length tokens, the list of occurrences covering it.
+    spans are triplets (offset, offset_end, occurrence), sorted by offset.
+    Takes time proportional to the tokens plus the tokens of each occurrence.
+    """
+    result = [[] for _ in range(length)]
+    for offset, offset_end, eo in spans:
+        for i in range(max(offset, 0), min(offset_end, length)):
+            result[i].append(eo)
+    return result
+
+
 class BaseModel(models.Model):
     class Meta:
         abstract = True
@@ -36,6 +55,19 @@ class EntityKind(BaseModel):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def ids_for_names(cls, names):
+        """Returns a dict name->id with the kinds of the names given, creating
+        the missing ones."""
+        names = list(set(names))
+        found = {}
+        for i in range(0, len(names), IN_LOOKUP_SIZE):
+            found.update(cls.objects.filter(
+                name__in=names[i:i + IN_LOOKUP_SIZE]).values_list('name', 'id'))
+        for name in set(names).difference(found):
+            found[name] = cls.objects.get_or_create(name=name)[0].id
+        return found
+
 
 class Entity(BaseModel):
     # the "key" IS the "canonical-form". Alieses are stored on
@@ -79,13 +111,13 @@ class IEDocument(BaseModel):
     creation_date = models.DateTimeField(auto_now_add=True)
 
     # The following 3 lists have 1 item per token
-    tokens = ListField(blank=True)  # strings
-    lemmas = ListField(blank=True)  # strings
-    postags = ListField(blank=True)  # strings
-    offsets_to_text = ListField(blank=True)  # ints, character offset for tokens, lemmas and postags
+    tokens = PackedStringListField(blank=True)  # strings
+    lemmas = PackedStringListField(blank=True)  # strings
+    postags = PackedStringListField(blank=True)  # strings
+    offsets_to_text = PackedIntListField(blank=True)  # ints, character offset for tokens, lemmas and postags
     syntactic_sentences = ListSyntacticTreeField(blank=True, editable=False)
 
-    sentences = ListField(blank=True)  # ints, it's a list of token-offsets
+    sentences = PackedIntListField(blank=True)  # ints, it's a list of token-offsets
 
     # Reversed fields:
     # entity_occurrences = Reversed ForeignKey of EntityOccurrence
@@ -114,7 +146,8 @@ class IEDocument(BaseModel):
         postags = self.postags
         sentences = self.sentences
         start = 0
-        eos = list(self.get_entity_occurrences())
+        if enriched:
+            eos_per_token = self.get_occurrences_per_token()
         tkn_offset = 0
         for i, end in enumerate(sentences[1:]):
             if enriched:
@@ -122,7 +155,7 @@ class IEDocument(BaseModel):
                 for i, (token, lemma, postag) in enumerate(zip(
                     tokens[start:end], lemmas[start:end], postags[start:end]
                 )):
-                    tkn_eos = [eo for eo in eos if eo.offset <= tkn_offset < eo.offset_end]
+                    tkn_eos = eos_per_token[tkn_offset]
                     rich_tokens.append(RichToken(
                         token=token,
                         lemma=lemma,
@@ -142,6 +175,17 @@ class IEDocument(BaseModel):
         """Returns an iterable of EntityOccurrences, sorted by offset"""
         return self.entity_occurrences.all().order_by('offset')
 
+    def get_occurrences_per_token(self):
+        """Returns, for each token, the list of EntityOccurrences (with their
+        entities and kinds loaded) covering it. Computed once per instance."""
+        eos_per_token = getattr(self, '_eos_per_token', None)
+        if eos_per_token is None:
+            eos = self.get_entity_occurrences().select_related('entity__kind')
+            eos_per_token = _occurrences_per_token(
+                len(self.tokens), ((eo.offset, eo.offset_end, eo) for eo in eos))
+            self._eos_per_token = eos_per_token
+        return eos_per_token
+
     def get_text_segments(self):
         """Returns the iterable of TextSegments, sorted by offset"""
         return self.segments.all().order_by('offset')
@@ -151,6 +195,18 @@ class IEDocument(BaseModel):
     def was_preprocess_step_done(self, step):
         return getattr(self, '%s_done_at' % step.name) is not None
 
+    def is_preprocess_step_outdated(self, step):
+        """True if the step was not done yet, or if any of the steps it
+        depends on was done again after it."""
+        done_at = getattr(self, '%s_done_at' % step.name)
+        if done_at is None:
+            return True
+        for dependency in STEP_DEPENDENCIES.get(step, []):
+            dependency_done_at = getattr(self, '%s_done_at' % dependency.name)
+            if dependency_done_at is not None and dependency_done_at > done_at:
+                return True
+        return False
+
     def set_tokenization_result(self, value):
         """Sets the value to the correspondent storage format"""
         if not isinstance(value, list):
@@ -218,56 +274,97 @@ class IEDocument(BaseModel):
         invalids = [x for x in value if feo_has_issues(x)]
         if invalids:
             raise ValueError('Invalid FoundEvidences: {}'.format(invalids))
-
+        self._eos_per_token = None
+
+        # Everything needed is loaded beforehand, with a few queries per document
+        kind_ids = EntityKind.ids_for_names(fe.kind_name for fe in value)
+        gazette_keys = list(set(fe.key for fe in value if fe.from_gazette))
+        gazette_items = {}
+        for i in range(0, len(gazette_keys), IN_LOOKUP_SIZE):
+            gazette_items.update(
+                (gi.text, gi) for gi in GazetteItem.objects.filter(
+                    text__in=gazette_keys[i:i + IN_LOOKUP_SIZE]))
+        keys = list(set(fe.key for fe in value))
+        entities = {}
+        for i in range(0, len(keys), IN_LOOKUP_SIZE):
+            entities.update(
+                ((e.key, e.kind_id), e) for e in Entity.objects.filter(
+                    key__in=keys[i:i + IN_LOOKUP_SIZE],
+                    kind_id__in=set(kind_ids.values())))
+
+        # existents are indexed by offsets, with pairs (is_from_gazette, kind_name)
         existents = defaultdict(list)
-        eo_clash_key = lambda x: (x.offset, x.offset_end)
-        for eo in self.entity_occurrences.all():
-            existents[eo_clash_key(eo)].append(eo)
+        for offset, offset_end, gazette_id, kind_name in self.entity_occurrences.values_list(
+                'offset', 'offset_end', 'entity__gazette_id', 'entity__kind__name'):
+            existents[offset, offset_end].append((gazette_id is not None, kind_name))
 
-        # No issue, let's create them
+        new_entities = []
+        new_occurrences = []
         for found_entity in value:
             key, kind_name, alias, offset, offset_end, from_gazette = found_entity
-            if (offset, offset_end) in existents.keys():
-                skip = False
-                for existent in existents[offset, offset_end]:
-                    is_from_gazette = existent.entity.gazette is not None
-                    is_same_kind = existent.entity.kind.name == kind_name
-
-                    if is_from_gazette or is_same_kind:
-                        skip = True
-                        break
-
-                if skip:
-                    continue
+            if any(is_from_gazette or existent_kind == kind_name
+                   for is_from_gazette, existent_kind in existents[offset, offset_end]):
+                continue
 
-            kind, _ = EntityKind.objects.get_or_create(name=kind_name)
+            kind_id = kind_ids[kind_name]
+            gazette_item = None
             if from_gazette:
-                gazette_item = GazetteItem.objects.get(text=key, kind=kind)
-                entity, created = Entity.objects.get_or_create(
-                    key=key, kind=kind,
-                    gazette=gazette_item
-                )
-            else:
-                entity, created = Entity.objects.get_or_create(key=key, kind=kind)
+                gazette_item = gazette_items.get(key)
+                if gazette_item is None or gazette_item.kind_id != kind_id:
+                    raise GazetteItem.DoesNotExist(
+                        'GazetteItem {!r} of kind {!r} does not exist'.format(key, kind_name))
+            entity = entities.get((key, kind_id))
+            if entity is None:
+                entity = Entity(key=key, kind_id=kind_id, gazette=gazette_item)
+                entities[key, kind_id] = entity
+                new_entities.append(entity)
 
             if len(alias) > CHAR_MAX_LENGHT:
                 alias_ = alias[:CHAR_MAX_LENGHT]
                 print('Alias "%s" reduced to "%s"' % (alias, alias_))
                 alias = alias_
 
-            obj, created = EntityOccurrence.objects.get_or_create(
-                document=self,
-                entity=entity,
-                offset=offset,
-                offset_end=offset_end,
-                alias=alias
-            )
-            if created:
-                existents[eo_clash_key(obj)].append(obj)
+            new_occurrences.append((entity, offset, offset_end, alias))
+            existents[offset, offset_end].append(
+                (entity.gazette_id is not None, kind_name))
+
+        with transaction.atomic():
+            self._save_new_entities(new_entities)
+            EntityOccurrence.objects.bulk_create([
+                EntityOccurrence(document=self, entity_id=entity.pk, offset=offset,
+                                 offset_end=offset_end, alias=alias)
+                for entity, offset, offset_end, alias in new_occurrences
+            ])
 
         self.ner_done_at = datetime.now()
         return self
 
+    @staticmethod
+    def _save_new_entities(new_entities):
+        # Saves the entities given, setting their ids. Entities created
+        # meanwhile (by other process) are taken instead.
+        if not new_entities:
+            return
+        try:
+            with transaction.atomic():
+                Entity.objects.bulk_create(new_entities)
+        except IntegrityError:
+            for entity in new_entities:
+                entity.pk = Entity.objects.get_or_create(
+                    key=entity.key, kind_id=entity.kind_id,
+                    defaults={'gazette': entity.gazette})[0].pk
+            return
+        # bulk_create does not set ids, they need to be fetched
+        keys = list(set(e.key for e in new_entities))
+        ids = {}
+        for i in range(0, len(keys), IN_LOOKUP_SIZE):
+            ids.update(((key, kind_id), pk) for pk, key, kind_id in Entity.objects.filter(
+                key__in=keys[i:i + IN_LOOKUP_SIZE],
+                kind_id__in=set(e.kind_id for e in new_entities)
+            ).values_list('id', 'key', 'kind_id'))
+        for entity in new_entities:
+            entity.pk = ids[entity.key, entity.kind_id]
+
     def set_segmentation_result(self, value, increment=True, override=False):
         if override:
             self.segments.all().delete()
@@ -275,7 +372,6 @@ class IEDocument(BaseModel):
         get_offsets = attrgetter('offset', 'offset_end')
         value = sorted(value, key=get_offsets)
         logger.info('About to set %s segments for current doc', len(value))
-        doc_ent_occurrences = list(self.entity_occurrences.all())
         currents = set(self.segments.all().values_list('offset', 'offset_end'))
         new_segs = []
         for i, raw_segment in enumerate(value):
@@ -285,23 +381,50 @@ class IEDocument(BaseModel):
                 document=self, offset=raw_segment.offset,
                 offset_end=raw_segment.offset_end)
             new_segs.append((_segm, raw_segment))
-        if new_segs:
-            TextSegment.objects.bulk_create(list(zip(*new_segs))[0])
-            logger.info('New %s segments created', len(new_segs))
-        # And now, taking care of setting Entity Occurrences
 
-        doc_segments = dict((get_offsets(s), s) for s in self.segments.all())
+        # Entity Ocurrences not provided need to be computed. Segments are
+        # sorted by offset, so a single pass over the sorted occurrences does it.
+        doc_ent_occurrences = []
+        if any(raw.entity_occurrences is None for _, raw in new_segs):
+            doc_ent_occurrences = list(self.entity_occurrences.order_by('offset'))
+        segments_eo_ids = []
+        first = 0  # first occurrence not starting before the current segment
         for _segm, raw_segment in new_segs:
-            segm = doc_segments[get_offsets(_segm)]
-            if raw_segment.entity_occurrences is None:
-                # Entity Ocurrences not provided, need to compute them
-                segm.entity_occurrences = [
-                    eo for eo in doc_ent_occurrences
-                    if eo.offset >= segm.offset
-                    and eo.offset_end <= segm.offset_end
-                ]
+            if raw_segment.entity_occurrences is not None:
+                eo_ids = set(getattr(eo, 'pk', eo) for eo in raw_segment.entity_occurrences)
             else:
-                segm.entity_occurrences = raw_segment.entity_occurrences
+                while (first < len(doc_ent_occurrences) and
+                       doc_ent_occurrences[first].offset < _segm.offset):
+                    first += 1
+                eo_ids = set()
+                for i in range(first, len(doc_ent_occurrences)):
+                    eo = doc_ent_occurrences[i]
+                    if eo.offset >= _segm.offset_end:
+                        break
+                    if eo.offset_end <= _segm.offset_end:
+                        eo_ids.add(eo.pk)
+            segments_eo_ids.append(eo_ids)
+
+        # And now, storing segments and their Entity Occurrences, with a
+        # fixed amount of queries
+        Through = EntityOccurrence.segments.through
+        if new_segs:
+            with transaction.atomic():
+                TextSegment.objects.bulk_create([_segm for _segm, _ in new_segs])
+                logger.info('New %s segments created', len(new_segs))
+                doc_segments = dict(((o, e), id_) for o, e, id_ in
+                                    self.segments.values_list('offset', 'offset_end', 'id'))
+                segment_ids = []
+                rows = []
+                for (_segm, _), eo_ids in zip(new_segs, segments_eo_ids):
+                    segm_id = doc_segments[get_offsets(_segm)]
+                    segment_ids.append(segm_id)
+                    rows.extend(Through(entityoccurrence_id=eo_id, textsegment_id=segm_id)
+                                for eo_id in eo_ids)
+                Through.objects.bulk_create(rows)
+                # Bulk inserts send no m2m_changed signals, labeling queues need
+                # to know about the occurrences of these segments anyway
+                LabelingQueue.refresh_segments(segment_ids)
 
         self.segmentation_done_at = datetime.now()
         return self
@@ -394,10 +517,54 @@ class TextSegment(BaseModel):
         eos = getattr(self, '_hydrated_eos', None)
         if eos is None:
             eos = [eo.hydrate_for_segment(self) for eo in
-                   self.entity_occurrences.all().order_by('offset')]
+                   self.entity_occurrences.all().select_related(
+                       'entity__kind').order_by('offset')]
             self._hydrated_eos = eos
         return eos
 
+    def get_occurrences_per_token(self):
+        """Returns, for each token of the (hydrated) segment, the list of its
+        EntityOccurrences covering it. Computed once per instance."""
+        eos_per_token = getattr(self, '_eos_per_token', None)
+        if eos_per_token is None:
+            eos = self.get_entity_occurrences()
+            eos_per_token = _occurrences_per_token(
+                len(self.tokens),
+                ((eo.segment_offset, eo.segment_offset_end, eo) for eo in eos))
+            self._eos_per_token = eos_per_token
+        return eos_per_token
+
+    @classmethod
+    def prefetch_entity_occurrences(cls, segments):
+        """Bulk version of get_entity_occurrences. Loads the EntityOccurrences
+        (with their entities and kinds) of all the segments provided, hydrated
+        for each of them, using one query every IN_LOOKUP_SIZE segments.
+        Segments with occurrences already hydrated are left untouched.
+        """
+        to_fetch = defaultdict(list)
+        for segment in segments:
+            if getattr(segment, '_hydrated_eos', None) is None:
+                to_fetch[segment.pk].append(segment)
+        if not to_fetch:
+            return
+        eos_per_segment = defaultdict(list)
+        segment_ids = list(to_fetch)
+        SegmentOccurrence = EntityOccurrence.segments.through
+        for i in range(0, len(segment_ids), IN_LOOKUP_SIZE):
+            rows = SegmentOccurrence.objects.filter(
+                textsegment_id__in=segment_ids[i:i + IN_LOOKUP_SIZE]
+            ).select_related('entityoccurrence__entity__kind').order_by(
+                'entityoccurrence__offset')
+            for row in rows:
+                eos_per_segment[row.textsegment_id].append(row.entityoccurrence)
+        for segment_id, segment_instances in to_fetch.items():
+            eos = eos_per_segment[segment_id]
+            for i, segment in enumerate(segment_instances):
+                if i > 0:
+                    # each instance needs its own hydrated occurrences
+                    eos = [copy(eo) for eo in eos]
+                segment._hydrated_eos = [eo.hydrate_for_segment(segment) for eo in eos]
+
     def get_evidences_for_relation(self, relation, existent=None):
         # Gets or creates Labeled Evidences (when creating, label is empty)
         lkind = relation.left_entity_kind
@@ -438,10 +605,9 @@ class TextSegment(BaseModel):
     def get_enriched_tokens(self):
         translation_dict = {'-LRB-': '(',
                             '-RRB-': ')'}
-        eos = list(self.get_entity_occurrences())
+        eos_per_token = self.get_occurrences_per_token()
         for tkn_offset, (tkn, lemma, postag) in enumerate(zip(self.tokens, self.lemmas, self.postags)):
-            tkn_eos = [eo for eo in eos
-                       if eo.segment_offset <= tkn_offset < eo.segment_offset_end]
+            tkn_eos = eos_per_token[tkn_offset]
             yield RichToken(
                 token=translation_dict.get(tkn, tkn),
                 lemma=lemma,
@@ -532,80 +698,38 @@ class Relation(BaseModel):
         judge_labels = EvidenceLabel.objects.filter(**filters)
 
         if isinstance(obj, TextSegment):
-            segments = self._matching_text_segments()
-            segments = segments.filter(evidence_relations__labels__relation=self)
-            candidates_with_label = judge_labels.values_list("evidence_candidate__segment", flat=True)
-            segments = segments.filter(id__in=candidates_with_label).distinct()
-            ids = list(segments.values_list('id', flat=True).order_by('id'))
+            id_field = 'evidence_candidate__segment_id'
         elif isinstance(obj, IEDocument):
-            ids = sorted(set(judge_labels.values_list(
-                'evidence_candidate__segment__document_id', flat=True)
-            ))
+            id_field = 'evidence_candidate__segment__document_id'
         else:
-            ids = []
-        if not ids:
             return None
-        try:
-            base_idx = ids.index(obj.id)
-        except ValueError:
-            # the base-object provided is not listed... Returning the base-object
-            # Returning last in list
-            return ids[-1]
+
+        def closest(lookup, aggregation):
+            labels = judge_labels
+            if lookup is not None:
+                labels = labels.filter(**{'%s__%s' % (id_field, lookup): obj.id})
+            return labels.aggregate(result=aggregation(id_field))['result']
+
+        if not judge_labels.filter(**{id_field: obj.id}).exists():
+            # the base-object provided is not labeled... Returning the last one
+            # (or None, if there is nothing labeled at all)
+            return closest(None, models.Max)
+        if back:
+            neighbor = closest('lt', models.Max)
         else:
-            if back:
-                if base_idx == 0:
-                    # there is no previous one. Returning same.
-                    return obj.id
-                else:
-                    return ids[base_idx - 1]
-            else:
-                if base_idx == len(ids) - 1:
-                    # there is no next one. Returning same.
-                    return obj.id
-                else:
-                    return ids[base_idx + 1]
+            neighbor = closest('gt', models.Min)
+        if neighbor is None:
+            # there is no previous/next one. Returning same.
+            return obj.id
+        return neighbor
 
     def get_next_segment_to_label(self, judge):
         # We'll pick first those Segments having already created questions with empty
         # answer (label=None). After finishing those, we'll look for
         # Segments never considered (ie, that doest have any question created).
         # Finally, those with answers in place, but with some answers "ASK-ME-LATER"
-        segments = self._matching_text_segments().order_by('id')
-        never_considered_segm = segments.exclude(evidence_relations__labels__relation=self)
-
-        evidences = EvidenceCandidate.objects.filter(
-            labels__relation=self
-        ).order_by('segment_id')
-        never_considered_ev = evidences.filter(labels__isnull=True)
-
-        existent_labels = EvidenceLabel.objects.filter(
-            evidence_candidate__in=evidences,
-            labeled_by_machine=False
-        ).order_by('evidence_candidate__segment_id')
-        none_labels = existent_labels.filter(label__isnull=True)
-        own_none_labels = none_labels.filter(judge=judge)
-
-        # requires re answer if there's no Good answer at all (not just for this judge)
-        NOT_NEED_RELABEL = [k for k, name in EvidenceLabel.LABEL_CHOICES
-                            if k not in EvidenceLabel.NEED_RELABEL]
-        to_re_answer = evidences.exclude(labels__label__in=NOT_NEED_RELABEL)
-
-        for qset in [own_none_labels, never_considered_ev, never_considered_segm,
-                     to_re_answer, none_labels]:
-            try:
-                obj = qset[0]
-            except IndexError:
-                pass
-            else:
-                if isinstance(obj, TextSegment):
-                    return obj
-                elif isinstance(obj, EvidenceCandidate):
-                    return obj.segment
-                elif isinstance(obj, EvidenceLabel):
-                    return obj.evidence_candidate.segment
-                else:
-                    raise ValueError
-        return None
+        # The priorities are kept precomputed on the LabelingQueue of the relation.
+        return LabelingQueue.for_relation(self).next_segment(judge)
 
     def get_next_document_to_label(self, judge):
         next_segment = self.get_next_segment_to_label(judge)
@@ -716,6 +840,142 @@ class SegmentToTag(BaseModel):
         unique_together = ['segment', 'relation']
 
 
+class LabelingQueue(BaseModel):
+    """Segments pending of labeling for a relation, with their priorities
+    precomputed. See Relation.get_next_segment_to_label.
+
+    The queue is built the first time is used, and since then kept updated
+    when labels are saved or deleted, when occurrences are added or removed
+    from segments, and with the segments created later (detected with
+    last_segment_id).
+    """
+    # Priorities. Those for a judge only are on items with that judge, the
+    # others on items with empty judge.
+    OWN_EMPTY_LABELS = 0  # segments with questions not answered by the judge
+    NEVER_CONSIDERED = 1  # segments without questions
+    TO_RE_ANSWER = 2  # segments with questions without any solid answer
+    EMPTY_LABELS = 3  # segments with questions not answered by someone else
+
+    relation = models.OneToOneField('Relation', related_name='labeling_queue')
+    # Segments with ids up to this one were already considered
+    last_segment_id = models.IntegerField(default=0)
+
+    @classmethod
+    def for_relation(cls, relation):
+        queue, _ = cls.objects.get_or_create(relation=relation)
+        queue.relation = relation
+        queue.add_new_segments()
+        return queue
+
+    @classmethod
+    def refresh_segments(cls, segment_ids, relation_id=None):
+        """Updates the queues (of the relation given or all of them) with
+        respect to the segments provided. Segments still not considered by
+        a queue are ignored."""
+        segment_ids = set(segment_ids)
+        if not segment_ids:
+            return
+        queues = cls.objects.filter(last_segment_id__gte=min(segment_ids))
+        if relation_id is not None:
+            queues = queues.filter(relation_id=relation_id)
+        for queue in queues.select_related('relation'):
+            queue._refresh([s for s in segment_ids if s <= queue.last_segment_id])
+
+    def add_new_segments(self):
+        last_id = TextSegment.objects.order_by('-id').values_list('id', flat=True)[:1]
+        if not last_id or last_id[0] <= self.last_segment_id:
+            return
+        last_id = last_id[0]
+        with transaction.atomic():
+            # Another request may have added them meanwhile
+            self.last_segment_id = self._lock()
+            if last_id <= self.last_segment_id:
+                return
+            new_segments = set(self.relation._matching_text_segments().filter(
+                id__gt=self.last_segment_id, id__lte=last_id).values_list('id', flat=True))
+            new_segments.update(EvidenceLabel.objects.filter(
+                relation=self.relation,
+                evidence_candidate__segment_id__gt=self.last_segment_id,
+                evidence_candidate__segment_id__lte=last_id,
+            ).values_list('evidence_candidate__segment_id', flat=True))
+            self._refresh(new_segments)
+            self.last_segment_id = last_id
+            self.save()
+
+    def next_segment(self, judge):
+        for judge_ in [judge, '']:
+            item = self.items.filter(judge=judge_).select_related('segment').order_by(
+                'priority', 'segment_id').first()
+            if item is not None:
+                return item.segment
+        return None
+
+    def _refresh(self, segment_ids):
+        segment_ids = list(segment_ids)
+        for i in range(0, len(segment_ids), IN_LOOKUP_SIZE):
+            with transaction.atomic():
+                self._refresh_batch(segment_ids[i:i + IN_LOOKUP_SIZE])
+
+    def _lock(self):
+        # Locks the queue row until the end of the current transaction, so
+        # concurrent refreshes of the queue (from different web requests)
+        # wait for each other instead of inserting the same items twice.
+        # Returns the stored last_segment_id.
+        return LabelingQueue.objects.select_for_update().values_list(
+            'last_segment_id', flat=True).get(pk=self.pk)
+
+    def _refresh_batch(self, segment_ids):
+        self._lock()
+        matching = set(self.relation._matching_text_segments().filter(
+            id__in=segment_ids).values_list('id', flat=True))
+        labels = EvidenceLabel.objects.filter(
+            relation_id=self.relation_id,
+            evidence_candidate__segment_id__in=segment_ids,
+        ).values_list('evidence_candidate__segment_id', 'evidence_candidate_id',
+                      'label', 'judge', 'labeled_by_machine')
+
+        priorities = {}  # (segment_id, judge) -> priority
+
+        def prioritize(segment_id, judge, priority):
+            key = (segment_id, judge)
+            priorities[key] = min(priority, priorities.get(key, priority))
+
+        considered = set()
+        weak_candidates = {}  # candidate_id -> (segment_id, all answers are weak)
+        for segment_id, candidate_id, label, judge, by_machine in labels:
+            considered.add(segment_id)
+            is_weak = label is None or label in EvidenceLabel.NEED_RELABEL
+            weak_candidates[candidate_id] = (
+                segment_id, weak_candidates.get(candidate_id, (None, True))[1] and is_weak)
+            if label is None and not by_machine:
+                if judge:
+                    prioritize(segment_id, judge, self.OWN_EMPTY_LABELS)
+                prioritize(segment_id, '', self.EMPTY_LABELS)
+        for segment_id in matching.difference(considered):
+            prioritize(segment_id, '', self.NEVER_CONSIDERED)
+        for segment_id, all_weak in weak_candidates.values():
+            if all_weak:
+                prioritize(segment_id, '', self.TO_RE_ANSWER)
+
+        self.items.filter(segment_id__in=segment_ids).delete()
+        LabelingQueueItem.objects.bulk_create([
+            LabelingQueueItem(queue=self, segment_id=segment_id, judge=judge,
+                              priority=priority)
+            for (segment_id, judge), priority in priorities.items()
+        ])
+
+
+class LabelingQueueItem(BaseModel):
+    queue = models.ForeignKey('LabelingQueue', related_name='items')
+    segment = models.ForeignKey('TextSegment', related_name='+')
+    judge = models.CharField(max_length=CHAR_MAX_LENGHT, blank=True)
+    priority = models.PositiveSmallIntegerField()
+
+    class Meta(BaseModel.Meta):
+        unique_together = ['queue', 'segment', 'judge']
+        index_together = [['queue', 'judge', 'priority', 'segment']]
+
+
 class GazetteItem(BaseModel):
     kind = models.ForeignKey(EntityKind)
     text = models.CharField(max_length=CHAR_MAX_LENGHT, blank=False, unique=True)
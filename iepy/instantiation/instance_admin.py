@@ -25,6 +25,7 @@ class InstanceManager:
         "rules_verifier.py",
         "manage.py",
         "gazettes_loader.py",
+        "materialize_candidates.py",
     ]
     steps = [
         'create_folders',
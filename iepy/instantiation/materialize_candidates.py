@@ -0,0 +1,51 @@
+"""
+IEPY evidence candidates materializer
+
+Creates, in bulk, all the missing evidence candidates of the given relations,
+so later runs of the extractors don't need to create them on the fly.
+If no relation is given, all of them are processed.
+
+Usage:
+    materialize_candidates.py [options] [<relation_name>...]
+    materialize_candidates.py -h | --help | --version
+
+Options:
+  --batch-size=<n>      Amount of segments processed per batch [default: 500]
+  -h --help             Show this screen
+  --version             Version number
+"""
+
+import logging
+from sys import exit
+
+from docopt import docopt
+
+import iepy
+iepy.setup(__file__)
+from iepy.data.db import CandidateEvidenceManager
+from iepy.data.models import Relation
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    opts = docopt(__doc__, version=iepy.__version__)
+    batch_size = int(opts['--batch-size'])
+
+    relation_names = opts['<relation_name>']
+    relations = list(Relation.objects.all())
+    if relation_names:
+        by_name = {r.name: r for r in relations}
+        missing = [n for n in relation_names if n not in by_name]
+        if missing:
+            print("Relations {} non existent".format(', '.join(map(repr, missing))))
+            print("All available relations:")
+            for relation in relations:
+                print("  {}".format(relation))
+            exit(1)
+        relations = [by_name[n] for n in relation_names]
+
+    for relation in relations:
+        report = CandidateEvidenceManager.bulk_create_candidates_for_relation(
+            relation, batch_size=batch_size)
+        print("Relation {}: {} candidates created on {} segments ({:.2f} secs)".format(
+            relation, report.created, report.segments, report.elapsed))
@@ -2,16 +2,18 @@
 Corpus preprocessing script
 
 Usage:
-    preprocess.py
-    preprocess.py --increment-ner
+    preprocess.py [--workers=<n>]
+    preprocess.py --increment-ner [--workers=<n>]
     preprocess.py -h | --help | --version
 
 Options:
   -h --help             Show this screen
   --increment-ner       Re run NER and Gazetter for every document. If a document lacked any of the previous steps, will be preprocessed entirely.
+  --workers=<n>         Amount of processes preprocessing documents at the same time. Using more than one is not recommended with sqlite databases [default: 1]
   --version             Version number
 """
 import logging
+from functools import partial
 
 from docopt import docopt
 
@@ -19,7 +21,7 @@ import iepy
 iepy.setup(__file__)
 from iepy.data.db import DocumentManager
 from iepy.preprocess.stanford_preprocess import StanfordPreprocess
-from iepy.preprocess.pipeline import PreProcessPipeline
+from iepy.preprocess.pipeline import PreProcessPipeline, ParallelPreProcessPipeline
 from iepy.preprocess.segmenter import SyntacticSegmenterRunner
 
 
@@ -30,9 +32,17 @@ if __name__ == '__main__':
     opts = docopt(__doc__, version=iepy.__version__)
     docs = DocumentManager()
     increment_ner = opts['--increment-ner']
+    workers = int(opts['--workers'])
 
-    pipeline = PreProcessPipeline([
-        StanfordPreprocess(increment_ner),
-        SyntacticSegmenterRunner(increment=True)
-    ], docs)
-    pipeline.process_everything()
+    runner_factories = [
+        partial(StanfordPreprocess, increment_ner),
+        partial(SyntacticSegmenterRunner, increment=True),
+    ]
+    if workers > 1:
+        pipeline = ParallelPreProcessPipeline(runner_factories, docs, workers=workers)
+        for report in pipeline.process_everything():
+            for doc_id, error in report.failures:
+                logger.error('Document %s failed: %s', doc_id, error)
+    else:
+        pipeline = PreProcessPipeline([factory() for factory in runner_factories], docs)
+        pipeline.process_everything()
@@ -1,9 +1,14 @@
+import gzip
+import hashlib
 import subprocess
-import xmltodict
 import os
 import sys
 import logging
+import queue
 import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import lru_cache
 
 import iepy
@@ -22,19 +27,176 @@ DOWNLOAD_URL_ES = _STANFORD_BASE_URL + '/stanford-spanish-corenlp-2014-08-26-mod
 _FOLDER_PATH = os.path.join(DIRS.user_data_dir, _CORENLP_VERSION)
 COMMAND_PATH = os.path.join(_FOLDER_PATH, "corenlp.sh")
 
+# All the annotators used, in the order they run
+ANNOTATORS = ("tokenize", "ssplit", "pos", "lemma", "ner", "parse", "dcoref")
+# Annotators that each annotator needs to be run before it
+_ANNOTATOR_REQUIREMENTS = {
+    "ssplit": ["tokenize"],
+    "pos": ["ssplit"],
+    "lemma": ["pos"],
+    "ner": ["lemma"],
+    "parse": ["ssplit"],
+    "dcoref": ["ner", "parse"],
+}
 
-@lru_cache(maxsize=1)
-def get_analizer(*args, **kwargs):
+
+def required_annotators(annotators):
+    """Returns the annotators needed for running the given ones (themselves
+    included), in the order they need to run."""
+    needed = set()
+    pending = list(annotators)
+    while pending:
+        annotator = pending.pop()
+        if annotator not in needed:
+            needed.add(annotator)
+            pending.extend(_ANNOTATOR_REQUIREMENTS.get(annotator, []))
+    return [x for x in ANNOTATORS if x in needed]
+
+
+@lru_cache(maxsize=None)
+def get_analizer(*args, processes=1, **kwargs):
+    """Returns a StanfordCoreNLP, or a pool of them if more than one process
+    is requested. The annotators to run can be chosen with the annotators
+    keyword argument (all of them by default). Unless a cache is given,
+    analysis are cached on disk as configured on the instance settings.
+    Analizers are kept running, one for each different set of arguments."""
     logger.info("Loading StanfordCoreNLP...")
+    if "cache" not in kwargs:
+        kwargs["cache"] = get_default_cache()
+    if processes > 1:
+        return StanfordCoreNLPPool(processes, *args, **kwargs)
     return StanfordCoreNLP(*args, **kwargs)
 
 
+def get_default_cache():
+    """Returns the AnalysisCache configured on the instance settings, or None
+    if the cache is disabled (IEPY_CORENLP_CACHE_SIZE set to 0)."""
+    settings = iepy.instance.settings
+    max_size = getattr(settings, "IEPY_CORENLP_CACHE_SIZE", 0)
+    if not max_size:
+        return None
+    folder = getattr(settings, "IEPY_CORENLP_CACHE_DIR", None)
+    if not folder:
+        folder = os.path.join(DIRS.user_cache_dir, "corenlp")
+    return AnalysisCache(folder, max_size)
+
+
+def file_hash(filepath):
+    hasher = hashlib.sha256()
+    with open(filepath, "rb") as filehandler:
+        for chunk in iter(lambda: filehandler.read(1 << 16), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def analysis_config_key(cmd_args, gazettes_filepath=None):
+    """Returns a string identifying everything, besides the text, that
+    determines the output of CoreNLP: its version and the command arguments
+    (language models and annotators). The gazettes file is identified by
+    its content, not by its path, given that it's regenerated on each run."""
+    parts = [_CORENLP_VERSION]
+    for arg in cmd_args:
+        if gazettes_filepath and arg == gazettes_filepath:
+            arg = "gazettes:" + file_hash(gazettes_filepath)
+        parts.append(arg)
+    return " ".join(parts)
+
+
+class AnalysisCache:
+    """Persistent cache of CoreNLP outputs, stored compressed on folder.
+
+    Entries are addressed by the hash of the analized text plus the
+    configuration that produced them (see analysis_config_key), so changing
+    the language, the annotators or the gazettes never hits stale entries.
+    When the stored entries exceed max_size bytes the least recently used
+    ones are removed.
+    """
+    SUFFIX = ".xml.gz"
+    EVICTION_RATIO = 0.9  # when evicting, size is reduced down to this ratio
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self._size = None  # computed on the first write
+        self._lock = threading.Lock()
+
+    def key(self, config_key, text):
+        hasher = hashlib.sha256(config_key.encode("utf8"))
+        hasher.update(b"\0")
+        hasher.update(text.encode("utf8"))
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + self.SUFFIX)
+
+    def get(self, key):
+        """Returns the output stored for key, or None if there's no such entry"""
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rb") as filehandler:
+                output = filehandler.read().decode("utf8")
+            os.utime(path)  # marks it as recently used
+        except (OSError, EOFError):
+            return None
+        return output
+
+    def put(self, key, output):
+        path = self._path(key)
+        data = gzip.compress(output.encode("utf8"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written on a temporary file and then moved, so other processes
+        # sharing the cache never read an entry half written
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as filehandler:
+            filehandler.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.folder):
+            for filename in filenames:
+                if not filename.endswith(self.SUFFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue  # removed by another process meanwhile
+                yield path, stat_result.st_size, stat_result.st_mtime
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda x: x[2])
+        self._size = sum(size for _, size, _ in entries)
+        target = self.max_size * self.EVICTION_RATIO
+        for path, size, _ in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+        logger.info("CoreNLP analysis cache reduced to {} bytes".format(self._size))
+
+
 class StanfordCoreNLP:
     CMD_ARGS = "-outputFormat xml -threads 4"
     PROMPT = b"\nNLP> "
 
-    def __init__(self, tokenize_with_whitespace=False, gazettes_filepath=None):
-        cmd_args = self.command_args(tokenize_with_whitespace, gazettes_filepath)
+    def __init__(self, tokenize_with_whitespace=False, gazettes_filepath=None,
+                 cache=None, annotators=ANNOTATORS):
+        """Only the given annotators (and the ones they depend on) are run."""
+        cmd_args = self.command_args(tokenize_with_whitespace, gazettes_filepath,
+                                     annotators)
+        self.cache = cache
+        if cache is not None:
+            self.config_key = analysis_config_key(cmd_args, gazettes_filepath)
         os.chdir(_FOLDER_PATH)
         self.corenlp_cmd = [COMMAND_PATH] + cmd_args
         self._start_proc()
@@ -50,31 +212,40 @@ class StanfordCoreNLP:
         self.output = self.iter_output_segments()
         self.receive()  # Wait until the prompt is ready
 
-    def command_args(self, tokenize_with_whitespace, gazettes_filepath):
-        annotators = ["tokenize", "ssplit", "pos", "lemma", "ner", "parse", "dcoref"]
+    def command_args(self, tokenize_with_whitespace, gazettes_filepath,
+                     annotators=ANNOTATORS):
+        lang = iepy.instance.settings.IEPY_LANG
+        annotators = list(annotators)
+        if lang == 'es' and 'dcoref' in annotators:
+            annotators.remove('dcoref')  # not supported for spanish on Stanford 3.4.1
+        annotators = required_annotators(annotators)
+
         cmd_args = self.CMD_ARGS[:]
         if tokenize_with_whitespace:
             cmd_args += " -tokenize.whitespace=true"
 
-        if gazettes_filepath:
+        if gazettes_filepath and "ner" in annotators:
             annotators.insert(annotators.index("ner") + 1, "regexner")
             cmd_args += " -regexner.mapping {}".format(gazettes_filepath)
 
-        lang = iepy.instance.settings.IEPY_LANG
         if lang == 'es':
             edu_mods = "edu/stanford/nlp/models"
-            annotators.remove('dcoref')  # not supported for spanish on Stanford 3.4.1
             cmd_args += " -tokenize.language es"
-            cmd_args += " -pos.model %s/pos-tagger/spanish/spanish-distsim.tagger" % edu_mods
-            cmd_args += " -ner.model %s/ner/spanish.ancora.distsim.s512.crf.ser.gz" % edu_mods
-            cmd_args += " -parse.model %s/lexparser/spanishPCFG.ser.gz" % edu_mods
+            if "pos" in annotators:
+                cmd_args += " -pos.model %s/pos-tagger/spanish/spanish-distsim.tagger" % edu_mods
+            if "ner" in annotators:
+                cmd_args += " -ner.model %s/ner/spanish.ancora.distsim.s512.crf.ser.gz" % edu_mods
+            if "parse" in annotators:
+                cmd_args += " -parse.model %s/lexparser/spanishPCFG.ser.gz" % edu_mods
 
         cmd_args += " -annotators {}".format(",".join(annotators))
         return cmd_args.split()
 
     def iter_output_segments(self):
+        # Several texts may be sent at once, so what's read after a prompt
+        # can be the start of the next output, and must be kept
+        buf = b""
         while True:
-            buf = b""
             while self.PROMPT not in buf:
                 buf += self.proc.stdout.read1(1024)
 
@@ -100,11 +271,93 @@ class StanfordCoreNLP:
 
     @lru_cache(maxsize=1)
     def analize(self, text):
-        self.send(text)
-        text = self.receive()
+        """Returns the xml output of CoreNLP for text"""
+        return self.analize_many([text])[0]
+
+    def analize_many(self, texts):
+        """Same as analize, but for several texts. All of them are sent at once,
+        so the process has always the next one ready to work on.
+        Returns the list of xml outputs, in the same order."""
+        texts = list(texts)
+        outputs = [None] * len(texts)
+        if self.cache is not None:
+            keys = [self.cache.key(self.config_key, t) for t in texts]
+            outputs = [self.cache.get(k) for k in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            # Sending from another thread, otherwise both processes could end up
+            # blocked writing on full pipes
+            writer = threading.Thread(target=self._send_all, args=([texts[i] for i in missing],))
+            writer.start()
+            try:
+                for i in missing:
+                    outputs[i] = self._xml_output(self.receive())
+                    if self.cache is not None:
+                        self.cache.put(keys[i], outputs[i])
+            except Exception:
+                # The outputs of the texts left would be read as the results of
+                # the next call, so the process is replaced. It's killed before
+                # waiting for the writer, that may be blocked on a full pipe.
+                self.proc.kill()
+                self.proc.wait()
+                writer.join()
+                self._start_proc()
+                raise
+            writer.join()
+        return outputs
+
+    def _send_all(self, texts):
+        try:
+            for text in texts:
+                self.send(text)
+        except OSError:
+            pass  # the process was killed, analize_many is failing already
+
+    def _xml_output(self, text):
         i = text.index("<?xml version")
-        text = text[i:]
-        return xmltodict.parse(text)["root"]["document"]
+        return text[i:]
+
+
+class StanfordCoreNLPPool:
+    """Several StanfordCoreNLP processes, analizing documents at the same time.
+    Takes the same arguments than StanfordCoreNLP, plus the amount of processes.
+    """
+
+    def __init__(self, processes, *args, **kwargs):
+        self.analizers = [StanfordCoreNLP(*args, **kwargs) for _ in range(processes)]
+        self._idle = queue.Queue()
+        for analizer in self.analizers:
+            self._idle.put(analizer)
+
+    @contextmanager
+    def _borrow(self):
+        analizer = self._idle.get()
+        try:
+            yield analizer
+        finally:
+            self._idle.put(analizer)
+
+    def analize(self, text):
+        with self._borrow() as analizer:
+            return analizer.analize(text)
+
+    def analize_many(self, texts, batch_size=8):
+        """Splits the texts in batches of batch_size, that are analized at the
+        same time by the different processes. Returns the list of xml outputs, in
+        the same order than texts."""
+        texts = list(texts)
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+        def analize_batch(batch):
+            with self._borrow() as analizer:
+                return analizer.analize_many(batch)
+
+        with ThreadPoolExecutor(len(self.analizers)) as executor:
+            return [x for batch in executor.map(analize_batch, batches) for x in batch]
+
+    def quit(self):
+        for analizer in self.analizers:
+            analizer.quit()
 
 
 def download(lang='en'):
@@ -1,4 +1,7 @@
 from collections import namedtuple
+
+from django.db import transaction
+
 from iepy.preprocess.pipeline import BasePreProcessStepRunner, PreProcessSteps
 
 
@@ -10,7 +13,7 @@ class BaseNERRunner(BasePreProcessStepRunner):
     step = PreProcessSteps.ner
 
     def __init__(self, override=False):
-        self.override = override
+        super(BaseNERRunner, self).__init__(override=override)
 
     def ok_for_running(self, doc):
         if not doc.was_preprocess_step_done(PreProcessSteps.sentencer):
@@ -30,9 +33,26 @@ class BaseNERRunner(BasePreProcessStepRunner):
         doc.set_ner_result(entities)
         doc.save()
 
+    def process_batch(self, docs):
+        # As with __call__, do not override this method when subclassing,
+        # but "run_ner_batch"
+        docs = [doc for doc in docs if self.ok_for_running(doc)]
+        if not docs:
+            return
+        results = self.run_ner_batch(docs)
+        with transaction.atomic():
+            for doc, entities in zip(docs, results):
+                doc.set_ner_result(entities)
+                doc.save()
+
     def run_ner(self, doc):
         # Define logic in here
         return []
 
+    def run_ner_batch(self, docs):
+        # Returns the entities found on each document. Define it when your
+        # NER can do better on several documents at once than one by one
+        return [self.run_ner(doc) for doc in docs]
+
     def build_occurrence(self, key, kind_name, alias, offset, offset_end):
         return FoundEntity(key, kind_name.upper(), alias, offset, offset_end, False)
@@ -1,6 +1,16 @@
+import logging
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
 from iepy.preprocess.ner.base import BaseNERRunner
 
 
+logger = logging.getLogger(__name__)
+
+
 class CombinedNERRunner(BaseNERRunner):
     """A NER runner that is the combination of different NER runners
     (therefore, different NERs).
@@ -8,9 +18,15 @@ class CombinedNERRunner(BaseNERRunner):
     The entities returned by each NER are combined by the method merge_entities
     without any check, possibly leading to duplicate or overlapping entities;
     but subclassing this combiner you may define something different.
+
+    The sub NERs run at the same time, each one on its own thread, so they
+    must be thread-safe. A sub NER querying the database does it with the
+    connection of its thread (closed once it finishes), that can't see what
+    the main thread didn't commit yet. The seconds spent on each of them are
+    accumulated on the elapsed list (same order than the NERs).
     """
 
-    def __init__(self, ners, override=False):
+    def __init__(self, ners, override=False, max_workers=None):
         """The NER runners should be instances of BasePreProcessStepRunner.
         Notes:
             - Each of the sub-ners will be configured to run with override-mode
@@ -18,11 +34,16 @@ class CombinedNERRunner(BaseNERRunner):
             The global override, will be used for determining wether to start
             or not the global-combined process.
             - Overriding only some NERs and not others is not allowed.
+            - At most max_workers sub-ners run at the same time (by default,
+            all of them). With max_workers=1 they run one after the other.
         """
         super(CombinedNERRunner, self).__init__(override=override)
         if not ners:
             raise ValueError(u'Empty NERs to combine')
         self.ners = ners
+        self.max_workers = max_workers or len(ners)
+        self.elapsed = [0.0] * len(ners)
+        self._executor = None  # created when first needed
 
         for sub_ner in self.ners:
             sub_ner.override = True
@@ -34,15 +55,32 @@ class CombinedNERRunner(BaseNERRunner):
             all_entities.extend(sub_entities)
         return sorted(all_entities, key=lambda x: x.offset)
 
+    def _timed_run_ner(self, i, doc):
+        start = time.time()
+        try:
+            return self.ners[i].run_ner(doc)
+        finally:
+            elapsed = time.time() - start
+            self.elapsed[i] += elapsed
+            logger.debug("Sub NER %s took %.3f secs", self.ners[i], elapsed)
+
+    def _threaded_run_ner(self, i, doc):
+        try:
+            return self._timed_run_ner(i, doc)
+        finally:
+            # each thread has its own database connection, if it was opened
+            connection.close()
+
     def run_ner(self, doc):
-        sub_results = []
-        for sub_ner in self.ners:
-            sub_results.append(
-                (sub_ner,
-                 sub_ner.run_ner(doc)
-                 )
-            )
-        return self.merge_entities(sub_results)
+        indexes = range(len(self.ners))
+        if self.max_workers == 1 or len(self.ners) == 1:
+            results = [self._timed_run_ner(i, doc) for i in indexes]
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            results = list(self._executor.map(
+                lambda i: self._threaded_run_ner(i, doc), indexes))
+        return self.merge_entities(list(zip(self.ners, results)))
 
 
 class NoOverlapCombinedNERRunner(CombinedNERRunner):
@@ -60,18 +98,48 @@ class NoOverlapCombinedNERRunner(CombinedNERRunner):
 
     def merge_entities(self, sub_results):
         result = []
+        # An entity overlaps some of the ones in result if and only if it
+        # overlaps the tokens covered by them. Those are kept as a sorted list
+        # of disjoint intervals, so checking an entity takes a binary search.
+        covered = _CoveredTokens()
         for ner, sub_res in sub_results:
-            if not result:
-                # first ner returning something. all in.
-                result.extend(sub_res)
-            else:
-                for ent in sub_res:
-                    if any(self.overlapped_entities(ent, e_i) for e_i in result):
-                        continue
-                    result.append(ent)
+            # first ner returning something. all in.
+            all_in = not result
+            for ent in sub_res:
+                if not all_in and covered.overlaps(ent.offset, ent.offset_end):
+                    continue
+                result.append(ent)
+                covered.add(ent.offset, ent.offset_end)
         return sorted(result, key=lambda x: x.offset)
 
 
+class _CoveredTokens(object):
+    """Union of intervals of tokens, stored as a sorted list of disjoint ones"""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def overlaps(self, start, end):
+        if start >= end:
+            return False
+        # first interval ending after start
+        i = bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        # intervals overlapping or touching [start, end) are merged with it
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+
 class KindPreferenceCombinedNERRunner(CombinedNERRunner):
     """
     Similar to the CombinedNERRunner, but when merging results from different
@@ -83,7 +151,7 @@ class KindPreferenceCombinedNERRunner(CombinedNERRunner):
         - shorter occurrences are preferred over larger
         - occurrences of former sub NERs are preferred.
     """
-    def __init__(self, ners, override=False, rank=tuple()):
+    def __init__(self, ners, override=False, rank=tuple(), max_workers=None):
         """
         """
         # the lower the rank, the more important
@@ -91,7 +159,7 @@ class KindPreferenceCombinedNERRunner(CombinedNERRunner):
             raise ValueError(u'rank can only be a list or tuple')
         self.kinds_rank = dict((k, i) for i, k in enumerate(rank))
         self.worst_rank = len(self.kinds_rank)
-        super(KindPreferenceCombinedNERRunner, self).__init__(ners, override)
+        super(KindPreferenceCombinedNERRunner, self).__init__(ners, override, max_workers)
 
     def get_rank(self, found_entity):
         return self.kinds_rank.setdefault(found_entity.kind_name, self.worst_rank)
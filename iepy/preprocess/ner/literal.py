@@ -1,39 +1,270 @@
-import codecs
+
+import json
+import mmap
+import struct
+import sys
+import zlib
+from array import array
 
 from iepy.preprocess.ner.base import BaseNERRunner
 
 
+class TokenTrie(object):
+    """Trie of names, where each name is a sequence of tokens.
+
+    Each node is a dict from tokens to the child nodes. On the nodes where
+    a name ends, the label of the name is stored under the key None.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, tokens, label):
+        if not tokens:
+            return
+        node = self.root
+        for token in tokens:
+            child = node.get(token)
+            if child is None:
+                child = node[token] = {}
+            node = child
+        node[None] = label
+
+    def encode(self, tokens):
+        """Returns the tokens as longest_match expects them"""
+        return tokens
+
+    def longest_match(self, tokens, start):
+        """Returns a pair (end, label) for the longest name that's found on
+        the encoded tokens starting at start, or None if no name is found
+        there."""
+        node = self.root
+        match = None
+        for j in range(start, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None:
+                break
+            if None in node:
+                match = (j + 1, node[None])
+        return match
+
+    def save(self, filepath):
+        """Writes the trie on filepath, on the format read by CompiledTokenTrie"""
+        # Nodes are numbered breadth first, the root is node 0
+        vocabulary = {}
+        labels = {}
+        transitions = []  # (node, token id, child)
+        node_labels = []
+        nodes = [self.root]
+        for node_id, node in enumerate(nodes):
+            label = node.get(None)
+            if label is None:
+                node_labels.append(0)
+            else:
+                node_labels.append(labels.setdefault(label, len(labels) + 1))
+            for token, child in node.items():
+                if token is None:
+                    continue
+                token_id = vocabulary.setdefault(token, len(vocabulary))
+                transitions.append((node_id, token_id, len(nodes)))
+                nodes.append(child)
+        _write_compiled_trie(filepath, vocabulary, sorted(labels, key=labels.get),
+                             transitions, node_labels)
+
+
+# Compiled trie file format. All numbers are unsigned, on native byte order.
+#  - header: magic, byte order, and the sizes of each section.
+#  - labels: json list of the labels.
+#  - tokens: offsets (uint32) of each token on the utf-8 blob of all tokens,
+#    plus the blob itself.
+#  - tokens hash table: open addressing, linear probing on the crc32 of the
+#    token. Slots hold the token id plus one (0 is empty).
+#  - transitions hash table: open addressing, linear probing. Keys (uint64)
+#    are (node << 32 | token id) plus one (0 is empty), values (uint32) are
+#    the child nodes.
+#  - node labels: for each node, 0 or the position of its label plus one (uint16).
+# Every section starts at an offset multiple of 8.
+_MAGIC = b"IEPYTRI1"
+_HEADER = struct.Struct("=8sc7I")
+_BYTEORDER = b"<" if sys.byteorder == "little" else b">"
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK_64 = (1 << 64) - 1
+
+
+def _table_bits(amount):
+    # Enough bits for a table at most half full
+    return max(1, (2 * amount).bit_length())
+
+
+def _transition_slot(key, bits):
+    return ((key * _HASH_MULTIPLIER) & _MASK_64) >> (64 - bits)
+
+
+def _padding(size):
+    return b"\0" * (-size % 8)
+
+
+def _write_compiled_trie(filepath, vocabulary, labels, transitions, node_labels):
+    tokens = sorted(vocabulary, key=vocabulary.get)
+    encoded = [t.encode("utf8") for t in tokens]
+    offsets = array("I", [0])
+    for token in encoded:
+        offsets.append(offsets[-1] + len(token))
+    blob = b"".join(encoded)
+
+    tokens_bits = _table_bits(len(tokens))
+    tokens_mask = (1 << tokens_bits) - 1
+    tokens_table = array("I", [0]) * (1 << tokens_bits)
+    for token_id, token in enumerate(encoded):
+        slot = zlib.crc32(token) & tokens_mask
+        while tokens_table[slot]:
+            slot = (slot + 1) & tokens_mask
+        tokens_table[slot] = token_id + 1
+
+    transitions_bits = _table_bits(len(transitions))
+    transitions_mask = (1 << transitions_bits) - 1
+    keys = array("Q", [0]) * (1 << transitions_bits)
+    children = array("I", [0]) * (1 << transitions_bits)
+    for node, token_id, child in transitions:
+        key = (node << 32 | token_id) + 1
+        slot = _transition_slot(key, transitions_bits)
+        while keys[slot]:
+            slot = (slot + 1) & transitions_mask
+        keys[slot] = key
+        children[slot] = child
+
+    labels_data = json.dumps(labels).encode("utf8")
+    header = _HEADER.pack(_MAGIC, _BYTEORDER, len(labels_data), len(tokens),
+                          len(blob), tokens_bits, len(node_labels), transitions_bits, 0)
+    with open(filepath, "wb") as f:
+        for data in [header, labels_data, offsets.tobytes(), blob, tokens_table.tobytes(),
+                     keys.tobytes(), children.tobytes(),
+                     array("H", node_labels).tobytes()]:
+            f.write(data)
+            f.write(_padding(len(data)))
+
+
+class CompiledTokenTrie(object):
+    """Read only TokenTrie, loaded from a file written by TokenTrie.save.
+
+    The file is memory mapped and used as is, so loading is immediate and
+    several processes using the same file share the memory.
+    """
+
+    def __init__(self, filepath):
+        with open(filepath, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = memoryview(self._mmap)
+        (magic, byteorder, labels_size, tokens_count, blob_size, self._tokens_bits,
+         nodes_count, self._transitions_bits, _) = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("{} is not a compiled gazette".format(filepath))
+        if byteorder != _BYTEORDER:
+            raise ValueError("{} was compiled on a machine of different byte order, "
+                             "it needs to be compiled again".format(filepath))
+        position = _HEADER.size + len(_padding(_HEADER.size))
+
+        def section(size, typecode=None):
+            nonlocal position
+            result = data[position:position + size]
+            position += size + (-size % 8)
+            return result.cast(typecode) if typecode else result
+
+        self.labels = json.loads(bytes(section(labels_size)).decode("utf8"))
+        self._offsets = section(4 * (tokens_count + 1), "I")
+        self._blob = section(blob_size)
+        self._tokens_table = section(4 << self._tokens_bits, "I")
+        self._keys = section(8 << self._transitions_bits, "Q")
+        self._children = section(4 << self._transitions_bits, "I")
+        self._node_labels = section(2 * nodes_count, "H")
+
+    def token_id(self, token):
+        """Returns the id of token, or None if it's on no name"""
+        encoded = token.encode("utf8")
+        mask = (1 << self._tokens_bits) - 1
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            token_id = self._tokens_table[slot] - 1
+            if token_id < 0:
+                return None
+            start, end = self._offsets[token_id], self._offsets[token_id + 1]
+            if self._blob[start:end] == encoded:
+                return token_id
+            slot = (slot + 1) & mask
+
+    def encode(self, tokens):
+        """Returns the tokens as longest_match expects them (their ids)"""
+        ids = {}
+        for token in tokens:
+            if token not in ids:
+                ids[token] = self.token_id(token)
+        return [ids[token] for token in tokens]
+
+    def child(self, node, token_id):
+        """Returns the child of node through token_id, or None"""
+        key = (node << 32 | token_id) + 1
+        keys = self._keys
+        mask = (1 << self._transitions_bits) - 1
+        slot = _transition_slot(key, self._transitions_bits)
+        while True:
+            current = keys[slot]
+            if current == key:
+                return self._children[slot]
+            if not current:
+                return None
+            slot = (slot + 1) & mask
+
+    def longest_match(self, tokens, start):
+        """Returns a pair (end, label) for the longest name that's found on
+        the encoded tokens starting at start, or None if no name is found
+        there."""
+        node_labels = self._node_labels
+        node = 0
+        match = None
+        for j in range(start, len(tokens)):
+            if tokens[j] is None:
+                break
+            node = self.child(node, tokens[j])
+            if node is None:
+                break
+            label = node_labels[node]
+            if label:
+                match = (j + 1, self.labels[label - 1])
+        return match
+
+
 class LiteralNER(object):
     """Trivial Named Entity Recognizer that tags exact matches.
     """
 
-    def __init__(self, labels, src_filenames):
+    def __init__(self, labels=None, src_filenames=None, compiled_filepath=None):
         """The i-th label is used to tag the occurrences of the terms in the
         i-th source file. If a term can have several labels, the last one in
         the list is selected.
+
+        Instead of labels and source files, the path of a file written by
+        save can be given as compiled_filepath. Loading it is immediate.
         """
+        if compiled_filepath is not None:
+            self.trie = CompiledTokenTrie(compiled_filepath)
+            self.labels = self.trie.labels
+            self.src_filenames = None
+            return
+
         assert len(labels) == len(src_filenames)
         self.labels = labels
         self.src_filenames = src_filenames
 
-        names = set()
-        names_map = {}
+        self.trie = TokenTrie()
         for label, filename in zip(labels, src_filenames):
-            f = codecs.open(filename, encoding="utf8")
-            namelist = f.read().strip().split('\n')
-            names.update(namelist)
-            for name in namelist:
-                names_map[name] = label
-        self.names = frozenset(names)
-        self.names_map = names_map
-
-        # compute prefix closure
-        prefixes = set()
-        for name in self.names:
-            sname = name.split()
-            prefixes.update([' '.join(sname[:i]) for i in range(1, len(sname) + 1)])
-
-        self.prefixes = frozenset(prefixes)
+            with open(filename, encoding="utf8") as f:
+                for name in f:
+                    self.trie.add(name.split(), label)
+
+    def save(self, filepath):
+        """Compiles the names on a binary file, that can be used later with
+        LiteralNER(compiled_filepath=filepath)"""
+        self.trie.save(filepath)
 
     def tag(self, sent):
         """Tagger with output a la Stanford (no start/end markers).
@@ -57,20 +288,18 @@ class LiteralNER(object):
 
     def entities(self, sent):
         """Return entities as a list of pairs ((offset, offset_end), label).
+        At each position the longest name found is taken, and the search
+        continues after it.
         """
         result = []
+        tokens = self.trie.encode(sent)
         i = 0
         while i < len(sent):
-            j = i + 1
-            prev_segment = segment = ' '.join(sent[i:j])
-            while segment in self.prefixes and j <= len(sent):
-                j += 1
-                prev_segment = segment
-                segment = ' '.join(sent[i:j])
-            if prev_segment in self.names:
-                label = self.names_map[prev_segment]
-                result.append(((i, j - 1), label))
-                i = j - 1
+            match = self.trie.longest_match(tokens, i)
+            if match is not None:
+                j, label = match
+                result.append(((i, j), label))
+                i = j
             else:
                 i += 1
 
@@ -79,9 +308,10 @@ class LiteralNER(object):
 
 class LiteralNERRunner(BaseNERRunner):
 
-    def __init__(self, labels, src_filenames, override=False):
+    def __init__(self, labels=None, src_filenames=None, override=False,
+                 compiled_filepath=None):
         super(LiteralNERRunner, self).__init__(override=override)
-        self.lit_tagger = LiteralNER(labels, src_filenames)
+        self.lit_tagger = LiteralNER(labels, src_filenames, compiled_filepath)
 
     def run_ner(self, doc):
         entities = []
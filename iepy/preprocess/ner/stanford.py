@@ -3,10 +3,10 @@ import os
 import os.path
 import logging
 
-from nltk.tag.stanford import NERTagger
 import wget
 
 from iepy.preprocess.ner.base import BaseNERRunner
+from iepy.preprocess.stanford_server import StanfordTaggingServer
 from iepy.utils import DIRS, unzip_file
 
 logger = logging.getLogger(__name__)
@@ -14,28 +14,32 @@ stanford_ner_name = 'stanford-ner-2014-01-04'
 download_url_base = 'http://nlp.stanford.edu/software/'
 
 
-class NonTokenizingNERTagger(NERTagger):
-
-    @property
-    def _cmd(self):
-        old = super(NonTokenizingNERTagger, self)._cmd
-        old = old + ["-tokenizerFactory", "edu.stanford.nlp.process.WhitespaceTokenizer"]
-        return old
-
-
 class NERRunner(BaseNERRunner):
     """Wrapper to insert a generic callable sentence NER tagger into the pipeline.
     """
-    def __init__(self, ner, override=False):
+    def __init__(self, ner, override=False, batch_size=50):
+        """Running in the pipeline, the sentences of batch_size documents are
+        sent to the ner with a single call."""
         super(NERRunner, self).__init__(override=override)
         self.ner = ner
+        self.batch_size = batch_size
 
     def run_ner(self, doc):
-        entities = []
+        return self.run_ner_batch([doc])[0]
+
+    def run_ner_batch(self, docs):
         # Apply the ner algorithm which takes a list of sentences and returns
         # a list of sentences, each being a list of NER-tokens, each of which is
         # a pairs (tokenstring, class)
-        ner_sentences = self.ner(doc.get_sentences())
+        sentences = [list(doc.get_sentences()) for doc in docs]
+        all_sentences = [s for ss in sentences for s in ss]
+        # no need to start the ner when there's nothing to tag
+        ner_sentences = iter(self.ner(all_sentences) if all_sentences else [])
+        return [self.build_entities(doc, itertools.islice(ner_sentences, len(doc_sentences)))
+                for doc, doc_sentences in zip(docs, sentences)]
+
+    def build_entities(self, doc, ner_sentences):
+        entities = []
         # Flatten the nested list above into just a list of kinds
         ner_kinds = (k for s in ner_sentences for (_, k) in s)
 
@@ -81,18 +85,25 @@ class NERRunner(BaseNERRunner):
 
 class StanfordNERRunner(NERRunner):
 
-    def __init__(self, override=False):
+    def __init__(self, override=False, batch_size=50):
         ner_path = os.path.join(DIRS.user_data_dir, stanford_ner_name)
         if not os.path.exists(ner_path):
             raise LookupError("Stanford NER not found. Try running the "
                               "command download_third_party_data.py")
 
-        ner = NonTokenizingNERTagger(
+        # The java process is started on the first use, and kept running
+        self.server = StanfordTaggingServer([
+            'java', '-mx1000m',
+            '-cp', os.path.join(ner_path, 'stanford-ner.jar'),
+            'edu.stanford.nlp.ie.crf.CRFClassifier',
+            '-loadClassifier',
             os.path.join(ner_path, 'classifiers', 'english.all.3class.distsim.crf.ser.gz'),
-            os.path.join(ner_path, 'stanford-ner.jar'),
-            encoding='utf8')
-
-        super(StanfordNERRunner, self).__init__(ner.tag_sents, override)
+            '-readStdin',
+            '-outputFormat', 'slashTags',
+            '-tokenizerFactory', 'edu.stanford.nlp.process.WhitespaceTokenizer',
+            '-encoding', 'utf8',
+        ], separator='/')
+        super(StanfordNERRunner, self).__init__(self.server.tag_sents, override, batch_size)
 
 
 def download():
@@ -1,8 +1,16 @@
 import logging
+import multiprocessing
+import time
+from collections import namedtuple
 from enum import Enum
+from itertools import islice
 
 logger = logging.getLogger(__name__)
 
+# Summary of running a step on several documents. Failures is a list of pairs
+# (document id, error description). Skipped are the documents not needing it.
+StepReport = namedtuple('StepReport', 'runner documents failures elapsed skipped')
+
 
 class PreProcessSteps(Enum):
     # numbers do not imply order
@@ -15,6 +23,18 @@ class PreProcessSteps(Enum):
     syntactic_parsing = 7
 
 
+# Steps whose results each step is computed from. The result of a step on a
+# document is outdated if any of them was done again after it.
+STEP_DEPENDENCIES = {
+    PreProcessSteps.lemmatization: [PreProcessSteps.tokenization],
+    PreProcessSteps.sentencer: [PreProcessSteps.tokenization],
+    PreProcessSteps.tagging: [PreProcessSteps.tokenization],
+    PreProcessSteps.ner: [PreProcessSteps.tokenization, PreProcessSteps.sentencer],
+    PreProcessSteps.segmentation: [PreProcessSteps.sentencer, PreProcessSteps.ner],
+    PreProcessSteps.syntactic_parsing: [PreProcessSteps.sentencer],
+}
+
+
 class PreProcessPipeline(object):
     """Coordinates the pre-processing tasks on a set of documents"""
 
@@ -35,26 +55,189 @@ class PreProcessPipeline(object):
         return
 
     def process_step_in_batch(self, runner):
-        """Tries to apply the required step to all documents lacking it"""
+        """Tries to apply the required step to all documents lacking it.
+        Runners on increment mode are applied to the documents whose result
+        on the step is outdated. Returns a StepReport."""
         logger.info('Starting preprocessing step %s', runner)
-        if hasattr(runner, 'step') and not (runner.override or runner.increment):
+        start = time.time()
+        filtered = hasattr(runner, 'step') and not runner.override
+        if filtered and getattr(runner, 'increment', False):
+            docs = self.documents.get_documents_outdated_preprocess(runner.step)
+        elif filtered:
             docs = self.documents.get_documents_lacking_preprocess(runner.step)
         else:
             docs = self.documents  # everything
-        for i, doc in enumerate(docs):
-            runner(doc)
-            logger.info('\tDone for %i documents', i + 1)
+        done = 0
+        if isinstance(runner, BasePreProcessStepRunner) and runner.batch_size:
+            for batch in _batches(docs, runner.batch_size):
+                runner.process_batch(batch)
+                done += len(batch)
+                logger.info('\tDone for %i documents', done)
+        else:
+            for doc in docs:
+                runner(doc)
+                done += 1
+                logger.info('\tDone for %i documents', done)
+        skipped = len(self.documents) - done if filtered else 0
+        if skipped:
+            logger.info('\tSkipped %i documents already up to date', skipped)
+        return StepReport(runner, done, [], time.time() - start, skipped)
 
     def process_everything(self):
-        """Tries to apply all the steps to all documents"""
-        for runner in self.step_runners:
-            self.process_step_in_batch(runner)
+        """Tries to apply all the steps to all documents. Returns the list
+        of StepReports."""
+        return [self.process_step_in_batch(runner) for runner in self.step_runners]
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+# State of each worker process of a ParallelPreProcessPipeline
+_worker = {}
+
+
+def _init_worker(runner_factories, documents_manager):
+    _worker['runners'] = [factory() for factory in runner_factories]
+    _worker['documents'] = documents_manager
+
+
+def _process_documents_batch(args):
+    runner_idx, doc_ids = args
+    runner = _worker['runners'][runner_idx]
+    documents = _worker['documents']
+    filtered = hasattr(runner, 'step') and not runner.override
+    if filtered and getattr(runner, 'increment', False):
+        docs = documents.get_documents_by_ids(doc_ids, outdated=runner.step)
+    elif filtered:
+        docs = documents.get_documents_by_ids(doc_ids, lacking=runner.step)
+    else:
+        docs = documents.get_documents_by_ids(doc_ids)
+    processed = 0
+    failures = []
+    if isinstance(runner, BasePreProcessStepRunner) and runner.batch_size:
+        for batch in _batches(docs, runner.batch_size):
+            try:
+                runner.process_batch(batch)
+            except Exception:
+                # retried one by one, so only the failing documents are reported.
+                # They are loaded again, since results may have been set on the
+                # ones in memory without being saved.
+                logger.warning('Failed preprocessing a batch of documents, '
+                               'retrying them one by one', exc_info=True)
+                batch = documents.get_documents_by_ids([doc.id for doc in batch])
+                failures.extend(_run_one_by_one(runner, batch))
+            processed += len(batch)
+    else:
+        docs = list(docs)
+        failures.extend(_run_one_by_one(runner, docs))
+        processed = len(docs)
+    return processed, failures
+
+
+def _run_one_by_one(runner, docs):
+    # Returns the (document id, error) of the documents that failed
+    failures = []
+    for doc in docs:
+        try:
+            runner(doc)
+        except Exception as error:
+            logger.exception('Failed preprocessing document %s', doc.id)
+            failures.append((doc.id, repr(error)))
+    return failures
+
+
+class ParallelPreProcessPipeline(PreProcessPipeline):
+    """Same than PreProcessPipeline, but distributing the documents among
+    several worker processes.
+
+    Instead of step runners, it takes callables that build them (one for each
+    step), so each worker has its own runners (and its own database connection).
+    Steps are processed one after the other, as in PreProcessPipeline.
+    walk_document, instead, runs all the steps on this process.
+    Document ids are handed out to workers in batches of batch_size, and
+    workers hand them to the process_batch of runners that define their own
+    batch_size.
+    Failures on some document are reported, and don't stop the others.
+
+    Since several processes will be writing on the database at the same time,
+    it's recommended to use a database engine other than sqlite.
+    """
+
+    def __init__(self, runner_factories, documents_manager, workers=None,
+                 batch_size=20):
+        self.runner_factories = runner_factories
+        self.documents = documents_manager
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self._step_runners = None
+
+    @property
+    def step_runners(self):
+        # Runners for processing documents on this same process, built when
+        # first needed (see walk_document)
+        if self._step_runners is None:
+            self._step_runners = [factory() for factory in self.runner_factories]
+        return self._step_runners
+
+    def process_step_in_batch(self, runner_idx):
+        """Applies the step of the runner built by the runner_idx-th factory
+        to all the documents. Returns a StepReport."""
+        return self.process_everything(only=[runner_idx])[0]
+
+    def process_everything(self, only=None):
+        """Tries to apply all the steps to all documents. Returns the list
+        of StepReports."""
+        if only is None:
+            only = range(len(self.runner_factories))
+        # Workers must not share the connection of the coordinator
+        if hasattr(self.documents, 'close_connection'):
+            self.documents.close_connection()
+        pool = multiprocessing.Pool(
+            self.workers, initializer=_init_worker,
+            initargs=(self.runner_factories, self.documents))
+        try:
+            return [self._process_step(pool, idx) for idx in only]
+        finally:
+            pool.close()
+            pool.join()
+
+    def _process_step(self, pool, runner_idx):
+        runner_name = self.runner_factories[runner_idx]
+        logger.info('Starting preprocessing step %s with %s workers',
+                    runner_name, self.workers)
+        start = time.time()
+        doc_ids = list(self.documents.get_documents_ids())
+        batches = [(runner_idx, doc_ids[i:i + self.batch_size])
+                   for i in range(0, len(doc_ids), self.batch_size)]
+        processed = 0
+        failures = []
+        for b_processed, b_failures in pool.imap_unordered(
+                _process_documents_batch, batches):
+            processed += b_processed
+            failures.extend(b_failures)
+            logger.info('\tDone for %i documents', processed)
+        report = StepReport(runner_name, processed, failures, time.time() - start,
+                            len(doc_ids) - processed)
+        logger.info('Step %s done for %i documents in %.1f secs (%i failures, '
+                    '%i skipped)', runner_name, processed, report.elapsed,
+                    len(failures), report.skipped)
+        return report
 
 
 class BasePreProcessStepRunner(object):
     # If it's for a particular step, you can write
     # step = PreProcessSteps.something
 
+    # If set, PreProcessPipeline hands documents to process_batch in lists of
+    # this size, instead of calling the runner with each of them
+    batch_size = None
+
     def __init__(self, override=False, increment=False):
         self.override = override
         self.increment = increment
@@ -68,3 +251,9 @@ class BasePreProcessStepRunner(object):
         #    - skip
         #    - re-do step.
         raise NotImplementedError
+
+    def process_batch(self, docs):
+        """Processes a list of documents. Runners able to do better than
+        processing them one by one shall redefine this."""
+        for doc in docs:
+            self(doc)
@@ -18,7 +18,12 @@ class SyntacticSegmenterRunner(BasePreProcessStepRunner):
         if not was_done(PreProcessSteps.ner) or not was_done(PreProcessSteps.sentencer):
             # preconditions not met.
             return
-        if self.increment or self.override or not was_done(self.step):
+        if self.increment:
+            # only if NER or sentences changed since the last segmentation
+            needed = doc.is_preprocess_step_outdated(self.step)
+        else:
+            needed = not was_done(self.step)
+        if self.override or needed:
             segments = self.build_syntactic_segments(doc)
             doc.set_segmentation_result(
                 segments, override=self.override, increment=self.increment)
@@ -1,12 +1,21 @@
+from array import array
 from collections import defaultdict
 from itertools import chain, groupby
+from xml.etree import ElementTree
+import hashlib
+import io
 import logging
+import os
+import sys
 import tempfile
 
+from django.db import transaction
+
 from iepy.preprocess import corenlp
 from iepy.preprocess.pipeline import BasePreProcessStepRunner, PreProcessSteps
 from iepy.preprocess.ner.base import FoundEntity
 from iepy.data.models import EntityOccurrence, GazetteItem
+from iepy.utils import DIRS
 
 
 logger = logging.getLogger(__name__)
@@ -27,8 +36,10 @@ class GazetteManager:
     ]
 
     def __init__(self):
-        self.gazette_items = list(GazetteItem.objects.all())
-        self._cache_per_kind = defaultdict(list)
+        # (text, kind name) of each item, fetched on a single query
+        self.gazette_items = list(
+            GazetteItem.objects.order_by('id').values_list('text', 'kind__name'))
+        self._cache_per_kind = {}
 
     def escape_text(self, text):
         text = " ".join("\Q{}\E".format(x) for x in text.split())
@@ -40,12 +51,14 @@ class GazetteManager:
     def was_entry_created_by_gazette(self, alias, kind):
         if kind.startswith(self._PREFIX):
             return True
-        return alias in self._cache_per_kind[kind]
+        return alias in self._cache_per_kind.get(kind, ())
 
     def generate_stanford_gazettes_file(self):
         """
         Generates the gazettes file if there's any. Returns
         the filepath in case gazette items where found, else None.
+        Files are named after the hash of their content, so the same file
+        is used while gazettes don't change.
 
         Note: the Stanford Coreference annotator, only handles Entities of their
         native classes. That's why there's some special management of Gazette items
@@ -53,44 +66,127 @@ class GazetteManager:
         As a side effect, populates the internal cache with the gazette-items
         that will be passed to Stanford with any of their Native classes (Entity Kinds)
         """
+        self._cache_per_kind = defaultdict(set)
         if not self.gazette_items:
             return
 
         overridable_classes = ",".join(self.NATIVE_CLASSES)
-        self._cache_per_kind = defaultdict(list)
-
         gazette_format = "{}\t{}\t{}\n"
-        _, filepath = tempfile.mkstemp()
-        with open(filepath, "w") as gazette_file:
-            for gazette in self.gazette_items:
-                kname = gazette.kind.name
-                if kname in self.NATIVE_CLASSES:
-                    # kind will not be escaped, but tokens will be stored on cache
-                    self._cache_per_kind[kname].append(gazette.text)
-                else:
-                    kname = "{}{}".format(self._PREFIX, kname)
-                text = self.escape_text(gazette.text)
-                line = gazette_format.format(text, kname, overridable_classes)
-                gazette_file.write(line)
+        lines = []
+        for text, kname in self.gazette_items:
+            if kname in self.NATIVE_CLASSES:
+                # kind will not be escaped, but tokens will be stored on cache
+                self._cache_per_kind[kname].add(text)
+            else:
+                kname = "{}{}".format(self._PREFIX, kname)
+            lines.append(gazette_format.format(self.escape_text(text), kname,
+                                               overridable_classes))
+        data = "".join(lines).encode("utf8")
+
+        folder = os.path.join(DIRS.user_cache_dir, "gazettes")
+        filepath = os.path.join(
+            folder, "{}.txt".format(hashlib.sha256(data).hexdigest()))
+        if not os.path.exists(filepath):
+            os.makedirs(folder, exist_ok=True)
+            # Written on a temporary file and then moved, so other processes
+            # never read it half written
+            fd, tmp_filepath = tempfile.mkstemp(dir=folder)
+            with os.fdopen(fd, "wb") as gazette_file:
+                gazette_file.write(data)
+            os.replace(tmp_filepath, filepath)
         return filepath
 
 
 class StanfordPreprocess(BasePreProcessStepRunner):
+    STEPS = [
+        PreProcessSteps.tokenization,
+        PreProcessSteps.sentencer,
+        PreProcessSteps.tagging,
+        PreProcessSteps.ner,
+        # Steps added after 0.9.1
+        PreProcessSteps.lemmatization,
+        # Steps added after 0.9.2
+        PreProcessSteps.syntactic_parsing,
+    ]
 
-    def __init__(self, increment_ner=False):
+    # Annotators each way of running the preprocess needs from CoreNLP
+    # (besides the ones they depend on). The parser and dcoref are the
+    # slowest ones, so partial runs skip them whenever possible.
+    ALL_ANNOTATORS = corenlp.ANNOTATORS
+    LEMMATIZATION_ANNOTATORS = ("lemma",)
+    PARSING_ANNOTATORS = ("parse",)
+    NER_ANNOTATORS = ("ner", "dcoref")
+
+    def __init__(self, increment_ner=False, corenlp_processes=1, batch_size=None):
+        """With batch_size, documents are sent to CoreNLP in batches of that
+        size, that can be analized by several corenlp_processes at the same
+        time."""
         super().__init__()
         self.gazette_manager = GazetteManager()
-        gazettes_filepath = self.gazette_manager.generate_stanford_gazettes_file()
-        self.corenlp = corenlp.get_analizer(gazettes_filepath=gazettes_filepath)
+        self.gazettes_filepath = self.gazette_manager.generate_stanford_gazettes_file()
+        self.corenlp_processes = corenlp_processes
         self.override = False
         self.increment_ner = increment_ner
+        self.batch_size = batch_size
+        self._analizers = {}  # by annotators, started when first needed
+        self._analyses = {}  # (annotators, data) analized in advance, by document id
+
+    def analizer(self, annotators):
+        """Returns the CoreNLP analizer running the given annotators"""
+        annotators = tuple(annotators)
+        if annotators not in self._analizers:
+            self._analizers[annotators] = corenlp.get_analizer(
+                gazettes_filepath=self.gazettes_filepath,
+                processes=self.corenlp_processes,
+                annotators=annotators)
+        return self._analizers[annotators]
+
+    def analize(self, document, annotators=ALL_ANNOTATORS):
+        analyzed = self._analyses.get(document.pk)
+        if analyzed is not None and set(
+                corenlp.required_annotators(analyzed[0])).issuperset(annotators):
+            data = analyzed[1]
+        else:
+            data = self.analizer(annotators).analize(document.text)
+        return StanfordXMLAnalysis(data)
+
+    def process_batch(self, documents):
+        to_analize = defaultdict(list)
+        for document in documents:
+            annotators = self.annotators_for(document)
+            if annotators:
+                to_analize[annotators].append(document)
+        try:
+            for annotators, docs in to_analize.items():
+                analyses = self.analizer(annotators).analize_many([d.text for d in docs])
+                for document, data in zip(docs, analyses):
+                    self._analyses[document.pk] = (annotators, data)
+            for document in documents:
+                self(document)
+        finally:
+            self._analyses = {}
+
+    def annotators_for(self, document):
+        """Returns the CoreNLP annotators needed for preprocessing document,
+        or None if it needs no analysis at all."""
+        steps_done = set(s for s in self.STEPS if document.was_preprocess_step_done(s))
+        if self.override or not steps_done:
+            return self.ALL_ANNOTATORS
+        if steps_done == set(self.STEPS):
+            return self.NER_ANNOTATORS if self.increment_ner else None
+        annotators = ()
+        if PreProcessSteps.lemmatization not in steps_done:
+            annotators += self.LEMMATIZATION_ANNOTATORS
+        if PreProcessSteps.syntactic_parsing not in steps_done:
+            annotators += self.PARSING_ANNOTATORS
+        return annotators or None
 
     def lemmatization_only(self, document):
         """ Run only the lemmatization """
         # Lemmatization was added after the first so we need to support
         # that a document has all the steps done but lemmatization
 
-        analysis = StanfordAnalysis(self.corenlp.analize(document.text))
+        analysis = self.analize(document, self.LEMMATIZATION_ANNOTATORS)
         tokens = analysis.get_tokens()
         if document.tokens != tokens:
             raise ValueError(
@@ -105,7 +201,7 @@ class StanfordPreprocess(BasePreProcessStepRunner):
         # syntactic parsing was added after the first release, so we need to
         # provide the ability of doing just this on documents that
         # have all the steps done but syntactic parsing
-        analysis = StanfordAnalysis(self.corenlp.analize(document.text))
+        analysis = self.analize(document, self.PARSING_ANNOTATORS)
         parse_trees = analysis.get_parse_trees()
         document.set_syntactic_parsing_result(parse_trees)
         document.save()
@@ -114,7 +210,7 @@ class StanfordPreprocess(BasePreProcessStepRunner):
         """
         Runs NER steps (basic NER and also Gazetter), adding the new found NE.
         """
-        analysis = StanfordAnalysis(self.corenlp.analize(document.text))
+        analysis = self.analize(document, self.NER_ANNOTATORS)
 
         # NER
         found_entities = analysis.get_found_entities(
@@ -126,27 +222,13 @@ class StanfordPreprocess(BasePreProcessStepRunner):
         document.save()
 
         # Coreference resolution
-        for coref in analysis.get_coreferences():
-            try:
-                apply_coreferences(document, coref)
-            except CoreferenceError as e:
-                logger.warning(e)
+        apply_all_coreferences(document, analysis.get_coreferences())
 
     def __call__(self, document):
         """Checks state of the document, and based on the preprocess options,
         # decides what needs to be run, and triggers it.
         """
-        steps = [
-            PreProcessSteps.tokenization,
-            PreProcessSteps.sentencer,
-            PreProcessSteps.tagging,
-            PreProcessSteps.ner,
-            # Steps added after 0.9.1
-            PreProcessSteps.lemmatization,
-            # Steps added after 0.9.2
-            PreProcessSteps.syntactic_parsing,
-        ]
-
+        steps = self.STEPS
         steps_done = set([s for s in steps if document.was_preprocess_step_done(s)])
 
         if self.override or not steps_done:
@@ -179,7 +261,7 @@ class StanfordPreprocess(BasePreProcessStepRunner):
                 )
 
     def run_everything(self, document):
-        analysis = StanfordAnalysis(self.corenlp.analize(document.text))
+        analysis = self.analize(document)
 
         # Tokenization
         tokens = analysis.get_tokens()
@@ -208,11 +290,7 @@ class StanfordPreprocess(BasePreProcessStepRunner):
         document.save()
 
         # Coreference resolution
-        for coref in analysis.get_coreferences():
-            try:
-                apply_coreferences(document, coref)
-            except CoreferenceError as e:
-                logger.warning(e)
+        apply_all_coreferences(document, analysis.get_coreferences())
 
 
 def _dict_path(d, *steps):
@@ -344,17 +422,16 @@ class StanfordAnalysis:
         """
         sentence_offsets = self.get_sentence_boundaries()
         coreferences = []
-        for mention in self._get("coreference", "coreference"):
+        for mentions in self._get_raw_coreferences():
             occurrences = []
             representative = 0
-            for r, occurrence in enumerate(_dict_path(mention, "mention")):
-                if "@representative" in occurrence:
+            for r, (sentence, start, end, head, is_representative) in enumerate(mentions):
+                if is_representative:
                     representative = r
-                sentence = int(occurrence["sentence"]) - 1
-                offset = sentence_offsets[sentence]
-                i = int(occurrence["start"]) - 1 + offset
-                j = int(occurrence["end"]) - 1 + offset
-                k = int(occurrence["head"]) - 1 + offset
+                offset = sentence_offsets[sentence - 1]
+                i = start - 1 + offset
+                j = end - 1 + offset
+                k = head - 1 + offset
                 occurrences.append((i, j, k))
             # Occurrences' representative goes in the first position
             k = representative
@@ -362,6 +439,126 @@ class StanfordAnalysis:
             coreferences.append(occurrences)
         return coreferences
 
+    def _get_raw_coreferences(self):
+        """
+        Returns a list with a list of mentions for each coreference chain.
+        Each mention is a tuple (sentence, start, end, head, is_representative),
+        with the 1-based numbers found on the corenlp output.
+        """
+        result = []
+        for mention in self._get("coreference", "coreference"):
+            mentions = []
+            for occurrence in _dict_path(mention, "mention"):
+                mentions.append((
+                    int(occurrence["sentence"]), int(occurrence["start"]),
+                    int(occurrence["end"]), int(occurrence["head"]),
+                    "@representative" in occurrence
+                ))
+            result.append(mentions)
+        return result
+
+
+class StanfordXMLAnalysis(StanfordAnalysis):
+    """
+    Same as StanfordAnalysis, but built straight from the xml output of
+    corenlp. The xml is read in a single streaming pass, keeping only the
+    values needed (one flat list per token attribute) and discarding
+    everything else as soon as it's read.
+    """
+
+    def __init__(self, xml):
+        self._tokens = []
+        self._lemmas = []
+        self._pos = []
+        self._ner = []
+        self._offsets = array("i")
+        self._sentence_boundaries = [0]
+        self._parse_trees = []
+        self._raw_coreferences = []
+        self._read(xml)
+
+    def _read(self, xml):
+        if isinstance(xml, str):
+            xml = xml.encode("utf8")
+        path = []  # tags of the elements being read
+        for event, elem in ElementTree.iterparse(io.BytesIO(xml), events=("start", "end")):
+            if event == "start":
+                if elem.tag == "coreference" and path[-1:] == ["coreference"]:
+                    mentions = []
+                path.append(elem.tag)
+                continue
+
+            path.pop()
+            tag = elem.tag
+            parent = path[-1] if path else None
+            if tag == "token" and parent == "tokens":
+                self._tokens.append(elem.findtext("word"))
+                self._lemmas.append(elem.findtext("lemma"))
+                self._pos.append(sys.intern(elem.findtext("POS", "")))
+                self._ner.append(sys.intern(elem.findtext("NER", "O")))
+                self._offsets.append(int(elem.findtext("CharacterOffsetBegin")))
+                elem.clear()
+            elif tag == "sentence" and parent == "sentences":
+                self._sentence_boundaries.append(len(self._tokens))
+                self._parse_trees.append(elem.findtext("parse"))
+                elem.clear()
+            elif tag == "mention" and parent == "coreference":
+                mentions.append((
+                    int(elem.findtext("sentence")), int(elem.findtext("start")),
+                    int(elem.findtext("end")), int(elem.findtext("head")),
+                    "representative" in elem.attrib
+                ))
+            elif tag == "coreference" and parent == "coreference":
+                self._raw_coreferences.append(mentions)
+                elem.clear()
+
+    def get_sentences(self):
+        result = []
+        boundaries = self._sentence_boundaries
+        for start, end in zip(boundaries, boundaries[1:]):
+            result.append([
+                {"word": word, "lemma": lemma, "POS": pos, "NER": ner,
+                 "CharacterOffsetBegin": str(offset)}
+                for word, lemma, pos, ner, offset in zip(
+                    self._tokens[start:end], self._lemmas[start:end],
+                    self._pos[start:end], self._ner[start:end],
+                    self._offsets[start:end])
+            ])
+        return result
+
+    def get_sentence_boundaries(self):
+        return list(self._sentence_boundaries)
+
+    def get_parse_trees(self):
+        return list(self._parse_trees)
+
+    def get_tokens(self):
+        return list(self._tokens)
+
+    def get_lemmas(self):
+        return list(self._lemmas)
+
+    def get_token_offsets(self):
+        return self._offsets.tolist()
+
+    def get_pos(self):
+        return list(self._pos)
+
+    def get_entity_occurrences(self):
+        found_entities = []
+        boundaries = self._sentence_boundaries
+        for start, end in zip(boundaries, boundaries[1:]):
+            i = start
+            for kind, group in groupby(self._ner[start:end]):
+                j = i + len(list(group))
+                if kind != "O":
+                    found_entities.append((i, j, kind))
+                i = j
+        return found_entities
+
+    def _get_raw_coreferences(self):
+        return self._raw_coreferences
+
 
 def issues_merging_entities(document, entities):
     # Checks is some general preconditions are met before proceeding to merge some
@@ -394,52 +591,147 @@ def apply_coreferences(document, coreferences):
     This function can raise CofererenceError in case a merge is attempted on
     entities of different kinds.
     """
-    # For each token index make a list of the occurrences there
-    occurrences = defaultdict(list)
-    for occurrence in document.entity_occurrences.all():
+    merger = CoreferencesMerger(document)
+    merger.merge(coreferences)
+    merger.save()
+
+
+def apply_all_coreferences(document, coreferences_list):
+    """
+    Same as apply_coreferences, for all the coreferences found on a document
+    (a list of them, as returned by StanfordAnalysis.get_coreferences).
+    Coreferences that can't be merged are skipped, logging a warning.
+    """
+    merger = CoreferencesMerger(document)
+    for coreferences in coreferences_list:
+        try:
+            merger.merge(coreferences)
+        except CoreferenceError as e:
+            logger.warning(e)
+    merger.save()
+
+
+class CoreferencesMerger:
+    """
+    Applies coreferences to the entity occurrences of a document (see
+    apply_coreferences). Occurrences are loaded once and merges are done in
+    memory, each of them seeing the results of the previous ones. Then all
+    the changes are saved at once with save().
+    """
+
+    def __init__(self, document):
+        self.document = document
+        # For each token index, the list of the occurrences there
+        self.occurrences = defaultdict(list)
+        # Occurrences of each entity, by entity id
+        self.by_entity = defaultdict(list)
+        self.original_entity_ids = {}  # by occurrence id
+        self.to_create = []
+        self.to_delete = []
+        query = document.entity_occurrences.select_related(
+            'entity__kind', 'entity__gazette')
+        for occurrence in query:
+            self.original_entity_ids[occurrence.pk] = occurrence.entity_id
+            self._add(occurrence)
+
+    def _add(self, occurrence):
         for i in range(occurrence.offset, occurrence.offset_end):
-            occurrences[i].append(occurrence)
-
-    entities = []  # Existing entities referenced by correferences
-    pickable_as_representant = []
-    missing = []  # References that have no entity occurrence yet
-    for i, j, head in sorted(coreferences):
-        if occurrences[head]:
-            for x in occurrences[head]:
-                entities.append(x.entity)
-                if not x.anaphora:
-                    pickable_as_representant.append(x.entity)
+            self.occurrences[i].append(occurrence)
+        self.by_entity[occurrence.entity_id].append(occurrence)
+
+    def _remove(self, occurrence):
+        for i in range(occurrence.offset, occurrence.offset_end):
+            self.occurrences[i].remove(occurrence)
+        if occurrence.pk is None:
+            self.to_create.remove(occurrence)
+        else:
+            self.to_delete.append(occurrence.pk)
+
+    def _find(self, entity, i, j):
+        for occurrence in self.occurrences[i]:
+            if (occurrence.entity_id == entity.pk and occurrence.offset == i and
+                    occurrence.offset_end == j):
+                return occurrence
+
+    def merge(self, coreferences):
+        entities = []  # Existing entities referenced by correferences
+        pickable_as_representant = []
+        missing = []  # References that have no entity occurrence yet
+        for i, j, head in sorted(coreferences):
+            if self.occurrences[head]:
+                for x in self.occurrences[head]:
+                    entities.append(x.entity)
+                    if not x.anaphora:
+                        pickable_as_representant.append(x.entity)
+            else:
+                missing.append((i, j, head))
+
+        if not pickable_as_representant:
+            return
+        issues = issues_merging_entities(self.document, entities)
+        if issues:
+            raise CoreferenceError(issues)
+
+        from_ner = [r for r in pickable_as_representant if not r.gazette]
+        if from_ner:
+            canonical = from_ner[0]
         else:
-            missing.append((i, j, head))
-
-    if not pickable_as_representant:
-        return
-    issues = issues_merging_entities(document, entities)
-    if issues:
-        raise CoreferenceError(issues)
-
-    from_ner = [r for r in pickable_as_representant if not r.gazette]
-    if from_ner:
-        canonical = from_ner[0]
-    else:
-        canonical = pickable_as_representant[0]
-
-    # Each missing coreference needs to be created into an occurrence now
-    for i, j, head in missing:
-        if j - i >= 5:  # If the entity is a long phrase then just keep one token
-            i = head
-            j = head + 1
-        EntityOccurrence.objects.get_or_create(
-            document=document,
-            entity=canonical,
-            offset=i,
-            offset_end=j,
-            alias=" ".join(document.tokens[i:j]),
-            defaults={'anaphora': True})
-
-    # Finally, the merging 'per se', where all things are entity occurrences
-    for entity in set(x for x in entities if x != canonical):
-        for occurrence in EntityOccurrence.objects.filter(entity=entity,
-                                                          document=document):
-            occurrence.entity = canonical
-            occurrence.save()
+            canonical = pickable_as_representant[0]
+
+        # Each missing coreference needs to be created into an occurrence now
+        for i, j, head in missing:
+            if j - i >= 5:  # If the entity is a long phrase then just keep one token
+                i = head
+                j = head + 1
+            if self._find(canonical, i, j) is not None:
+                continue
+            occurrence = EntityOccurrence(
+                document=self.document,
+                entity=canonical,
+                offset=i,
+                offset_end=j,
+                alias=" ".join(self.document.tokens[i:j]),
+                anaphora=True)
+            self.to_create.append(occurrence)
+            self._add(occurrence)
+
+        # Finally, the merging 'per se', where all things are entity occurrences
+        for entity in set(x for x in entities if x != canonical):
+            for occurrence in self.by_entity.pop(entity.pk, []):
+                if self._find(canonical, occurrence.offset, occurrence.offset_end):
+                    # canonical already occurs there
+                    self._remove(occurrence)
+                    continue
+                occurrence.entity = canonical
+                self.by_entity[canonical.pk].append(occurrence)
+
+    def save(self):
+        """Stores all the changes, on a single transaction"""
+        # Merged occurrences, by original entity id and then final entity id
+        merged = defaultdict(lambda: defaultdict(list))
+        for entity_id, occurrences in self.by_entity.items():
+            for occurrence in occurrences:
+                if occurrence.pk is None:
+                    continue
+                original_id = self.original_entity_ids[occurrence.pk]
+                if original_id != entity_id:
+                    merged[original_id][entity_id].append(occurrence.pk)
+
+        with transaction.atomic():
+            if self.to_delete:
+                EntityOccurrence.objects.filter(pk__in=self.to_delete).delete()
+            for original_id, targets in merged.items():
+                query = EntityOccurrence.objects.filter(
+                    document=self.document, entity_id=original_id)
+                if len(targets) == 1:
+                    entity_id, = targets
+                    query.update(entity=entity_id)
+                else:
+                    # can't happen merging all the occurrences of an entity,
+                    # but being careful doesn't hurt
+                    for entity_id, pks in targets.items():
+                        query.filter(pk__in=pks).update(entity=entity_id)
+            if self.to_create:
+                EntityOccurrence.objects.bulk_create(self.to_create)
+        self.to_create = []
+        self.to_delete = []
@@ -0,0 +1,116 @@
+import logging
+import subprocess
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class StanfordTaggingServer:
+    """Long lived Stanford POS tagger or NER java process.
+
+    The model is loaded once, when the first sentences are tagged, and then
+    the process keeps reading sentences from its standard input (one per line,
+    tokens separated by spaces) and writing them tagged on its standard output
+    (tokens as `token<separator>tag`).
+
+    Works as a replacement of NLTK's taggers tag_sents, that start a new java
+    process (loading the model again) on each call.
+    """
+
+    def __init__(self, cmd, separator):
+        self.cmd = cmd
+        self.separator = separator
+        self.proc = None
+        self._lock = threading.Lock()
+
+    def _start_proc(self):
+        logger.info("Starting '{}'".format(" ".join(self.cmd)))
+        self.proc = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # Model loading messages and warnings are written on stderr. It's
+        # consumed all the time, otherwise the process could block on it.
+        threading.Thread(target=self._log_stderr, args=(self.proc,), daemon=True).start()
+
+    def _log_stderr(self, proc):
+        for line in proc.stderr:
+            logger.debug(line.decode("utf8", "replace").rstrip())
+
+    def _clean_token(self, token):
+        # tokens can't have spaces inside, nor be empty, or they would count
+        # as a different amount of tokens
+        return "_".join(token.split()) or "_"
+
+    def _send(self, proc, sentences):
+        try:
+            for sentence in sentences:
+                line = " ".join(self._clean_token(x) for x in sentence) + "\n"
+                proc.stdin.write(line.encode("utf8"))
+            proc.stdin.flush()
+        except OSError:
+            pass  # the process died, it's reported when reading
+
+    def _read_tokens(self):
+        # Yields the (token, tag) pairs written by the process. Output lines are
+        # not trusted to match input lines, since a sentence may be split
+        # in several lines, so tokens are matched one by one.
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                raise RuntimeError("Error running '{}'".format(" ".join(self.cmd)))
+            tagged = line.decode("utf8").split()
+            if not all(self.separator in x for x in tagged):
+                logger.debug("Ignoring output line '{}'".format(line))
+                continue
+            for x in tagged:
+                token, _, tag = x.rpartition(self.separator)
+                yield token, tag
+
+    def _kill(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.proc = None
+
+    def tag_sents(self, sentences):
+        """Returns, for each sentence (list of tokens), the list of pairs
+        (token, tag)."""
+        sentences = [list(s) for s in sentences]
+        with self._lock:
+            if self.proc is None:
+                self._start_proc()
+            # Sending from another thread, otherwise both processes could end
+            # up blocked writing on full pipes
+            writer = threading.Thread(target=self._send, args=(self.proc, sentences))
+            writer.start()
+            try:
+                tokens = self._read_tokens()
+                result = []
+                for sentence in sentences:
+                    tagged_sentence = []
+                    for token in sentence:
+                        output_token, tag = next(tokens)
+                        if output_token != self._clean_token(token):
+                            raise RuntimeError(
+                                "Token '{}' was tagged as '{}'".format(token, output_token))
+                        tagged_sentence.append((token, tag))
+                    result.append(tagged_sentence)
+            except Exception:
+                # The output left would be read by the next call, so the process
+                # is discarded. It's killed before waiting for the writer, that
+                # may be blocked on a full pipe.
+                self._kill()
+                writer.join()
+                raise
+            writer.join()
+        return result
+
+    def quit(self):
+        with self._lock:
+            if self.proc is not None:
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
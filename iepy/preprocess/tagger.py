@@ -1,11 +1,13 @@
 import os
 import os.path
 import logging
+from itertools import islice
 
-from nltk.tag.stanford import POSTagger
+from django.db import transaction
 import wget
 
 from iepy.preprocess.pipeline import BasePreProcessStepRunner, PreProcessSteps
+from iepy.preprocess.stanford_server import StanfordTaggingServer
 from iepy.utils import DIRS, unzip_file
 
 
@@ -20,43 +22,70 @@ class TaggerRunner(BasePreProcessStepRunner):
     """
     step = PreProcessSteps.tagging
 
-    def __init__(self, postagger, override=False):
-        """override:
+    def __init__(self, postagger, override=False, batch_size=50):
+        """postagger is called with a list of sentences, and shall return
+        the list of (token, tag) pairs of each of them.
+        Running in the pipeline, the sentences of batch_size documents are
+        tagged with a single call (all of them are kept in memory meanwhile).
         """
+        super(TaggerRunner, self).__init__(override=override)
         self.postagger = postagger
-        self.override = override
+        self.batch_size = batch_size
 
-    def __call__(self, doc):
+    def ok_for_running(self, doc):
         if not doc.was_preprocess_step_done(PreProcessSteps.sentencer):
             # cannot proceed if the document wasn't split in senteces
-            return
+            return False
         if not self.override and doc.was_preprocess_step_done(PreProcessSteps.tagging):
-            return
+            return False
+        return True
 
-        tagged_doc = []
-        for ts in self.postagger(doc.get_sentences()):
-            tagged_doc.extend(tag for token, tag in ts)
-
-        assert len(tagged_doc) == len(doc.tokens)
+    def __call__(self, doc):
+        self.process_batch([doc])
 
-        doc.set_tagging_result(tagged_doc)
-        doc.save()
-        logger.debug("POS tagged a document")
+    def process_batch(self, docs):
+        docs = [doc for doc in docs if self.ok_for_running(doc)]
+        if not docs:
+            return
+        sentences = [list(doc.get_sentences()) for doc in docs]
+        tagged_sentences = iter(self.postagger([s for ss in sentences for s in ss]))
+        results = []
+        for doc, doc_sentences in zip(docs, sentences):
+            tagged_doc = []
+            for ts in islice(tagged_sentences, len(doc_sentences)):
+                tagged_doc.extend(tag for token, tag in ts)
+            assert len(tagged_doc) == len(doc.tokens)
+            results.append(tagged_doc)
+
+        # Results are set only once all of them are ready
+        with transaction.atomic():
+            for doc, tagged_doc in zip(docs, results):
+                doc.set_tagging_result(tagged_doc)
+                doc.save()
+        logger.debug("POS tagged %i documents", len(docs))
 
 
 class StanfordTaggerRunner(TaggerRunner):
 
-    def __init__(self, override=False):
+    def __init__(self, override=False, batch_size=50):
         tagger_path = os.path.join(DIRS.user_data_dir, stanford_postagger_name)
         if not os.path.exists(tagger_path):
             raise LookupError("Stanford POS tagger not found. Try running the "
                               "command download_third_party_data.py")
 
-        postagger = POSTagger(
-            os.path.join(tagger_path, 'models', 'english-bidirectional-distsim.tagger'),
-            os.path.join(tagger_path, 'stanford-postagger.jar'),
-            encoding='utf8')
-        super(StanfordTaggerRunner, self).__init__(postagger.tag_sents, override)
+        # The java process is started on the first use, and kept running
+        self.server = StanfordTaggingServer([
+            'java', '-mx1000m',
+            '-cp', os.path.join(tagger_path, 'stanford-postagger.jar'),
+            'edu.stanford.nlp.tagger.maxent.MaxentTagger',
+            '-model', os.path.join(tagger_path, 'models', 'english-bidirectional-distsim.tagger'),
+            '-tokenize', 'false',
+            '-sentenceDelimiter', 'newline',
+            '-outputFormat', 'slashTags',
+            '-encoding', 'utf8',
+        ], separator='_')
+        super(StanfordTaggerRunner, self).__init__(self.server.tag_sents, override,
+                                                   batch_size)
 
 
 def download():
@@ -106,30 +106,25 @@ def csv_to_iepy(filepath):
 
     name = os.path.basename(filepath)
 
+    def iter_documents():
+        seen = set()
+        while True:
+            try:
+                d = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as error:
+                logger.warn("Couldn't load document: {}".format(error))
+                continue
+
+            doc_id = d["document_id"]
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            yield doc_id, d["document_text"], {"input_filename": name}
+
     docdb = DocumentManager()
-    seen = set()
-
-    i = 0
-    while True:
-
-        try:
-            d = next(reader)
-        except StopIteration:
-            break
-        except csv.Error as error:
-            logger.warn("Couldn't load document: {}".format(error))
-            continue
-
-        i += 1
-
-        doc_id = d["document_id"]
-        if doc_id in seen:
-            continue
-        seen.add(doc_id)
-        docdb.create_document(
-            identifier=doc_id,
-            text=d["document_text"],
-            metadata={"input_filename": name},
-            update_mode=True
-        )
-        print ('Added {} documents'.format(i))
+    report = docdb.bulk_create_documents(iter_documents(), update_mode=True)
+    total = report.created + report.updated
+    print('Added {} documents ({} new, {} updated) in {:.1f} seconds'.format(
+        total, report.created, report.updated, report.elapsed))
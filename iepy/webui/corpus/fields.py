@@ -1,6 +1,12 @@
 import ast
+import struct
+import sys
+from array import array
+from collections.abc import MutableSequence
+from itertools import accumulate
 
 from nltk.tree import Tree
+from django import forms
 from django.db import models
 
 
@@ -30,6 +36,210 @@ class ListField(models.TextField, metaclass=models.SubfieldBase):
         return self.get_db_prep_value(value)
 
 
+# Packed storage format.
+# Every non empty packed value starts with a one byte format version, so the
+# layout can evolve without ambiguity, followed by one byte with the array
+# typecode used for the numbers that come after it (the narrowest one that fits).
+# The empty list is stored as b''.
+#  - list of strings: header, uint32 count, count x lengths (measured in
+#    characters) and finally all the strings concatenated, utf-8 encoded.
+#  - list of ints: header, followed by the items.
+# All numbers are little endian.
+PACKED_FORMAT_VERSION = 1
+_COUNT = struct.Struct('<I')
+_HEADER_SIZE = 2
+_ITEM_SIZES = {'B': 1, 'H': 2, 'I': 4, 'i': 4}
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _narrowest_typecode(values):
+    lowest, highest = min(values), max(values)
+    if lowest >= 0:
+        if highest < 2 ** 8:
+            return 'B'
+        if highest < 2 ** 16:
+            return 'H'
+        return 'I'
+    return 'i'
+
+
+def _header(typecode):
+    return bytes([PACKED_FORMAT_VERSION, ord(typecode)])
+
+
+def _read_header(data):
+    if data[0] != PACKED_FORMAT_VERSION:
+        raise ValueError('Unknown packed list format version %r' % data[0])
+    typecode = chr(data[1])
+    if typecode not in _ITEM_SIZES:
+        raise ValueError('Unknown packed list typecode %r' % typecode)
+    return typecode
+
+
+def _pack_array(typecode, values):
+    xs = array(typecode, values)
+    assert xs.itemsize == _ITEM_SIZES[typecode]
+    if _BIG_ENDIAN and xs.itemsize > 1:
+        xs.byteswap()
+    return xs.tobytes()
+
+
+def _unpack_array(typecode, data):
+    xs = array(typecode)
+    xs.frombytes(data)
+    if _BIG_ENDIAN and xs.itemsize > 1:
+        xs.byteswap()
+    return xs
+
+
+def pack_strings(values):
+    """Packs a list of strings into bytes. See unpack_strings."""
+    if not values:
+        return b''
+    lengths = [len(x) for x in values]
+    typecode = _narrowest_typecode(lengths)
+    return b''.join([
+        _header(typecode),
+        _COUNT.pack(len(values)),
+        _pack_array(typecode, lengths),
+        ''.join(values).encode('utf8'),
+    ])
+
+
+def unpack_strings(data):
+    """Returns the list of strings stored on data by pack_strings."""
+    if not data:
+        return []
+    typecode = _read_header(data)
+    count, = _COUNT.unpack_from(data, _HEADER_SIZE)
+    lengths_start = _HEADER_SIZE + _COUNT.size
+    payload_start = lengths_start + count * _ITEM_SIZES[typecode]
+    lengths = _unpack_array(typecode, data[lengths_start:payload_start])
+    text = data[payload_start:].decode('utf8')
+    ends = list(accumulate(lengths))
+    return [text[i:j] for i, j in zip([0] + ends, ends)]
+
+
+def pack_ints(values):
+    """Packs a list of ints into bytes. See unpack_ints."""
+    if not values:
+        return b''
+    typecode = _narrowest_typecode(values)
+    return _header(typecode) + _pack_array(typecode, values)
+
+
+def unpack_ints(data):
+    """Returns the list of ints stored on data by pack_ints."""
+    if not data:
+        return []
+    typecode = _read_header(data)
+    return _unpack_array(typecode, data[_HEADER_SIZE:]).tolist()
+
+
+class _PackedListField(models.Field, metaclass=models.SubfieldBase):
+    """Base for list fields stored on a binary column using the packed format.
+
+    Strings (like the ones received from forms, fixtures or the older ListField
+    storage) are interpreted as python list literals.
+    """
+    pack = unpack = None  # defined on subclasses
+
+    def get_internal_type(self):
+        return "BinaryField"
+
+    def to_python(self, value):
+        if not value:
+            return []
+        if isinstance(value, list):
+            return value
+        if isinstance(value, tuple):
+            return list(value)
+        if isinstance(value, str):
+            return ast.literal_eval(value)
+        return self.unpack(bytes(value))
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        if isinstance(value, (bytes, memoryview)):
+            return bytes(value)
+        return self.pack(self.to_python(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super().get_db_prep_value(value, connection, prepared)
+        if value is not None:
+            return connection.Database.Binary(value)
+        return value
+
+    def value_to_string(self, obj):
+        return str(self._get_val_from_obj(obj))
+
+    def formfield(self, **kwargs):
+        defaults = {'form_class': forms.CharField, 'widget': forms.Textarea}
+        defaults.update(kwargs)
+        return super().formfield(**defaults)
+
+
+class PackedStringListField(_PackedListField):
+    description = "Python list of strings, packed"
+    pack = staticmethod(pack_strings)
+    unpack = staticmethod(unpack_strings)
+
+
+class PackedIntListField(_PackedListField):
+    description = "Python list of ints, packed"
+    pack = staticmethod(pack_ints)
+    unpack = staticmethod(unpack_ints)
+
+
+class _UnparsedTree(str):
+    """Bracketed string of a syntactic tree that wasn't parsed yet"""
+
+
+class LazyTreeList(MutableSequence):
+    """List of syntactic trees that keeps the bracketed strings as loaded from
+    the database, and parses each tree only the first time it's accessed.
+    """
+
+    def __init__(self, bracketed_strings=()):
+        self._items = [_UnparsedTree(x) for x in bracketed_strings]
+
+    def _parsed(self, i):
+        item = self._items[i]
+        if type(item) is _UnparsedTree:
+            item = self._items[i] = Tree.fromstring(item)
+        return item
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._parsed(j) for j in range(*i.indices(len(self)))]
+        return self._parsed(i)
+
+    def __setitem__(self, i, value):
+        self._items[i] = value
+
+    def __delitem__(self, i):
+        del self._items[i]
+
+    def __len__(self):
+        return len(self._items)
+
+    def insert(self, i, value):
+        self._items.insert(i, value)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyTreeList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def as_strings(self):
+        """Returns the bracketed strings of the trees, parsing none of them."""
+        return [str(x) for x in self._items]
+
+
 class ListSyntacticTreeField(models.TextField, metaclass=models.SubfieldBase):
     description = "List of Stanford syntactic tree"
 
@@ -40,16 +250,19 @@ class ListSyntacticTreeField(models.TextField, metaclass=models.SubfieldBase):
         if not value:
             value = []
 
-        if isinstance(value, list):
+        if isinstance(value, (list, LazyTreeList)):
             return value
 
-        xs = ast.literal_eval(value)
-        return [Tree.fromstring(x) for x in xs]
+        # Trees are parsed on demand, most of the times only a few are needed
+        return LazyTreeList(ast.literal_eval(value))
 
     def get_prep_value(self, value):
         if value is None:
             return value
 
+        if isinstance(value, LazyTreeList):
+            return str(value.as_strings())
+
         if isinstance(value, list):
             return str([str(x) for x in value])
 
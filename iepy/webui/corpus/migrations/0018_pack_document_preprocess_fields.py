@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import ast
+import logging
+
+from django.db import migrations
+import corpus.fields
+
+
+logging.basicConfig(format="%(asctime)-15s  %(message)s")
+logger = logging.getLogger(__file__)
+logger.setLevel(logging.INFO)
+
+BULK_SIZE = 2500
+STRING_FIELDS = ['tokens', 'lemmas', 'postags']
+INT_FIELDS = ['offsets_to_text', 'sentences']
+PACKED_PREFIX = 'packed_'
+
+
+def _as_list(value):
+    # Raw values of the old ListField are python literals
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    return ast.literal_eval(value)
+
+
+def _as_packed_list(value, unpack):
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    return unpack(bytes(value))
+
+
+def _copy_documents_fields(apps, source_fields, target_fields, convert):
+    IEDocument = apps.get_model('corpus', 'IEDocument')
+    documents = IEDocument.objects.values_list('id', *source_fields)
+    total = documents.count()
+    for i, row in enumerate(documents.iterator()):
+        if i % BULK_SIZE == 0:
+            logger.info("Converted {} out of {}".format(i, total))
+        values = [convert(fname, value) for fname, value in zip(source_fields, row[1:])]
+        IEDocument.objects.filter(pk=row[0]).update(**dict(zip(target_fields, values)))
+    logger.info("Converted {} out of {}".format(total, total))
+
+
+def pack_fields(apps, schema_editor):
+    fields = STRING_FIELDS + INT_FIELDS
+    _copy_documents_fields(
+        apps, fields, [PACKED_PREFIX + f for f in fields],
+        lambda fname, value: _as_list(value)
+    )
+
+
+def unpack_fields(apps, schema_editor):
+    fields = STRING_FIELDS + INT_FIELDS
+
+    def convert(fname, value):
+        if fname[len(PACKED_PREFIX):] in STRING_FIELDS:
+            unpack = corpus.fields.unpack_strings
+        else:
+            unpack = corpus.fields.unpack_ints
+        return str(_as_packed_list(value, unpack))
+
+    _copy_documents_fields(
+        apps, [PACKED_PREFIX + f for f in fields], fields, convert
+    )
+
+
+def _add_packed_field(fname, field_class):
+    return migrations.AddField(
+        model_name='iedocument',
+        name=PACKED_PREFIX + fname,
+        field=field_class(blank=True, default=[]),
+        preserve_default=False,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0017_auto_20150302_1916'),
+    ]
+
+    operations = (
+        [_add_packed_field(f, corpus.fields.PackedStringListField) for f in STRING_FIELDS] +
+        [_add_packed_field(f, corpus.fields.PackedIntListField) for f in INT_FIELDS] +
+        [migrations.RunPython(pack_fields, unpack_fields)] +
+        [migrations.RemoveField(model_name='iedocument', name=f)
+         for f in STRING_FIELDS + INT_FIELDS] +
+        [migrations.RenameField(model_name='iedocument',
+                                old_name=PACKED_PREFIX + f, new_name=f)
+         for f in STRING_FIELDS + INT_FIELDS]
+    )
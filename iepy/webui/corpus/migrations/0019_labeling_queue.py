@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpus', '0018_pack_document_preprocess_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelingQueue',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('last_segment_id', models.IntegerField(default=0)),
+                ('relation', models.OneToOneField(related_name='labeling_queue', to='corpus.Relation')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='LabelingQueueItem',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, primary_key=True, auto_created=True)),
+                ('judge', models.CharField(max_length=256, blank=True)),
+                ('priority', models.PositiveSmallIntegerField()),
+                ('queue', models.ForeignKey(related_name='items', to='corpus.LabelingQueue')),
+                ('segment', models.ForeignKey(related_name='+', to='corpus.TextSegment')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='labelingqueueitem',
+            unique_together=set([('queue', 'segment', 'judge')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='labelingqueueitem',
+            index_together=set([('queue', 'judge', 'priority', 'segment')]),
+        ),
+    ]
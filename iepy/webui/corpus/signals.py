@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models.signals import post_delete, pre_delete
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from iepy.data import models
 
@@ -19,10 +19,14 @@ def pre_eo_delete(sender, instance, **kwargs):
 def on_eo_delete(sender, instance, **kwargs):
     segments_to_check = sender._segments_to_check.get(instance.id)
     if segments_to_check:
+        kept = []
         for segment in segments_to_check:
             eos = list(segment.get_entity_occurrences())
             if len(eos) < 2:
                 segment.delete()
+            else:
+                kept.append(segment.id)
+        models.LabelingQueue.refresh_segments(kept)
 
 
 @receiver(pre_delete, sender=models.GazetteItem)
@@ -55,3 +59,37 @@ def on_iedocument_delete(sender, instance, **kwargs):
     if hasattr(sender, "to_delete"):
         for item in sender.to_delete:
             item.delete()
+
+
+@receiver(post_save, sender=models.EvidenceLabel)
+@receiver(post_delete, sender=models.EvidenceLabel)
+def on_evidence_label_change(sender, instance, **kwargs):
+    if instance.relation_id is None:
+        return
+    try:
+        segment_id = instance.evidence_candidate.segment_id
+    except ObjectDoesNotExist:
+        return
+    models.LabelingQueue.refresh_segments([segment_id], instance.relation_id)
+
+
+@receiver(m2m_changed, sender=models.EntityOccurrence.segments.through)
+def on_segment_occurrences_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # instance is a segment
+        segment_ids = [instance.pk]
+    elif action == 'pre_clear':
+        instance._segments_to_check = list(instance.segments.values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        segment_ids = getattr(instance, '_segments_to_check', [])
+    else:
+        segment_ids = pk_set
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        models.LabelingQueue.refresh_segments(segment_ids)
+
+
+@receiver(post_delete, sender=models.TextSegment)
+def on_segment_delete(sender, instance, **kwargs):
+    # Labels deleted together with the segment may have put it back on the queues
+    models.LabelingQueueItem.objects.filter(segment_id=instance.pk).delete()
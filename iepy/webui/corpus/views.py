@@ -251,8 +251,10 @@ class LabelEvidenceOnDocumentView(_BaseLabelEvidenceView):
         subtitle = 'For Document "{0}"'.format(self.document.human_identifier)
 
         segments_with_rich_tokens = []
-        for segment in self.get_text_segments(only_with_evidences=True):
-            segment.hydrate()
+        segments = list(self.get_text_segments(only_with_evidences=True))
+        TextSegment.prefetch_entity_occurrences(segments)
+        for segment in segments:
+            segment.hydrate(self.document)
             segments_with_rich_tokens.append(
                 {'id': segment.id,
                  'rich_tokens': list(segment.get_enriched_tokens())}
@@ -357,7 +359,9 @@ class LabelEvidenceOnDocumentView(_BaseLabelEvidenceView):
         self.document = get_object_or_404(IEDocument, pk=self.kwargs['document_id'])
         self.relation = get_object_or_404(Relation, pk=self.kwargs['relation_id'])
         evidences = []
-        for segment in self.document.get_text_segments():
+        segments = list(self.document.get_text_segments())
+        TextSegment.prefetch_entity_occurrences(segments)
+        for segment in segments:
             evidences.extend(
                 list(segment.get_evidences_for_relation(self.relation))
             )
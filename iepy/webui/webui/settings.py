@@ -114,3 +114,10 @@ LOGGING = {
 
 
 IEPY_LANG = 'en'
+
+# Stanford CoreNLP outputs are cached on disk, so documents analized before
+# (for instance, when re-running the preprocess) are not analized again.
+# Maximum size in bytes of the cache, 0 disables it.
+IEPY_CORENLP_CACHE_SIZE = 1024 ** 3
+# Folder for the cache. If None, a folder on the user cache dir is used.
+IEPY_CORENLP_CACHE_DIR = None
@@ -0,0 +1,136 @@
+"""
+Benchmark of LiteralNER on a big gazette, comparing the token trie against
+the previous matcher (prefix closure of space-joined strings), and against
+the token trie compiled to a file.
+
+Builds a gazette of <names> random names (of 1 to 4 words, taken from a
+vocabulary of <words> words) and tags <sentences> random sentences of
+<length> tokens where some of the names were planted.
+
+Usage:
+    benchmark_literal_ner.py [options]
+    benchmark_literal_ner.py -h | --help
+
+Options:
+  --names=<n>           Number of names on the gazette [default: 1000000]
+  --words=<n>           Size of the vocabulary [default: 200000]
+  --sentences=<n>       Number of sentences to tag [default: 20000]
+  --length=<n>          Number of tokens per sentence [default: 40]
+  --seed=<n>            Random seed [default: 1]
+  -h --help             Show this screen
+"""
+import os
+import random
+import tempfile
+import time
+
+from docopt import docopt
+
+from iepy.preprocess.ner.literal import LiteralNER
+
+
+class PrefixesLiteralNER(LiteralNER):
+    # What LiteralNER used to do
+    def __init__(self, labels, src_filenames):
+        names_map = {}
+        for label, filename in zip(labels, src_filenames):
+            with open(filename, encoding="utf8") as f:
+                for name in f.read().strip().split('\n'):
+                    names_map[name] = label
+        self.names = frozenset(names_map)
+        self.names_map = names_map
+        prefixes = set()
+        for name in self.names:
+            sname = name.split()
+            prefixes.update([' '.join(sname[:i]) for i in range(1, len(sname) + 1)])
+        self.prefixes = frozenset(prefixes)
+
+    def entities(self, sent):
+        result = []
+        i = 0
+        while i < len(sent):
+            j = i + 1
+            prev_segment = segment = ' '.join(sent[i:j])
+            while segment in self.prefixes and j <= len(sent):
+                j += 1
+                prev_segment = segment
+                segment = ' '.join(sent[i:j])
+            if prev_segment in self.names:
+                result.append(((i, j - 1), self.names_map[prev_segment]))
+                i = j - 1
+            else:
+                i += 1
+        return result
+
+
+def build_gazette(names, words):
+    vocabulary = ["w{}".format(i) for i in range(words)]
+    result = set()
+    while len(result) < names:
+        size = random.randint(1, 4)
+        result.add(" ".join(random.choice(vocabulary) for _ in range(size)))
+    return vocabulary, sorted(result)
+
+
+def build_sentences(vocabulary, names, amount, length):
+    sentences = []
+    for _ in range(amount):
+        sentence = []
+        while len(sentence) < length:
+            if random.random() < 0.1:
+                sentence.extend(random.choice(names).split())
+            else:
+                sentence.append(random.choice(vocabulary))
+        sentences.append(sentence[:length])
+    return sentences
+
+
+def run(build, sentences):
+    start = time.time()
+    ner = build()
+    built = time.time()
+    results = [ner.entities(s) for s in sentences]
+    return built - start, time.time() - built, results
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    random.seed(int(opts['--seed']))
+    vocabulary, names = build_gazette(int(opts['--names']), int(opts['--words']))
+    sentences = build_sentences(vocabulary, names, int(opts['--sentences']),
+                                int(opts['--length']))
+    fd, filename = tempfile.mkstemp()
+    with os.fdopen(fd, "w", encoding="utf8") as f:
+        f.write("\n".join(names) + "\n")
+    fd, compiled_filename = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        print("Gazette of {} names, tagging {} sentences of {} tokens".format(
+            len(names), len(sentences), opts['--length']))
+        old_build, old_tag, old_results = run(
+            lambda: PrefixesLiteralNER(["X"], [filename]), sentences)
+        print("  prefix closure: built in {:.2f} secs, tagged in {:.2f} secs".format(
+            old_build, old_tag))
+        new_build, new_tag, new_results = run(
+            lambda: LiteralNER(["X"], [filename]), sentences)
+        print("  token trie:     built in {:.2f} secs, tagged in {:.2f} secs".format(
+            new_build, new_tag))
+        start = time.time()
+        LiteralNER(["X"], [filename]).save(compiled_filename)
+        compiling = time.time() - start
+        load, compiled_tag, compiled_results = run(
+            lambda: LiteralNER(compiled_filepath=compiled_filename), sentences)
+        print("  compiled trie:  compiled in {:.2f} secs ({:.1f} MB), loaded in {:.4f} secs, "
+              "tagged in {:.2f} secs".format(
+                  compiling, os.path.getsize(compiled_filename) / 2 ** 20, load, compiled_tag))
+        assert compiled_results == new_results
+        print("  tagging speedup: {:.1f}x".format(old_tag / new_tag if new_tag else float('inf')))
+        # The trie also finds names that are a prefix of some longer name
+        # not fully present, the prefix closure missed those
+        missed = sum(1 for old, new in zip(old_results, new_results)
+                     if not set(old).issubset(new))
+        print("  sentences where the trie missed matches found before: {}".format(missed))
+    finally:
+        os.remove(filename)
+        os.remove(compiled_filename)
@@ -0,0 +1,116 @@
+"""
+Benchmark of preprocessing documents with several processes, comparing it
+with the serial pipeline.
+
+Creates a synthetic corpus of <documents> documents on the given IEPY
+instance, and preprocesses it (tokenization, literal NER and segmentation)
+first serially and later with <workers> processes, checking that both
+produce the same results.
+Every document of the instance is preprocessed, so better use an empty one
+(and a database engine other than sqlite).
+
+Usage:
+    benchmark_parallel_preprocess.py [options] <instance_path>
+    benchmark_parallel_preprocess.py -h | --help
+
+Options:
+  --documents=<n>       Number of documents of the synthetic corpus [default: 500]
+  --workers=<n>         Number of worker processes [default: 4]
+  --batch-size=<n>      Documents handed out to workers at once [default: 20]
+  -h --help             Show this screen
+"""
+import os
+import random
+import tempfile
+import time
+from functools import partial
+
+from docopt import docopt
+
+import iepy
+
+WORDS = ("the a of was in and to at with from for by lived worked born "
+         "visited city company river house year people").split()
+NAMES = {
+    'person': ["John Smith", "Mary Jones", "Peter Parker", "Ana Lopez", "Ken Adams"],
+    'location': ["London", "Buenos Aires", "New York", "Paris", "Rome"],
+}
+
+
+def synthetic_text(rnd, sentences=20):
+    result = []
+    for _ in range(sentences):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(8, 20))]
+        for kind in NAMES:
+            words.insert(rnd.randint(0, len(words)), rnd.choice(NAMES[kind]))
+        result.append(' '.join(words).capitalize() + '.')
+    return ' '.join(result)
+
+
+def runner_factories(labels, filenames):
+    # Everything in override mode, so both runs process all the documents
+    from iepy.preprocess.tokenizer import TokenizeSentencerRunner
+    from iepy.preprocess.ner.literal import LiteralNERRunner
+    from iepy.preprocess.segmenter import SyntacticSegmenterRunner
+    return [
+        partial(TokenizeSentencerRunner, override=True),
+        partial(LiteralNERRunner, labels, filenames, override=True),
+        partial(SyntacticSegmenterRunner, override=True),
+    ]
+
+
+def snapshot():
+    from iepy.data.models import IEDocument
+    result = {}
+    for doc in IEDocument.objects.all():
+        result[doc.id] = (
+            doc.tokens, doc.sentences,
+            sorted(doc.entity_occurrences.values_list('offset', 'offset_end', 'entity__key')),
+            sorted(doc.segments.values_list('offset', 'offset_end')),
+        )
+    return result
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    iepy.setup(opts['<instance_path>'])
+    from iepy.data.db import DocumentManager
+    from iepy.preprocess.pipeline import PreProcessPipeline, ParallelPreProcessPipeline
+
+    amount = int(opts['--documents'])
+    workers = int(opts['--workers'])
+    docs = DocumentManager()
+    rnd = random.Random(1)
+    docs.bulk_create_documents(
+        ('benchmark-%i' % i, synthetic_text(rnd), {}) for i in range(amount))
+
+    gazettes_dir = tempfile.mkdtemp()
+    labels, filenames = [], []
+    for kind, names in NAMES.items():
+        filename = os.path.join(gazettes_dir, kind + '.txt')
+        with open(filename, 'w') as fout:
+            fout.write('\n'.join(names))
+        labels.append(kind)
+        filenames.append(filename)
+    factories = runner_factories(labels, filenames)
+
+    start = time.time()
+    PreProcessPipeline([f() for f in factories], docs).process_everything()
+    serial = time.time() - start
+    serial_results = snapshot()
+
+    start = time.time()
+    pipeline = ParallelPreProcessPipeline(
+        factories, docs, workers=workers, batch_size=int(opts['--batch-size']))
+    reports = pipeline.process_everything()
+    parallel = time.time() - start
+
+    print("Preprocessing {} documents".format(len(serial_results)))
+    print("  serial:             {:.2f} secs ({:.1f} docs/sec)".format(
+        serial, len(serial_results) / serial))
+    print("  {} workers:          {:.2f} secs ({:.1f} docs/sec)".format(
+        workers, parallel, len(serial_results) / parallel))
+    for report in reports:
+        print("    {}: {:.2f} secs, {} failures".format(
+            report.runner.func.__name__, report.elapsed, len(report.failures)))
+    print("  same results: {}".format(snapshot() == serial_results))
@@ -0,0 +1,62 @@
+"""
+Benchmark of loading syntactic parse trees of documents, comparing parsing
+all of them on load against parsing them on demand.
+
+Simulates loading <documents> documents of <sentences> parsed sentences each
+(trees taken from the NLTK treebank sample), and accessing a few of them.
+
+Usage:
+    benchmark_tree_loading.py [options]
+    benchmark_tree_loading.py -h | --help
+
+Options:
+  --documents=<n>       Number of documents to load [default: 200]
+  --sentences=<n>       Number of parsed sentences per document [default: 40]
+  --accessed=<n>        Number of trees accessed per document [default: 2]
+  -h --help             Show this screen
+"""
+import time
+
+import nltk
+from docopt import docopt
+
+import iepy
+iepy.setup(_safe_mode=True)
+from corpus.fields import ListSyntacticTreeField
+
+
+def eager_load(raw_value):
+    # What loading a document used to cost: every tree parsed
+    field = ListSyntacticTreeField()
+    return list(field.to_python(raw_value))
+
+
+def lazy_load(raw_value):
+    return ListSyntacticTreeField().to_python(raw_value)
+
+
+def run(loader, raw_value, documents, accessed):
+    start = time.time()
+    for _ in range(documents):
+        trees = loader(raw_value)
+        for i in range(accessed):
+            trees[i].height()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    opts = docopt(__doc__)
+    documents = int(opts['--documents'])
+    sentences = int(opts['--sentences'])
+    accessed = min(int(opts['--accessed']), sentences)
+
+    trees = nltk.corpus.treebank.parsed_sents()[:sentences]
+    raw_value = ListSyntacticTreeField().get_prep_value(list(trees))
+
+    eager = run(eager_load, raw_value, documents, accessed)
+    lazy = run(lazy_load, raw_value, documents, accessed)
+    print("Loading {} documents of {} trees, accessing {} of them".format(
+        documents, sentences, accessed))
+    print("  parsing all trees on load: {:.3f} secs".format(eager))
+    print("  parsing trees on demand:   {:.3f} secs".format(lazy))
+    print("  speedup: {:.1f}x".format(eager / lazy if lazy else float('inf')))
@@ -0,0 +1,26 @@
+"""
+IEPY's gazettes compiler (to be used with the Literal NER).
+
+Compiles names lists (like the ones written by download_freebase_type.py) to a
+binary file that LiteralNER can load immediately, with
+LiteralNER(compiled_filepath=<output_file>). The file is memory mapped, so
+processes using it at the same time share the memory.
+
+Each label tags the names of the file given after it. If a name has several
+labels, the last one is used.
+
+Usage:
+    compile_gazettes.py <output_file> (<label> <names_file>)...
+    compile_gazettes.py -h | --help | --version
+
+Options:
+  -h --help             Show this screen
+  --version             Version number
+"""
+from docopt import docopt
+
+from iepy.preprocess.ner.literal import LiteralNER
+
+if __name__ == '__main__':
+    opts = docopt(__doc__, version=0.1)
+    LiteralNER(opts['<label>'], opts['<names_file>']).save(opts['<output_file>'])
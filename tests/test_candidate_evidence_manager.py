@@ -0,0 +1,220 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from iepy.data.db import CandidateEvidenceManager
+from iepy.data.models import EvidenceCandidate, EvidenceLabel, TextSegment
+from .factories import (
+    EntityKindFactory, EntityFactory, EntityOccurrenceFactory, EvidenceCandidateFactory,
+    IEDocFactory, RelationFactory, TextSegmentFactory,
+)
+from .manager_case import ManagerTestCase
+
+
+class BaseCandidatesTest(ManagerTestCase):
+
+    def setUp(self):
+        self.k_person = EntityKindFactory(name='person')
+        self.k_location = EntityKindFactory(name='location')
+        self.relation = RelationFactory(left_entity_kind=self.k_person,
+                                        right_entity_kind=self.k_location)
+
+    def document_with_segment(self, entities_amount=2):
+        # Creates a document with one segment having "entities_amount"
+        # persons and the same amount of locations
+        doc = IEDocFactory(text=' '.join(['tkn'] * 10))
+        doc.set_tokenization_result(list(enumerate(doc.text.split())))
+        doc.save()
+        segment = TextSegmentFactory(document=doc, offset=0, offset_end=10)
+        for i in range(entities_amount):
+            for j, kind in enumerate([self.k_person, self.k_location]):
+                offset = 2 * i + j
+                eo = EntityOccurrenceFactory(
+                    document=doc, offset=offset, offset_end=offset + 1,
+                    entity=EntityFactory(kind=kind))
+                eo.segments.add(segment)
+        return doc, segment
+
+
+class TestCandidatesForRelation(BaseCandidatesTest):
+
+    def candidates(self, **kwargs):
+        return list(CandidateEvidenceManager.candidates_for_relation(
+            self.relation, **kwargs))
+
+    def document_queries(self, queries):
+        return [q for q in queries if 'FROM "corpus_iedocument"' in q['sql']]
+
+    def test_all_candidates_are_returned_hydrated_with_their_document(self):
+        docs = [self.document_with_segment()[0] for i in range(5)]
+        candidates = self.candidates(doc_chunk_size=2)
+        self.assertEqual(len(candidates), 5 * 4)
+        self.assertEqual(set(c.segment.document_id for c in candidates),
+                         set(d.id for d in docs))
+        for c in candidates:
+            self.assertEqual(c.segment.tokens, ['tkn'] * 10)
+
+    def test_documents_are_loaded_by_chunks(self):
+        for i in range(7):
+            self.document_with_segment()
+        for chunk_size, expected_queries in [(1, 7), (3, 3), (10, 1)]:
+            with CaptureQueriesContext(connection) as ctx:
+                self.candidates(doc_chunk_size=chunk_size)
+            self.assertEqual(len(self.document_queries(ctx.captured_queries)),
+                             expected_queries)
+
+    def test_entity_occurrences_are_not_queried_per_segment(self):
+        for i in range(3):
+            self.document_with_segment()
+        self.candidates()  # candidates creation is not counted
+        with CaptureQueriesContext(connection) as ctx:
+            few = self.candidates()
+        for i in range(5):
+            self.document_with_segment()
+        self.candidates()
+        with CaptureQueriesContext(connection) as ctx_2:
+            many = self.candidates()
+        self.assertEqual(len(few), 3 * 4)
+        self.assertEqual(len(many), 8 * 4)
+        self.assertEqual(len(ctx.captured_queries), len(ctx_2.captured_queries))
+
+
+class TestBulkCreateCandidates(BaseCandidatesTest):
+
+    def bulk_create(self, **kwargs):
+        return CandidateEvidenceManager.bulk_create_candidates_for_relation(
+            self.relation, **kwargs)
+
+    def triples(self):
+        return set(EvidenceCandidate.objects.values_list(
+            'left_entity_occurrence_id', 'right_entity_occurrence_id', 'segment_id'))
+
+    def test_creates_all_missing_candidates(self):
+        segments = [self.document_with_segment(3)[1] for i in range(3)]
+        report = self.bulk_create()
+        self.assertEqual(report.segments, 3)
+        self.assertEqual(report.created, 3 * 3 * 3)
+        expected = set()
+        for segment in segments:
+            for l_eo, r_eo in segment.kind_occurrence_pairs(self.k_person,
+                                                            self.k_location):
+                expected.add((l_eo.pk, r_eo.pk, segment.pk))
+        self.assertEqual(self.triples(), expected)
+
+    def test_existent_candidates_are_kept(self):
+        segment = self.document_with_segment()[1]
+        l_eo, r_eo = segment.kind_occurrence_pairs(self.k_person, self.k_location)[0]
+        ec = EvidenceCandidate.objects.create(
+            left_entity_occurrence=l_eo, right_entity_occurrence=r_eo, segment=segment)
+        report = self.bulk_create()
+        self.assertEqual(report.created, 3)
+        self.assertEqual(EvidenceCandidate.objects.count(), 4)
+        self.assertTrue(EvidenceCandidate.objects.filter(pk=ec.pk).exists())
+        self.assertEqual(self.bulk_create().created, 0)
+
+    def test_same_kind_relation_does_not_pair_occurrence_with_itself(self):
+        self.relation = RelationFactory(left_entity_kind=self.k_person,
+                                        right_entity_kind=self.k_person)
+        self.document_with_segment(3)
+        self.assertEqual(self.bulk_create().created, 3 * 2)
+        for l_eo, r_eo, _ in self.triples():
+            self.assertNotEqual(l_eo, r_eo)
+
+    def test_only_given_segments_are_processed(self):
+        segments = [self.document_with_segment()[1] for i in range(3)]
+        report = self.bulk_create(segment_ids=[segments[1].pk])
+        self.assertEqual(report.created, 4)
+        self.assertEqual(set(t[2] for t in self.triples()), {segments[1].pk})
+
+    def test_queries_do_not_depend_on_segments_amount(self):
+        for i in range(5):
+            self.document_with_segment()
+        with CaptureQueriesContext(connection) as ctx:
+            self.bulk_create()
+        for i in range(20):
+            self.document_with_segment()
+        with CaptureQueriesContext(connection) as ctx_2:
+            self.bulk_create()
+        self.assertEqual(len(ctx.captured_queries), len(ctx_2.captured_queries))
+
+
+class TestPrefetchEntityOccurrences(BaseCandidatesTest):
+
+    def test_occurrences_are_hydrated_for_each_segment(self):
+        doc, segment = self.document_with_segment()
+        other = TextSegmentFactory(document=doc, offset=1, offset_end=10)
+        for eo in segment.entity_occurrences.all():
+            if eo.offset >= 1:
+                eo.segments.add(other)
+        segments = list(TextSegment.objects.filter(pk__in=[segment.pk, other.pk]))
+        TextSegment.prefetch_entity_occurrences(segments)
+        for s in segments:
+            expected = list(s.entity_occurrences.order_by('offset'))
+            with self.assertNumQueries(0):
+                eos = s.get_entity_occurrences()
+                kinds = [eo.entity.kind.name for eo in eos]
+            self.assertEqual(eos, expected)
+            self.assertEqual(kinds, [eo.entity.kind.name for eo in expected])
+            for eo in eos:
+                self.assertEqual(eo.segment_offset, eo.offset - s.offset)
+
+    def test_fixed_amount_of_queries(self):
+        segments = [self.document_with_segment()[1] for i in range(10)]
+        with self.assertNumQueries(1):
+            TextSegment.prefetch_entity_occurrences(segments)
+        for s in segments:
+            self.assertEqual(len(s._hydrated_eos), 4)
+
+    def test_already_hydrated_segments_are_not_queried(self):
+        segment = self.document_with_segment()[1]
+        segment.get_entity_occurrences()
+        with self.assertNumQueries(0):
+            TextSegment.prefetch_entity_occurrences([segment])
+
+
+class TestLabelsFor(ManagerTestCase):
+    YES, NO = EvidenceLabel.YESRELATION, EvidenceLabel.NORELATION
+
+    def setUp(self):
+        self.relation = RelationFactory()
+        self.evidences = [EvidenceCandidateFactory() for i in range(4)]
+
+    def labels_for(self, evidences=None, **kwargs):
+        if evidences is None:
+            evidences = self.evidences
+        return CandidateEvidenceManager.labels_for(self.relation, evidences, **kwargs)
+
+    def test_non_informative_or_missing_labels_are_none(self):
+        ev1, ev2, ev3, ev4 = self.evidences
+        ev1.set_label(self.relation, self.YES, 'judge')
+        ev2.set_label(self.relation, self.NO, 'judge')
+        ev3.set_label(self.relation, EvidenceLabel.NONSENSE, 'judge')
+        self.assertEqual(self.labels_for(),
+                         {ev1: True, ev2: False, ev3: None, ev4: None})
+
+    def test_labels_by_machine_or_for_other_relation_are_ignored(self):
+        ev1, ev2 = self.evidences[:2]
+        ev1.set_label(self.relation, self.YES, 'judge', labeled_by_machine=True)
+        ev2.set_label(RelationFactory(), self.YES, 'judge')
+        self.assertEqual(self.labels_for([ev1, ev2]), {ev1: None, ev2: None})
+
+    def test_conflicts_are_solved_with_the_solver_given(self):
+        ev1, ev2 = self.evidences[:2]
+        ev1.set_label(self.relation, self.YES, 'alice')
+        ev1.set_label(self.relation, self.NO, 'bob')
+        ev2.set_label(self.relation, self.NO, 'alice')
+        ev2.set_label(self.relation, self.NO, 'bob')
+        solver = CandidateEvidenceManager.conflict_resolution_by_judge_name
+        self.assertEqual(self.labels_for([ev1, ev2]), {ev1: None, ev2: False})
+        self.assertEqual(self.labels_for([ev1, ev2], conflict_solver=solver(['bob'])),
+                         {ev1: False, ev2: False})
+        self.assertEqual(self.labels_for([ev1, ev2], conflict_solver=solver(['alice'])),
+                         {ev1: True, ev2: False})
+        self.assertEqual(self.labels_for([ev1], conflict_solver=solver(['carol'])),
+                         {ev1: None})
+
+    def test_labels_are_not_queried_per_evidence(self):
+        for ev in self.evidences:
+            ev.set_label(self.relation, self.YES, 'judge')
+        with self.assertNumQueries(1):
+            result = self.labels_for()
+        self.assertEqual(set(result.values()), {True})
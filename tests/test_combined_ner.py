@@ -1,3 +1,5 @@
+import threading
+import time
 from unittest import mock
 
 from operator import attrgetter
@@ -87,6 +89,43 @@ class TestCombinedNERRunner(BaseTestCombined):
         runner(doc)
         doc.set_ner_result.assert_called_once_with(ents)
 
+    def test_runners_run_at_the_same_time(self):
+        # each one waits for the other to start
+        barrier = threading.Barrier(2, timeout=5)
+        self.runner1.run_ner.side_effect = lambda doc: [barrier.wait()] and []
+        self.runner2.run_ner.side_effect = lambda doc: [barrier.wait()] and []
+        runner = CombinedNERRunner([self.runner1, self.runner2])
+        runner(self.doc)
+        self.doc.set_ner_result.assert_called_once_with([])
+
+    def test_runners_threads_close_their_db_connection(self):
+        runner = CombinedNERRunner([self.runner1, self.runner2])
+        with mock.patch('iepy.preprocess.ner.combiner.connection') as db_connection:
+            runner(self.doc)
+        self.assertEqual(db_connection.close.call_count, 2)
+
+    def test_runners_run_one_after_the_other_with_one_worker(self):
+        threads = []
+
+        def run_ner(doc):
+            threads.append(threading.current_thread())
+            return []
+        self.runner1.run_ner.side_effect = run_ner
+        self.runner2.run_ner.side_effect = run_ner
+        runner = CombinedNERRunner([self.runner1, self.runner2], max_workers=1)
+        runner(self.doc)
+        self.assertEqual(threads, [threading.current_thread()] * 2)
+
+    def test_time_spent_on_each_runner_is_accumulated(self):
+        self.runner1.run_ner.side_effect = lambda doc: time.sleep(0.01) or []
+        self.runner2.run_ner.side_effect = lambda doc: []
+        runner = CombinedNERRunner([self.runner1, self.runner2])
+        self.assertEqual(runner.elapsed, [0, 0])
+        runner(self.doc)
+        runner(self.doc)
+        self.assertGreaterEqual(runner.elapsed[0], 0.02)
+        self.assertLess(runner.elapsed[1], runner.elapsed[0])
+
 
 class TestNEROverlappingHandling(BaseTestCombined):
 
@@ -130,6 +169,14 @@ class TestNEROverlappingHandling(BaseTestCombined):
         NER(self.doc)
         self.doc.set_ner_result.assert_called_once_with(self.result2)
 
+    def test_simple_overlap_solver_checks_against_entities_of_the_same_subner(self):
+        later = self.construct_occurrences([(4, 6, u'Y'), (5, 6, u'Z'), (6, 7, u'Y')])
+        self.runner2.run_ner.side_effect = lambda doc: later
+        NER = NoOverlapCombinedNERRunner([self.runner1, self.runner2])
+        NER(self.doc)
+        self.doc.set_ner_result.assert_called_once_with(
+            [self.result1[0], later[0], self.result1[1], self.result1[2], self.result1[3]])
+
     def test_overlaps_is_solved_prefering_some_kind_over_other(self):
         combiner = lambda rank: KindPreferenceCombinedNERRunner(
             [self.runner1, self.runner2],
@@ -1,6 +1,10 @@
+from datetime import datetime, timedelta
 from unittest import TestCase
 from unittest import mock
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from iepy.data.db import DocumentManager
 from iepy.data.models import IEDocument
 from iepy.preprocess.pipeline import PreProcessSteps
@@ -50,6 +54,79 @@ class TestDocumentCreationThruManager(ManagerTestCase):
         self.assertEqual(doc.metadata.items, new_metadata)
 
 
+class TestBulkDocumentCreationThruManager(ManagerTestCase):
+    docmanager = DocumentManager()
+
+    def sample(self, n, prefix='doc'):
+        return [('%s-%i' % (prefix, i), 'text %i' % i, {'i': i}) for i in range(n)]
+
+    def test_creates_documents_with_their_metadata(self):
+        report = self.docmanager.bulk_create_documents(self.sample(7), batch_size=3)
+        self.assertEqual(report.created, 7)
+        self.assertEqual((report.updated, report.skipped), (0, 0))
+        self.assertEqual(IEDocument.objects.count(), 7)
+        for identifier, text, metadata in self.sample(7):
+            doc = IEDocument.objects.get(human_identifier=identifier)
+            self.assertEqual(doc.text, text)
+            self.assertEqual(doc.metadata.items, metadata)
+
+    def test_accepts_any_iterable(self):
+        report = self.docmanager.bulk_create_documents(iter(self.sample(4)))
+        self.assertEqual(report.created, 4)
+
+    def test_existent_and_repeated_are_skipped(self):
+        self.docmanager.create_document('doc-1', 'original', {'old': True})
+        docs = self.sample(3) + [('doc-2', 'repeated', {})]
+        report = self.docmanager.bulk_create_documents(docs)
+        self.assertEqual((report.created, report.updated, report.skipped), (2, 0, 2))
+        self.assertEqual(IEDocument.objects.count(), 3)
+        doc = IEDocument.objects.get(human_identifier='doc-1')
+        self.assertEqual(doc.text, 'original')
+        self.assertEqual(doc.metadata.items, {'old': True})
+        self.assertEqual(IEDocument.objects.get(human_identifier='doc-2').text, 'text 2')
+
+    def test_existent_are_updated_if_enabled(self):
+        self.docmanager.create_document('doc-1', 'original', {'old': True})
+        report = self.docmanager.bulk_create_documents(self.sample(3), update_mode=True)
+        self.assertEqual((report.created, report.updated, report.skipped), (2, 1, 0))
+        doc = IEDocument.objects.get(human_identifier='doc-1')
+        self.assertEqual(doc.text, 'text 1')
+        self.assertEqual(doc.metadata.items, {'i': 1})
+
+    def test_queries_do_not_grow_with_documents(self):
+        with CaptureQueriesContext(connection) as few_docs:
+            self.docmanager.bulk_create_documents(self.sample(5, 'a'))
+        with CaptureQueriesContext(connection) as more_docs:
+            self.docmanager.bulk_create_documents(self.sample(40, 'b'))
+        self.assertEqual(len(few_docs), len(more_docs))
+
+    def test_unchanged_existent_are_skipped_when_updating(self):
+        self.docmanager.bulk_create_documents(self.sample(3))
+        docs = self.sample(3)
+        docs[1] = ('doc-1', 'new text', {'i': 1})
+        docs[2] = ('doc-2', 'text 2', {'new': True})
+        report = self.docmanager.bulk_create_documents(docs, update_mode=True)
+        self.assertEqual((report.created, report.updated, report.skipped), (0, 2, 1))
+        doc = IEDocument.objects.get(human_identifier='doc-1')
+        self.assertEqual((doc.text, doc.metadata.items), ('new text', {'i': 1}))
+        doc = IEDocument.objects.get(human_identifier='doc-2')
+        self.assertEqual((doc.text, doc.metadata.items), ('text 2', {'new': True}))
+
+    def test_update_queries_do_not_grow_with_documents(self):
+        self.docmanager.bulk_create_documents(self.sample(5, 'a') + self.sample(40, 'b'))
+        changed = lambda docs: [(i, t + ' changed', {'changed': True}) for i, t, _ in docs]
+        with CaptureQueriesContext(connection) as few_docs:
+            self.docmanager.bulk_create_documents(changed(self.sample(5, 'a')),
+                                                  update_mode=True)
+        with CaptureQueriesContext(connection) as more_docs:
+            report = self.docmanager.bulk_create_documents(changed(self.sample(40, 'b')),
+                                                           update_mode=True)
+        self.assertEqual(report.updated, 40)
+        self.assertEqual(len(few_docs), len(more_docs))
+        doc = IEDocument.objects.get(human_identifier='b-39')
+        self.assertEqual((doc.text, doc.metadata.items), ('text 39 changed', {'changed': True}))
+
+
 class TestDocumentsPreprocessMetadata(ManagerTestCase):
 
     def test_preprocess_steps(self):
@@ -195,6 +272,25 @@ class TestDocumentManagerFiltersForPreprocess(ManagerTestCase):
         self.assertIn(doc2, unsentenced)
         self.assertNotIn(doc3, unsentenced)
 
+    def test_documents_with_outdated_segmentation_are_filtered(self):
+        now = datetime.now()
+        before = now - timedelta(hours=1)
+        unsegmented = IEDocFactory(sentencer_done_at=before, ner_done_at=now)
+        old_ner = IEDocFactory(sentencer_done_at=before, ner_done_at=now,
+                               segmentation_done_at=before)
+        new_ner = IEDocFactory(sentencer_done_at=before, ner_done_at=before,
+                               segmentation_done_at=now)
+        outdated = self.manager.get_documents_outdated_preprocess(
+            PreProcessSteps.segmentation)
+        self.assertEqual(list(outdated), [unsegmented, old_ner])
+        for doc in [unsegmented, old_ner]:
+            self.assertTrue(doc.is_preprocess_step_outdated(PreProcessSteps.segmentation))
+        self.assertFalse(new_ner.is_preprocess_step_outdated(PreProcessSteps.segmentation))
+        self.assertEqual(
+            list(self.manager.get_documents_by_ids(
+                [old_ner.id, new_ner.id], outdated=PreProcessSteps.segmentation)),
+            [old_ner])
+
 
 class TestDocumentSentenceIterator(TestCase):
 
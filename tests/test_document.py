@@ -1,6 +1,14 @@
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from nltk.tree import Tree
+
+from iepy.data.models import Entity, EntityOccurrence, GazetteItem, IEDocument
 from iepy.preprocess.ner.base import FoundEntity
 
-from .factories import SentencedIEDocFactory, GazetteItemFactory
+from .factories import (
+    SentencedIEDocFactory, SyntacticParsedIEDocFactory, GazetteItemFactory,
+    EntityOccurrenceFactory
+)
 from .manager_case import ManagerTestCase
 
 
@@ -15,6 +23,43 @@ class TestDocumentInvariants(ManagerTestCase):
             doc.set_syntactic_parsing_result(fake_syn_parse_items)
 
 
+class TestDocumentPackedStorage(ManagerTestCase):
+
+    def test_preprocess_lists_survive_db_round_trip(self):
+        doc = SentencedIEDocFactory(text="Él vivió en Córdoba. Long live the dog.")
+        doc.set_lemmatization_result([t.lower() for t in doc.tokens])
+        doc.set_tagging_result(['NN'] * len(doc.tokens))
+        doc.save()
+        from_db = IEDocument.objects.get(pk=doc.pk)
+        for fname in ['tokens', 'lemmas', 'postags', 'offsets_to_text', 'sentences']:
+            self.assertEqual(getattr(from_db, fname), getattr(doc, fname))
+
+    def test_empty_lists_survive_db_round_trip(self):
+        doc = SentencedIEDocFactory(text="")
+        from_db = IEDocument.objects.get(pk=doc.pk)
+        self.assertEqual(from_db.tokens, [])
+        self.assertEqual(from_db.sentences, [0])
+
+    def test_list_literals_are_accepted(self):
+        # as the ones coming from forms, fixtures or the older storage
+        doc = SentencedIEDocFactory(text="Hello world.")
+        doc.tokens = "['Hello', 'world', '.']"
+        doc.offsets_to_text = "[0, 6, 11]"
+        self.assertEqual(doc.tokens, ['Hello', 'world', '.'])
+        self.assertEqual(doc.offsets_to_text, [0, 6, 11])
+
+    def test_syntactic_trees_are_parsed_on_demand(self):
+        doc = SyntacticParsedIEDocFactory()
+        from_db = IEDocument.objects.get(pk=doc.pk)
+        trees = from_db.syntactic_sentences
+        self.assertEqual(len(trees), len(doc.syntactic_sentences))
+        self.assertEqual(trees.as_strings(), [str(x) for x in doc.syntactic_sentences])
+        self.assertEqual(trees[3], Tree.fromstring(doc.syntactic_sentences[3]))
+        # and saving back does not alter them
+        from_db.save()
+        self.assertEqual(IEDocument.objects.get(pk=doc.pk).syntactic_sentences, trees)
+
+
 class TestSetNERResults(ManagerTestCase):
 
     def _f_eo(self, key='something', kind_name='ABC', alias='The dog', offset=0,
@@ -77,3 +122,105 @@ class TestSetNERResults(ManagerTestCase):
         eo = self.doc.entity_occurrences.first()
         # the one that is saved is the first one
         self.assertEqual(eo.entity.key, f_eo.key)
+
+    def test_same_offsets_but_different_kind_are_allowed(self):
+        f_eo = self._f_eo()
+        f_eo_2 = self._f_eo(kind_name='XYZ')
+        self.doc.set_ner_result([f_eo, f_eo_2])
+        self.assertEqual(
+            sorted(eo.entity.kind.name for eo in self.doc.entity_occurrences.all()),
+            ['ABC', 'XYZ'])
+
+    def test_occurrences_from_gazette_are_not_clashed(self):
+        f_eo = self._f_eo(from_gazette=True)
+        GazetteItemFactory(kind__name=f_eo.kind_name, text=f_eo.key)
+        self.doc.set_ner_result([f_eo])
+        self.doc.set_ner_result([self._f_eo(key='other', kind_name='XYZ')])
+        self.assertEqual(self.doc.entity_occurrences.count(), 1)
+
+    def test_missing_gazette_item_fails_without_saving(self):
+        f_eo = self._f_eo(from_gazette=True)
+        with self.assertRaises(GazetteItem.DoesNotExist):
+            self.doc.set_ner_result([self._f_eo(key='other', offset=3, offset_end=4), f_eo])
+        self.assertEqual(self.doc.entity_occurrences.count(), 0)
+
+    def test_existent_entities_are_reused(self):
+        f_eo = self._f_eo()
+        self.doc.set_ner_result([f_eo])
+        other_doc = SentencedIEDocFactory(text="The dog is dead.")
+        other_doc.set_ner_result([f_eo])
+        self.assertEqual(Entity.objects.count(), 1)
+        self.assertEqual(EntityOccurrence.objects.count(), 2)
+
+    def test_queries_do_not_depend_on_amount_of_entities(self):
+        doc_tkns = len(self.doc.tokens)
+
+        def found_entities(amount, prefix):
+            return [self._f_eo(key='{} {}'.format(prefix, i), offset=i % doc_tkns,
+                               offset_end=i % doc_tkns + 1, kind_name='K{}'.format(i))
+                    for i in range(amount)]
+        self.doc.set_ner_result(found_entities(30, 'warm'))  # kinds get created
+        few_doc = SentencedIEDocFactory(text=self.doc.text)
+        many_doc = SentencedIEDocFactory(text=self.doc.text)
+        with CaptureQueriesContext(connection) as ctx:
+            few_doc.set_ner_result(found_entities(5, 'few'))
+        with CaptureQueriesContext(connection) as ctx_2:
+            many_doc.set_ner_result(found_entities(30, 'many'))
+        self.assertEqual(few_doc.entity_occurrences.count(), 5)
+        self.assertEqual(many_doc.entity_occurrences.count(), 30)
+        self.assertEqual(len(ctx.captured_queries), len(ctx_2.captured_queries))
+
+    def test_kinds_rolled_back_are_created_again(self):
+        try:
+            with transaction.atomic():
+                self.doc.set_ner_result([self._f_eo(kind_name='NEW_KIND')])
+                raise ValueError
+        except ValueError:
+            pass
+        other_doc = SentencedIEDocFactory(text=self.doc.text)
+        other_doc.set_ner_result([self._f_eo(kind_name='NEW_KIND')])
+        self.assertEqual(other_doc.entity_occurrences.get().entity.kind.name, 'NEW_KIND')
+
+
+class TestEnrichedSentences(ManagerTestCase):
+
+    def setUp(self):
+        self.doc = SentencedIEDocFactory(text='John Smith lives in New York . He is fine .')
+        self.doc.lemmas = self.doc.tokens
+        self.doc.postags = ['NN'] * len(self.doc.tokens)
+        self.doc.save()
+
+    def enriched(self):
+        return [t for sentence in self.doc.get_sentences(enriched=True) for t in sentence]
+
+    def test_tokens_have_the_occurrences_covering_them(self):
+        eo_1 = EntityOccurrenceFactory(document=self.doc, offset=0, offset_end=2)
+        eo_2 = EntityOccurrenceFactory(document=self.doc, offset=1, offset_end=2)
+        eo_3 = EntityOccurrenceFactory(document=self.doc, offset=4, offset_end=6)
+        eo_4 = EntityOccurrenceFactory(document=self.doc, offset=7, offset_end=8)
+        tokens = self.enriched()
+        self.assertEqual([t.offset for t in tokens], list(range(len(self.doc.tokens))))
+        self.assertEqual(
+            [t.eo_ids for t in tokens],
+            [[eo_1.id], [eo_1.id, eo_2.id], [], [], [eo_3.id], [eo_3.id], [],
+             [eo_4.id], [], [], []])
+        self.assertEqual(tokens[4].eo_kinds, [eo_3.entity.kind])
+
+    def test_queries_dont_depend_on_amount_of_occurrences(self):
+        def count_queries():
+            doc = IEDocument.objects.get(pk=self.doc.pk)
+            with CaptureQueriesContext(connection) as ctx:
+                list(doc.get_sentences(enriched=True))
+                list(doc.get_sentences(enriched=True))
+            return len(ctx.captured_queries)
+        EntityOccurrenceFactory(document=self.doc, offset=0, offset_end=2)
+        few = count_queries()
+        for i in range(2, 10):
+            EntityOccurrenceFactory(document=self.doc, offset=i, offset_end=i + 1)
+        self.assertEqual(count_queries(), few)
+        self.assertEqual(few, 1)
+
+    def test_new_ner_result_is_seen(self):
+        self.assertEqual(sum(len(t.eo_ids) for t in self.enriched()), 0)
+        self.doc.set_ner_result([FoundEntity('John Smith', 'PERSON', 'John Smith', 0, 2, False)])
+        self.assertEqual(sum(len(t.eo_ids) for t in self.enriched()), 2)
@@ -0,0 +1,91 @@
+from unittest import TestCase, mock
+
+from nltk.tree import Tree
+
+from corpus.fields import (
+    pack_strings, unpack_strings, pack_ints, unpack_ints, LazyTreeList
+)
+
+
+class TestPackedStrings(TestCase):
+
+    def assertRoundTrip(self, values):
+        packed = pack_strings(values)
+        self.assertIsInstance(packed, bytes)
+        self.assertEqual(unpack_strings(packed), values)
+
+    def test_empty(self):
+        self.assertEqual(pack_strings([]), b'')
+        self.assertEqual(unpack_strings(b''), [])
+
+    def test_simple(self):
+        self.assertRoundTrip(['The', 'dog', 'is', 'dead', '.'])
+
+    def test_empty_strings_and_unicode(self):
+        self.assertRoundTrip(['', 'Ñandú', '', '東京', '-LRB-', "''"])
+
+    def test_long_strings(self):
+        self.assertRoundTrip(['a' * 300, 'b'])
+        self.assertRoundTrip(['a' * 70000, 'b' * 3])
+
+    def test_smaller_than_list_literal(self):
+        tokens = 'Some sentence . And some other . Indeed !'.split() * 100
+        self.assertLess(len(pack_strings(tokens)), len(str(tokens).encode('utf8')))
+
+    def test_unknown_version_is_rejected(self):
+        packed = pack_strings(['a', 'b'])
+        self.assertRaises(ValueError, unpack_strings, b'\xff' + packed[1:])
+
+
+class TestPackedInts(TestCase):
+
+    def assertRoundTrip(self, values):
+        self.assertEqual(unpack_ints(pack_ints(values)), values)
+
+    def test_empty(self):
+        self.assertEqual(pack_ints([]), b'')
+        self.assertEqual(unpack_ints(b''), [])
+
+    def test_different_magnitudes(self):
+        self.assertRoundTrip([0, 3, 7])
+        self.assertRoundTrip([0, 300, 70000])
+        self.assertRoundTrip([0, 2 ** 31 - 1])
+        self.assertRoundTrip([-5, 0, 5])
+
+    def test_smaller_than_list_literal(self):
+        offsets = list(range(0, 50000, 7))
+        self.assertLess(len(pack_ints(offsets)), len(str(offsets)))
+
+
+class TestLazyTreeList(TestCase):
+    bracketed = ['(S (NP (NNP John)) (VP (VBZ runs)))', '(S (NP (PRP He)) (VP (VBD slept)))']
+
+    def setUp(self):
+        self.trees = LazyTreeList(self.bracketed)
+
+    def test_nothing_is_parsed_on_creation(self):
+        with mock.patch.object(Tree, 'fromstring') as fromstring:
+            LazyTreeList(self.bracketed)
+            self.assertFalse(fromstring.called)
+
+    def test_only_the_indexed_tree_is_parsed(self):
+        with mock.patch.object(Tree, 'fromstring', wraps=Tree.fromstring) as fromstring:
+            tree = self.trees[1]
+            fromstring.assert_called_once_with(self.bracketed[1])
+            self.assertIs(self.trees[1], tree)  # parsed only once
+            self.assertEqual(fromstring.call_count, 1)
+        self.assertEqual(tree.label(), 'S')
+        self.assertEqual(tree.leaves(), ['He', 'slept'])
+
+    def test_behaves_like_a_list_of_trees(self):
+        expected = [Tree.fromstring(x) for x in self.bracketed]
+        self.assertEqual(len(self.trees), 2)
+        self.assertEqual(list(self.trees), expected)
+        self.assertEqual(self.trees, expected)
+        self.assertEqual(self.trees[:1], expected[:1])
+        self.assertFalse(LazyTreeList([]))
+
+    def test_as_strings_does_not_parse(self):
+        with mock.patch.object(Tree, 'fromstring') as fromstring:
+            self.assertEqual(self.trees.as_strings(), self.bracketed)
+            self.assertFalse(fromstring.called)
@@ -66,6 +66,38 @@ class TestLiteralNER(TestCase):
                              ((4, 5), 'MEDICAL_TEST'), ((5, 7), 'DISEASE')]
         self.assertEqual(result, expected_entities)
 
+    def test_longest_name_is_found_even_if_a_longer_one_starts_equal(self):
+        f = NamedTemporaryFile23(mode="w", encoding="utf8")
+        f.write('New York\nNew York City Hall\nCity\n')
+        f.seek(0)
+        tagger = LiteralNER(['LOCATION'], [f.name])
+        result = tagger.entities("New York City is big".split())
+        self.assertEqual(result, [((0, 2), 'LOCATION'), ((2, 3), 'LOCATION')])
+        result = tagger.entities("at New York City Hall".split())
+        self.assertEqual(result, [((1, 5), 'LOCATION')])
+
+    def test_compiled_finds_the_same_entities(self):
+        tagger = LiteralNER(NEW_ENTITIES,
+                            [self.tmp_file1.name, self.tmp_file2.name])
+        compiled = NamedTemporaryFile23(mode="w", encoding="utf8")
+        tagger.save(compiled.name)
+        compiled_tagger = LiteralNER(compiled_filepath=compiled.name)
+        for s in ["Chase notes she's negative for HIV and Hepatitis C",
+                  "CT scan said HIV MRI Hepatitis C drooling",
+                  "Hepatitis CT scan brain Hepatitis tumor brain tumor",
+                  ""]:
+            self.assertEqual(compiled_tagger.entities(s.split()),
+                             tagger.entities(s.split()))
+        self.assertEqual(compiled_tagger.entities(["drooling"]), [((0, 1), 'MEDICAL_TEST')])
+
+    def test_compiled_empty(self):
+        f = NamedTemporaryFile23(mode="w", encoding="utf8")
+        tagger = LiteralNER(['X'], [f.name])
+        compiled = NamedTemporaryFile23(mode="w", encoding="utf8")
+        tagger.save(compiled.name)
+        compiled_tagger = LiteralNER(compiled_filepath=compiled.name)
+        self.assertEqual(compiled_tagger.entities("some text".split()), [])
+
 
 class TestLiteralNERRunner(ManagerTestCase, NERTestMixin):
 
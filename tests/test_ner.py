@@ -50,3 +50,31 @@ class TestNERRunner(ManagerTestCase, NERTestMixin):
             text='The student Rami Eid Stony Brook University in NY')
         self.check_ner(doc, [(2, 4, 'PERSON'), (4, 7, 'ORGANIZATION')])
 
+    def test_ner_runner_batch_calls_ner_once(self):
+        docs = [
+            SentencedIEDocFactory(text='Rami Eid is studying . At Stony Brook University'),
+            SentencedIEDocFactory(text='Nothing to see here'),
+            SentencedIEDocFactory(text='Stony Brook University . With Eid'),
+        ]
+        calls = []
+
+        def ner(sents):
+            calls.append(sents)
+            return [[(t, self.entity_map.get(t, 'O')) for t in sent] for sent in sents]
+        NERRunner(ner).process_batch(docs)
+        self.assertEqual(len(calls), 1)
+        self.check_ner_result(docs[0], [(0, 2, 'PERSON'), (6, 9, 'ORGANIZATION')])
+        self.check_ner_result(docs[1], [])
+        self.check_ner_result(docs[2], [(0, 3, 'ORGANIZATION'), (5, 6, 'PERSON')])
+
+    def test_ner_runner_batch_without_sentences_does_not_call_ner(self):
+        calls = []
+
+        def ner(sents):
+            calls.append(sents)
+            return []
+        runner = NERRunner(ner)
+        runner.process_batch([])
+        runner.process_batch([IEDocFactory(text='Not sentenced yet')])
+        self.assertEqual(runner.run_ner_batch([]), [])
+        self.assertEqual(calls, [])
@@ -5,7 +5,10 @@ except ImportError:
 
 from unittest import TestCase
 
-from iepy.preprocess.pipeline import PreProcessPipeline, PreProcessSteps
+from iepy.preprocess.pipeline import (
+    BasePreProcessStepRunner, PreProcessPipeline, ParallelPreProcessPipeline,
+    PreProcessSteps, _init_worker, _process_documents_batch, _worker
+)
 
 
 class TestPreProcessPipeline(TestCase):
@@ -62,16 +65,33 @@ class TestPreProcessPipeline(TestCase):
         all_docs = [object() for i in range(5)]
         docs_manager = mock.MagicMock()
         docs_manager.__iter__.return_value = all_docs
+        docs_manager.__len__.return_value = len(all_docs)
         docs_manager.get_documents_lacking_preprocess.side_effect = lambda x: all_docs[:2]
         # Ok, docs manager has 5 docs, but get_documents_lacking_preprocess will return
         # only 2 of them
         p = PreProcessPipeline([step_runner], docs_manager)
-        p.process_step_in_batch(step_runner)
+        report = p.process_step_in_batch(step_runner)
         docs_filter = docs_manager.get_documents_lacking_preprocess
         docs_filter.assert_called_once_with(step_runner.step)
         self.assertNotEqual(step_runner.call_count, 5)
         self.assertEqual(step_runner.call_count, 2)
         self.assertEqual(step_runner.call_args_list, [mock.call(d) for d in all_docs[:2]])
+        self.assertEqual((report.documents, report.skipped), (2, 3))
+
+    def test_process_step_in_batch_on_increment_mode_filters_outdated_docs(self):
+        step_runner = mock.MagicMock(step=PreProcessSteps.segmentation,
+                                     override=False, increment=True)
+        all_docs = [object() for i in range(5)]
+        docs_manager = mock.MagicMock()
+        docs_manager.__iter__.return_value = all_docs
+        docs_manager.__len__.return_value = len(all_docs)
+        docs_manager.get_documents_outdated_preprocess.side_effect = lambda x: all_docs[3:]
+        p = PreProcessPipeline([step_runner], docs_manager)
+        report = p.process_step_in_batch(step_runner)
+        docs_manager.get_documents_outdated_preprocess.assert_called_once_with(
+            PreProcessSteps.segmentation)
+        self.assertEqual(step_runner.call_args_list, [mock.call(d) for d in all_docs[3:]])
+        self.assertEqual((report.documents, report.skipped), (2, 3))
 
     def test_process_step_in_batch_does_not_call_docs_save(self):
         runner = mock.Mock(wraps=lambda x: x)
@@ -94,3 +114,111 @@ class TestPreProcessPipeline(TestCase):
             self.assertEqual(mock_batch.call_args_list,
                              [mock.call(runner1), mock.call(runner2)])
         self.assertEqual(p.call_order, [runner1, runner2])
+
+    def test_process_step_in_batch_hands_batches_to_runners_supporting_it(self):
+        runner = BasePreProcessStepRunner()
+        runner.batch_size = 2
+        docs = [object() for i in range(5)]
+        p = PreProcessPipeline([runner], docs)
+        with mock.patch.object(runner, 'process_batch') as mock_process_batch:
+            p.process_step_in_batch(runner)
+        self.assertEqual(mock_process_batch.call_args_list,
+                         [mock.call(docs[:2]), mock.call(docs[2:4]), mock.call(docs[4:])])
+
+
+class FakeDoc:
+    def __init__(self, id, manager=None):
+        self.id = id
+        self.manager = manager
+        self.done = manager is not None and id in manager.saved
+
+    def save(self):
+        self.manager.saved.add(self.id)
+
+
+class FakeDocumentsManager:
+    # Picklable, so can be sent to workers. Documents are built again on each
+    # query, so changes not saved are lost as with the database
+    def __init__(self, amount):
+        self.ids = list(range(amount))
+        self.saved = set()
+
+    def get_documents_ids(self):
+        return list(self.ids)
+
+    def get_documents_by_ids(self, ids, lacking=None):
+        return [FakeDoc(i, self) for i in self.ids if i in ids]
+
+
+class FailingRunner:
+    def __call__(self, doc):
+        if doc.id % 5 == 0:
+            raise ValueError(doc.id)
+
+
+class FailingBatchRunner(BasePreProcessStepRunner):
+    # Sets results on all the documents, but saves none of them if one fails
+    batch_size = 3
+
+    def __init__(self):
+        super(FailingBatchRunner, self).__init__()
+        self.batches = []
+
+    def __call__(self, doc):
+        self.process_batch([doc])
+
+    def process_batch(self, docs):
+        docs = [doc for doc in docs if not doc.done]
+        self.batches.append([doc.id for doc in docs])
+        for doc in docs:
+            doc.done = True
+        for doc in docs:
+            FailingRunner()(doc)
+        for doc in docs:
+            doc.save()
+
+
+class TestParallelPreProcessPipeline(TestCase):
+
+    def test_all_documents_are_processed_by_each_step(self):
+        p = ParallelPreProcessPipeline([FailingRunner, FailingRunner],
+                                       FakeDocumentsManager(23), workers=2, batch_size=4)
+        reports = p.process_everything()
+        self.assertEqual(len(reports), 2)
+        for report in reports:
+            self.assertEqual(report.documents, 23)
+            self.assertEqual(sorted(doc_id for doc_id, _ in report.failures),
+                             [0, 5, 10, 15, 20])
+            self.assertGreaterEqual(report.elapsed, 0)
+
+    def test_process_step_in_batch_runs_only_the_step_given(self):
+        factory1, factory2 = mock.Mock(), mock.Mock()
+        p = ParallelPreProcessPipeline([factory1, factory2], FakeDocumentsManager(3),
+                                       workers=1)
+        with mock.patch.object(p, '_process_step') as mock_step:
+            p.process_step_in_batch(1)
+        self.assertEqual(mock_step.call_count, 1)
+        self.assertEqual(mock_step.call_args[0][1], 1)
+
+    def test_walk_document_applies_all_step_runners_on_this_process(self):
+        factory1, factory2 = mock.Mock(), mock.Mock()
+        p = ParallelPreProcessPipeline([factory1, factory2], FakeDocumentsManager(3))
+        doc = mock.Mock()
+        p.walk_document(doc)
+        p.walk_document(doc)
+        for factory in [factory1, factory2]:
+            factory.assert_called_once_with()
+            self.assertEqual(factory.return_value.call_args_list, [mock.call(doc)] * 2)
+
+    def test_workers_hand_batches_to_runners_supporting_it(self):
+        runner = FailingBatchRunner()
+        documents = FakeDocumentsManager(7)
+        _init_worker([lambda: runner], documents)
+        self.addCleanup(_worker.clear)
+        processed, failures = _process_documents_batch((0, list(range(7))))
+        # failed batches are retried one by one, starting from what was saved
+        self.assertEqual(runner.batches, [[0, 1, 2], [0], [1], [2],
+                                          [3, 4, 5], [3], [4], [5], [6]])
+        self.assertEqual(processed, 7)
+        self.assertEqual([doc_id for doc_id, _ in failures], [0, 5])
+        self.assertEqual(documents.saved, {1, 2, 3, 4, 6})
@@ -1,6 +1,9 @@
 from unittest import mock
 
-from iepy.data.models import EvidenceLabel
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from iepy.data.models import EvidenceLabel, LabelingQueue, LabelingQueueItem
 from .factories import (
     RelationFactory, EntityFactory, EntityKindFactory,
     TextSegmentFactory, EntityOccurrenceFactory,
@@ -209,6 +212,83 @@ class TestReferenceNextSegmentToLabel(BaseTestReferenceBuilding):
         self.assertEqual(set(real), expected)
 
 
+class TestLabelingQueue(BaseTestReferenceBuilding):
+    judge = "iepy"
+
+    def next(self, judge=None):
+        return self.r_lives_in.get_next_segment_to_label(judge or self.judge)
+
+    def label_segment(self, segment, label, judge=None):
+        for evidence in segment.get_evidences_for_relation(self.r_lives_in):
+            evidence.set_label(self.r_lives_in, label, judge or self.judge)
+
+    def test_queries_do_not_depend_on_corpus_size(self):
+        segments = [self.segment_with_occurrences_factory([self.john, self.roma])
+                    for i in range(3)]
+        self.next()  # builds the queue
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(self.next(), segments[0])
+        segments += [self.segment_with_occurrences_factory([self.john, self.roma])
+                     for i in range(20)]
+        self.next()
+        for s in segments[:10]:
+            self.label_segment(s, self.solid_label)
+        with CaptureQueriesContext(connection) as ctx_2:
+            self.assertEqual(self.next(), segments[10])
+        self.assertEqual(len(ctx.captured_queries), len(ctx_2.captured_queries))
+
+    def test_deleted_labels_put_segment_back_on_queue(self):
+        s = self.segment_with_occurrences_factory([self.john, self.roma])
+        self.label_segment(s, self.solid_label)
+        self.assertIsNone(self.next())
+        EvidenceLabel.objects.all().delete()
+        self.assertEqual(self.next(), s)
+
+    def test_segments_losing_occurrences_leave_the_queue(self):
+        s = self.segment_with_occurrences_factory([self.john, self.peter, self.roma])
+        self.assertEqual(self.next(), s)
+        s.entity_occurrences.filter(entity=self.roma).delete()
+        self.assertIsNone(self.next())
+
+    def test_occurrences_added_to_known_segments_are_considered(self):
+        s = self.segment_with_occurrences_factory([self.john])
+        self.assertIsNone(self.next())
+        eo = self.create_occurrence(s.document, self.roma, 1, 2)
+        eo.segments.add(s)
+        self.assertEqual(self.next(), s)
+
+    def test_deleted_segments_leave_the_queue(self):
+        s = self.segment_with_occurrences_factory([self.john, self.roma])
+        self.label_segment(s, None)
+        self.assertEqual(self.next(), s)
+        s.delete()
+        self.assertIsNone(self.next())
+        self.assertFalse(LabelingQueueItem.objects.exists())
+
+    def test_empty_labels_of_judge_are_preferred_only_for_that_judge(self):
+        s1 = self.segment_with_occurrences_factory([self.john, self.roma])
+        s2 = self.segment_with_occurrences_factory([self.peter, self.london])
+        self.label_segment(s2, None, judge='other')
+        self.assertEqual(self.next(judge='other'), s2)
+        self.assertEqual(self.next(), s1)
+
+    def test_refreshes_from_a_stale_queue_dont_duplicate_items(self):
+        s = self.segment_with_occurrences_factory([self.john, self.roma])
+        queue = LabelingQueue.for_relation(self.r_lives_in)
+        # as loaded by another request, before the segment was added
+        stale = LabelingQueue.objects.get(pk=queue.pk)
+        stale.last_segment_id = 0
+        with CaptureQueriesContext(connection) as ctx:
+            stale.add_new_segments()
+        if connection.features.has_select_for_update:
+            self.assertTrue(any('FOR UPDATE' in q['sql'] for q in ctx.captured_queries))
+        self.assertEqual(stale.last_segment_id, s.id)
+        queue._refresh([s.id])
+        stale._refresh([s.id])
+        self.assertEqual(LabelingQueueItem.objects.filter(segment=s).count(), 1)
+        self.assertEqual(self.next(), s)
+
+
 class TestNavigateLabeledSegments(BaseTestReferenceBuilding):
     judge = "iepy"
 
@@ -325,6 +405,26 @@ class TestNavigateLabeledSegments(BaseTestReferenceBuilding):
             r.labeled_neighbor(reference, self.judge, back=True)
         )
 
+    def test_judgeless_navigation_considers_labels_of_every_judge(self):
+        r = self.r_lives_in
+        segments = self.create_labeled_segments_for_relation(r, 3)
+        other = self.segment_with_occurrences_factory([self.john, self.london])
+        for le in other.get_evidences_for_relation(r):
+            le.set_label(r, self.solid_label, 'someone else')
+        self.assertEqual(segments[-1].id, r.labeled_neighbor(segments[-1], self.judge))
+        self.assertEqual(other.id, r.labeled_neighbor(segments[-1], None))
+        self.assertEqual(segments[-1].id, r.labeled_neighbor(other, None, back=True))
+
+    def test_queries_do_not_depend_on_amount_labeled(self):
+        r = self.r_lives_in
+        segments = self.create_labeled_segments_for_relation(r, 3)
+        with CaptureQueriesContext(connection) as ctx:
+            r.labeled_neighbor(segments[1], self.judge)
+        segments += self.create_labeled_segments_for_relation(r, 20)
+        with CaptureQueriesContext(connection) as ctx_2:
+            r.labeled_neighbor(segments[1], self.judge)
+        self.assertEqual(len(ctx.captured_queries), len(ctx_2.captured_queries))
+
 
 class TestNavigateLabeledDocuments(BaseTestReferenceBuilding):
     judge = "iepy"
@@ -1,6 +1,10 @@
 import unittest
+from unittest import mock
 
-from iepy.data.models import TextSegment, EntityOccurrence
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from iepy.data.models import TextSegment, EntityOccurrence, LabelingQueue
 from iepy.preprocess.segmenter import RawSegment, SyntacticSegmenterRunner
 
 from .factories import IEDocFactory, EntityFactory, EntityOccurrenceFactory, TextSegmentFactory
@@ -118,6 +122,66 @@ class TextSegmentCreationTest(ManagerTestCase):
         s = self.build_and_get_segment_from_raw(RSF(2, 5))
         self.assertEqual(list(s.get_entity_occurrences()), [])
 
+    def test_entities_capture_several_segments(self):
+        self.hack_document("The people around the world is crazy.")
+        eo1 = EntityOccurrenceFactory(document=self.d, offset=1, offset_end=3)
+        eo2 = EntityOccurrenceFactory(document=self.d, offset=3, offset_end=5)
+        eo3 = EntityOccurrenceFactory(document=self.d, offset=5, offset_end=6)
+        self.d.set_segmentation_result([RSF(0, 4), RSF(2, 7), RSF(3, 5)], override=True)
+        segments = list(self.d.get_text_segments())
+        self.assertEqual([(s.offset, s.offset_end) for s in segments],
+                         [(0, 4), (2, 7), (3, 5)])
+        self.assertEqual([list(s.get_entity_occurrences()) for s in segments],
+                         [[eo1], [eo2, eo3], [eo2]])
+
+    def test_entities_provided_are_used(self):
+        self.hack_document("The people around the world is crazy.")
+        eo1 = EntityOccurrenceFactory(document=self.d, offset=1, offset_end=3)
+        EntityOccurrenceFactory(document=self.d, offset=3, offset_end=5)
+        s = self.build_and_get_segment_from_raw(RSF(0, 6, [eo1]))
+        self.assertEqual(list(s.get_entity_occurrences()), [eo1])
+
+    def test_queries_dont_grow_with_the_number_of_segments(self):
+        self.hack_document("The people around the world is crazy.")
+        for i in range(6):
+            EntityOccurrenceFactory(document=self.d, offset=i, offset_end=i + 1)
+
+        def count_queries(raws):
+            self.d.segments.all().delete()
+            with CaptureQueriesContext(connection) as ctx:
+                self.d.set_segmentation_result(raws)
+            return len(ctx.captured_queries)
+        few = count_queries([RSF(0, 2)])
+        many = count_queries([RSF(0, 2), RSF(1, 4), RSF(2, 5), RSF(3, 6)])
+        self.assertEqual(few, many)
+        self.assertEqual(
+            sum(len(list(s.get_entity_occurrences())) for s in self.d.get_text_segments()),
+            2 + 3 + 3 + 3)
+
+    def test_labeling_queues_are_told_about_new_segments(self):
+        self.hack_document("The people around the world is crazy.")
+        with mock.patch.object(LabelingQueue, 'refresh_segments') as refresh:
+            self.d.set_segmentation_result([RSF(0, 2), RSF(2, 5)], override=True)
+        ids = [s.id for s in self.d.get_text_segments()]
+        refresh.assert_called_once_with(ids)
+
+    def test_enriched_tokens_have_the_occurrences_covering_them(self):
+        self.hack_document("The people around the world is crazy.")
+        self.d.lemmas = self.d.tokens
+        self.d.save()
+        eo1 = EntityOccurrenceFactory(document=self.d, offset=1, offset_end=3)
+        eo2 = EntityOccurrenceFactory(document=self.d, offset=2, offset_end=3)
+        eo3 = EntityOccurrenceFactory(document=self.d, offset=4, offset_end=5)
+        s = self.build_and_get_segment_from_raw(RSF(1, 6))
+        with CaptureQueriesContext(connection) as ctx:
+            tokens = list(s.get_enriched_tokens())
+            list(s.get_enriched_tokens())
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual([t.offset for t in tokens], [1, 2, 3, 4, 5])
+        self.assertEqual([t.eo_ids for t in tokens],
+                         [[eo1.id], [eo1.id, eo2.id], [], [eo3.id], []])
+        self.assertEqual(tokens[3].eo_kinds, [eo3.entity.kind])
+
     def test_sentence_information(self):
         d = self.d
         L = 100
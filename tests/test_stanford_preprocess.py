@@ -1,13 +1,84 @@
+import io
+import os
+import shutil
+import tempfile
 from unittest import TestCase, mock
 from datetime import datetime
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from .factories import (IEDocFactory, SentencedIEDocFactory, GazetteItemFactory,
                         EntityOccurrenceFactory, EntityKindFactory)
 from .manager_case import ManagerTestCase
+from iepy.preprocess import corenlp
 from iepy.preprocess.pipeline import PreProcessSteps
 from iepy.preprocess.stanford_preprocess import (
-    StanfordPreprocess, GazetteManager, apply_coreferences, CoreferenceError,
-    StanfordAnalysis)
+    StanfordPreprocess, GazetteManager, apply_coreferences, apply_all_coreferences,
+    CoreferenceError, StanfordAnalysis, StanfordXMLAnalysis)
+
+
+EMPTY_OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<root><document><sentences></sentences></document></root>"""
+
+OUTPUT = """<?xml version="1.0" encoding="UTF-8"?>
+<?xml-stylesheet href="CoreNLP-to-HTML.xsl" type="text/xsl"?>
+<root>
+  <document>
+    <sentences>
+      <sentence id="1">
+        <tokens>
+          <token id="1">
+            <word>John</word><lemma>John</lemma>
+            <CharacterOffsetBegin>0</CharacterOffsetBegin><CharacterOffsetEnd>4</CharacterOffsetEnd>
+            <POS>NNP</POS><NER>PERSON</NER>
+          </token>
+          <token id="2">
+            <word>Smith</word><lemma>Smith</lemma>
+            <CharacterOffsetBegin>5</CharacterOffsetBegin><CharacterOffsetEnd>10</CharacterOffsetEnd>
+            <POS>NNP</POS><NER>PERSON</NER>
+          </token>
+          <token id="3">
+            <word>sleeps</word><lemma>sleep</lemma>
+            <CharacterOffsetBegin>11</CharacterOffsetBegin><CharacterOffsetEnd>17</CharacterOffsetEnd>
+            <POS>VBZ</POS><NER>O</NER>
+          </token>
+        </tokens>
+        <parse>(ROOT (S (NP (NNP John) (NNP Smith)) (VP (VBZ sleeps))))</parse>
+        <basic-dependencies>
+          <dep type="nsubj">
+            <governor idx="3">sleeps</governor><dependent idx="2">Smith</dependent>
+          </dep>
+        </basic-dependencies>
+      </sentence>
+      <sentence id="2">
+        <tokens>
+          <token id="1">
+            <word>He</word><lemma>he</lemma>
+            <CharacterOffsetBegin>19</CharacterOffsetBegin><CharacterOffsetEnd>21</CharacterOffsetEnd>
+            <POS>PRP</POS><NER>O</NER>
+          </token>
+          <token id="2">
+            <word>snores</word><lemma>snore</lemma>
+            <CharacterOffsetBegin>22</CharacterOffsetBegin><CharacterOffsetEnd>28</CharacterOffsetEnd>
+            <POS>VBZ</POS><NER>O</NER>
+          </token>
+        </tokens>
+        <parse>(ROOT (S (NP (PRP He)) (VP (VBZ snores))))</parse>
+      </sentence>
+    </sentences>
+    <coreference>
+      <coreference>
+        <mention representative="true">
+          <sentence>1</sentence><start>1</start><end>3</end><head>2</head><text>John Smith</text>
+        </mention>
+        <mention>
+          <sentence>2</sentence><start>1</start><end>2</end><head>1</head><text>He</text>
+        </mention>
+      </coreference>
+    </coreference>
+  </document>
+</root>"""
 
 
 class TestableStanfordAnalysis(StanfordAnalysis):
@@ -162,6 +233,52 @@ class TestSentenceFunctions(TestCase):
         self.assertEqual(len(tokens), len(lemmas))
 
 
+class TestStanfordXMLAnalysis(TestCase):
+
+    def setUp(self):
+        self.analysis = StanfordXMLAnalysis(OUTPUT)
+
+    def test_token_attributes(self):
+        self.assertEqual(self.analysis.get_tokens(),
+                         ["John", "Smith", "sleeps", "He", "snores"])
+        self.assertEqual(self.analysis.get_lemmas(),
+                         ["John", "Smith", "sleep", "he", "snore"])
+        self.assertEqual(self.analysis.get_pos(),
+                         ["NNP", "NNP", "VBZ", "PRP", "VBZ"])
+        self.assertEqual(self.analysis.get_token_offsets(), [0, 5, 11, 19, 22])
+
+    def test_sentences_and_parse_trees(self):
+        self.assertEqual(self.analysis.get_sentence_boundaries(), [0, 3, 5])
+        self.assertEqual(self.analysis.get_parse_trees(), [
+            "(ROOT (S (NP (NNP John) (NNP Smith)) (VP (VBZ sleeps))))",
+            "(ROOT (S (NP (PRP He)) (VP (VBZ snores))))",
+        ])
+        self.assertEqual([[t["word"] for t in s] for s in self.analysis.get_sentences()],
+                         [["John", "Smith", "sleeps"], ["He", "snores"]])
+
+    def test_entity_occurrences_and_coreferences(self):
+        self.assertEqual(self.analysis.get_entity_occurrences(), [(0, 2, "PERSON")])
+        found = self.analysis.get_found_entities("doc")
+        self.assertEqual([(f.alias, f.kind_name, f.offset, f.offset_end) for f in found],
+                         [("John Smith", "PERSON", 0, 2)])
+        self.assertEqual(self.analysis.get_coreferences(), [[(0, 2, 1), (3, 4, 3)]])
+
+    def test_same_results_than_from_dicts(self):
+        sentences = self.analysis.get_sentences()
+        from_dicts = TestableStanfordAnalysis(sentences)
+        for method in ["get_tokens", "get_lemmas", "get_token_offsets",
+                       "get_sentence_boundaries", "get_entity_occurrences"]:
+            self.assertEqual(getattr(self.analysis, method)(),
+                             getattr(from_dicts, method)())
+
+    def test_empty_output(self):
+        analysis = StanfordXMLAnalysis(EMPTY_OUTPUT)
+        self.assertEqual(analysis.get_tokens(), [])
+        self.assertEqual(analysis.get_sentence_boundaries(), [0])
+        self.assertEqual(analysis.get_entity_occurrences(), [])
+        self.assertEqual(analysis.get_coreferences(), [])
+
+
 class TestPreProcessCall(ManagerTestCase):
 
     def _doc_creator(self, mark_as_done):
@@ -195,14 +312,14 @@ class TestPreProcessCall(ManagerTestCase):
 
     def test_if_all_steps_are_done_but_in_override_mode_then_all_are_run_again(self):
         doc = self._doc_creator(mark_as_done=self._all_steps[:])
-        self.mock_analizer.analize.return_value = {}
+        self.mock_analizer.analize.return_value = EMPTY_OUTPUT
         self.stanfordpp.override = True
         self.stanfordpp(doc)
         self.assertTrue(self.mock_analizer.analize.called)
 
     def test_for_new_doc_all_steps_are_done_when_preprocessed(self):
         doc = IEDocFactory()
-        self.mock_analizer.analize.return_value = {}
+        self.mock_analizer.analize.return_value = EMPTY_OUTPUT
         self.stanfordpp(doc)
         for step in self._all_steps:
             self.assertTrue(doc.was_preprocess_step_done(step))
@@ -241,6 +358,187 @@ class TestPreProcessCall(ManagerTestCase):
                 self.assertEqual(mock_ner_only.call_count, 1)
                 self.assertEqual(mock_run_everything.call_count, 1)
 
+    def test_process_batch_analizes_all_documents_at_once(self):
+        docs = [IEDocFactory() for i in range(3)]
+        docs.append(self._doc_creator(mark_as_done=self._all_steps))
+        self.mock_analizer.analize_many.side_effect = lambda texts: [EMPTY_OUTPUT for t in texts]
+        self.stanfordpp.process_batch(docs)
+        self.mock_analizer.analize_many.assert_called_once_with(
+            [d.text for d in docs[:3]])
+        self.assertFalse(self.mock_analizer.analize.called)
+        for doc in docs:
+            for step in self._all_steps:
+                self.assertTrue(doc.was_preprocess_step_done(step))
+
+    def test_partial_runs_only_need_some_annotators(self):
+        sp = self.stanfordpp
+        no_parse = [s for s in self._all_steps if s is not PreProcessSteps.syntactic_parsing]
+        no_lemmas_nor_parse = [s for s in no_parse if s is not PreProcessSteps.lemmatization]
+        self.assertEqual(sp.annotators_for(IEDocFactory()), sp.ALL_ANNOTATORS)
+        self.assertEqual(sp.annotators_for(self._doc_creator(no_parse)), ("parse",))
+        self.assertEqual(sp.annotators_for(self._doc_creator(no_lemmas_nor_parse)),
+                         ("lemma", "parse"))
+        done = self._doc_creator(self._all_steps)
+        self.assertIsNone(sp.annotators_for(done))
+        sp.increment_ner = True
+        self.assertEqual(sp.annotators_for(done), ("ner", "dcoref"))
+
+    def test_analizers_are_started_per_annotators_when_needed(self):
+        self.assertFalse(self.mock_get_analizer.called)
+        doc = IEDocFactory()
+        self.mock_analizer.analize.return_value = EMPTY_OUTPUT
+        self.stanfordpp.analize(doc, ("lemma",))
+        self.stanfordpp.analize(doc, ("lemma",))
+        self.mock_get_analizer.assert_called_once_with(
+            gazettes_filepath=self.stanfordpp.gazettes_filepath, processes=1,
+            annotators=("lemma",))
+
+    def test_analysis_done_in_advance_is_used_if_it_has_the_annotators(self):
+        doc = IEDocFactory()
+        self.stanfordpp._analyses[doc.pk] = (("lemma", "parse"), EMPTY_OUTPUT)
+        self.stanfordpp.analize(doc, ("pos",))
+        self.stanfordpp.analize(doc, ("parse",))
+        self.assertFalse(self.mock_analizer.analize.called)
+        self.mock_analizer.analize.return_value = EMPTY_OUTPUT
+        self.stanfordpp.analize(doc, ("ner",))
+        self.assertTrue(self.mock_analizer.analize.called)
+
+
+class TestRequiredAnnotators(TestCase):
+
+    def test_dependencies_are_added_in_running_order(self):
+        self.assertEqual(corenlp.required_annotators(["lemma"]),
+                         ["tokenize", "ssplit", "pos", "lemma"])
+        self.assertEqual(corenlp.required_annotators(["parse"]),
+                         ["tokenize", "ssplit", "parse"])
+        self.assertEqual(corenlp.required_annotators(["dcoref"]), list(corenlp.ANNOTATORS))
+
+
+class FakeCoreNLP:
+    def __init__(self, *args, **kwargs):
+        self.analized = []
+
+    def analize_many(self, texts):
+        self.analized.append(texts)
+        return [t.upper() for t in texts]
+
+
+class FakeCoreNLPProcess:
+    # Writes its output on the given chunks, no matter what it reads
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.stdin = io.BytesIO()
+        self.stdout = self
+
+    def read1(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+    def poll(self):
+        return None
+
+    def kill(self):
+        self.killed = True
+
+    def wait(self):
+        return -9
+
+
+class TestStanfordCoreNLP(TestCase):
+
+    def analizer(self, chunks):
+        analizer = corenlp.StanfordCoreNLP.__new__(corenlp.StanfordCoreNLP)
+        analizer.proc = FakeCoreNLPProcess(chunks)
+        analizer.corenlp_cmd = ["corenlp.sh"]
+        analizer.cache = None
+        analizer.output = analizer.iter_output_segments()
+        return analizer
+
+    def test_outputs_read_together_are_split_by_prompt(self):
+        first = b"Processing\n<?xml version=\"1.0\"?><root>first</root>"
+        second = b"<?xml version=\"1.0\"?><root>second</root>"
+        analizer = self.analizer([first + b"\nNLP> " + second[:15],
+                                  second[15:] + b"\nNLP> "])
+        self.assertEqual(analizer.analize_many(["one", "two"]),
+                         [first[11:].decode("utf8"), second.decode("utf8")])
+
+    def test_process_is_replaced_after_a_bad_output(self):
+        good = b"<?xml version=\"1.0\"?><root>good</root>"
+        analizer = self.analizer([good + b"\nNLP> Exception!\nNLP> " + good + b"\nNLP> "])
+        failed_proc = analizer.proc
+
+        def start_proc():
+            analizer.proc = FakeCoreNLPProcess([b"\nNLP> " + good + b"\nNLP> "])
+            analizer.output = analizer.iter_output_segments()
+            analizer.receive()
+        with mock.patch.object(analizer, "_start_proc", side_effect=start_proc):
+            self.assertRaises(ValueError, analizer.analize_many, ["one", "two", "three"])
+        self.assertTrue(failed_proc.killed)
+        # the output left of the failed batch is not taken as the next result
+        self.assertEqual(analizer.analize_many(["four"]), [good.decode("utf8")])
+
+
+class TestCoreNLPPool(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("iepy.preprocess.corenlp.StanfordCoreNLP", FakeCoreNLP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_analize_many_keeps_order_of_texts(self):
+        pool = corenlp.StanfordCoreNLPPool(3)
+        texts = ['text %i' % i for i in range(20)]
+        self.assertEqual(pool.analize_many(texts, batch_size=2),
+                         [t.upper() for t in texts])
+        analized = [batch for a in pool.analizers for batch in a.analized]
+        self.assertEqual(len(analized), 10)
+        self.assertEqual(sorted(t for batch in analized for t in batch), sorted(texts))
+
+
+class TestAnalysisCache(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.cache = corenlp.AnalysisCache(self.folder, max_size=10 ** 6)
+
+    def test_stored_outputs_are_retrieved(self):
+        key = self.cache.key("config", "some text")
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, "<xml>some output</xml>")
+        self.assertEqual(self.cache.get(key), "<xml>some output</xml>")
+
+    def test_key_depends_on_text_and_config(self):
+        key = self.cache.key("config", "some text")
+        self.assertEqual(key, self.cache.key("config", "some text"))
+        self.assertNotEqual(key, self.cache.key("config", "other text"))
+        self.assertNotEqual(key, self.cache.key("other config", "some text"))
+
+    def test_config_key_depends_on_gazettes_content_not_path(self):
+        def config_key(content, name):
+            path = os.path.join(self.folder, name)
+            with open(path, "w") as filehandler:
+                filehandler.write(content)
+            return corenlp.analysis_config_key(
+                ["-regexner.mapping", path, "-annotators", "ner,regexner"], path)
+        key = config_key("Ford\tORG\n", "gazettes_1")
+        self.assertEqual(key, config_key("Ford\tORG\n", "gazettes_2"))
+        self.assertNotEqual(key, config_key("Ford\tPERSON\n", "gazettes_3"))
+
+    def test_least_recently_used_outputs_are_evicted_when_full(self):
+        output = os.urandom(1000).hex()  # hardly compressible
+        keys = [self.cache.key("config", "text %i" % i) for i in range(5)]
+        for i, key in enumerate(keys[:4]):
+            self.cache.put(key, output)
+            os.utime(self.cache._path(key), (i, i))
+        self.cache.max_size = 3.5 * os.path.getsize(self.cache._path(keys[0]))
+        self.cache.get(keys[0])  # most recently used from now on
+        self.cache.put(keys[4], output)
+        self.assertEqual(self.cache.get(keys[0]), output)
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNone(self.cache.get(keys[2]))
+        self.assertEqual(self.cache.get(keys[3]), output)
+        self.assertEqual(self.cache.get(keys[4]), output)
+
 
 class TestGazetteer(ManagerTestCase):
 
@@ -282,6 +580,30 @@ class TestGazetteer(ManagerTestCase):
         self._test_single_gazette("æ}@ł¢µ«»µ«»“~þðøđþ")
         self._test_single_gazette("\ || \ ()(()))) \\ |")
 
+    def test_gazettes_are_loaded_on_a_single_query(self):
+        [GazetteItemFactory() for x in range(5)]
+        with self.assertNumQueries(1):
+            GazetteManager().generate_stanford_gazettes_file()
+
+    def test_gazettes_file_is_regenerated_only_if_gazettes_change(self):
+        GazetteItemFactory(text="Stuart Little")
+        filepath = GazetteManager().generate_stanford_gazettes_file()
+        self.assertEqual(GazetteManager().generate_stanford_gazettes_file(), filepath)
+        GazetteItemFactory(text="Memento")
+        new_filepath = GazetteManager().generate_stanford_gazettes_file()
+        self.assertNotEqual(new_filepath, filepath)
+        self.assertEqual(open(new_filepath).read().count("\n"), 2)
+
+    def test_entries_of_native_classes_are_found_by_kind(self):
+        person = EntityKindFactory(name="PERSON")
+        GazetteItemFactory(text="Stuart Little", kind=person)
+        GazetteItemFactory(text="Memento")
+        gm = GazetteManager()
+        gm.generate_stanford_gazettes_file()
+        self.assertTrue(gm.was_entry_created_by_gazette("Stuart Little", "PERSON"))
+        self.assertFalse(gm.was_entry_created_by_gazette("Memento", "PERSON"))
+        self.assertFalse(gm.was_entry_created_by_gazette("Stuart Little", "LOCATION"))
+
     def test_gazettes_same_eo_has_same_entity(self):
         tokens = "The nominates were Stuart Little and Memento but the winner was Stuart Little".split()
         analysis = get_analysis_from_sent_markup(
@@ -404,3 +726,46 @@ class TestMergeCorreferences(ManagerTestCase):
         eo_2.entity.gazette = GazetteItemFactory()
         eo_2.entity.save()
         self.assertRaises(CoreferenceError, self.merge, self.mentions[:])
+
+    def test_all_coreferences_of_a_document_are_merged(self):
+        eo_1 = self.create_eo_with_mention(self.mentions[0])
+        eo_2 = self.create_eo_with_mention(self.mentions[3])
+        apply_all_coreferences(self.doc, [self.mentions[:3], self.mentions[3:]])
+        self.assertEqual(self.doc.entity_occurrences.count(), len(self.mentions))
+        for eo in self.doc.entity_occurrences.filter(offset__lt=18):
+            self.assertEqual(eo.entity, eo_1.entity)
+        for eo in self.doc.entity_occurrences.filter(offset__gte=18):
+            self.assertEqual(eo.entity, eo_2.entity)
+
+    def test_later_coreferences_see_the_merges_of_previous_ones(self):
+        self.create_eo_with_mention(self.mentions[0])
+        eo_2 = self.create_eo_with_mention(self.mentions[3])
+        # the second one only reaches the first entity through the "He"
+        # occurrence created by the first one
+        apply_all_coreferences(self.doc, [self.mentions[:2], self.mentions[1:]])
+        self.assertEqual(self.doc.entity_occurrences.count(), len(self.mentions))
+        for eo in self.doc.entity_occurrences.all():
+            self.assertEqual(eo.entity, eo_2.entity)
+
+    def test_coreferences_that_cant_be_merged_are_skipped(self):
+        eo_1 = self.create_eo_with_mention(self.mentions[0])
+        eo_2 = self.create_eo_with_mention(self.mentions[3])
+        eo_2.entity.kind = EntityKindFactory()
+        eo_2.entity.save()
+        apply_all_coreferences(self.doc, [self.mentions[:2],
+                                          self.mentions[:1] + self.mentions[3:]])
+        self.assertEqual(self.doc.entity_occurrences.count(), 3)
+        eo_2 = self.doc.entity_occurrences.get(pk=eo_2.pk)
+        self.assertNotEqual(eo_2.entity, eo_1.entity)
+
+    def test_queries_dont_grow_with_the_number_of_mentions(self):
+        def count_queries(chains):
+            self.doc.entity_occurrences.all().delete()
+            self.create_eo_with_mention(self.mentions[0])
+            with CaptureQueriesContext(connection) as ctx:
+                apply_all_coreferences(self.doc, chains)
+            return len(ctx.captured_queries)
+        few = count_queries([self.mentions[:2]])
+        many = count_queries([self.mentions[:3], self.mentions[:1] + self.mentions[3:]])
+        self.assertEqual(self.doc.entity_occurrences.count(), len(self.mentions))
+        self.assertEqual(few, many)
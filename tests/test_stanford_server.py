@@ -0,0 +1,64 @@
+import sys
+from unittest import TestCase
+
+from iepy.preprocess.stanford_server import StanfordTaggingServer
+
+
+# Tags each token with its length. Writes some noise first, splits
+# sentences longer than 3 tokens in several lines, and drops "DROP" tokens.
+FAKE_TAGGER = """
+import sys
+print("Loading model... done")
+sys.stdout.flush()
+for line in sys.stdin:
+    tokens = ["{}/{}".format(x, len(x)) for x in line.split() if x != "DROP"]
+    for i in range(0, len(tokens), 3):
+        print(" ".join(tokens[i:i + 3]))
+    sys.stdout.flush()
+"""
+
+
+class TestStanfordTaggingServer(TestCase):
+
+    def setUp(self):
+        self.server = StanfordTaggingServer([sys.executable, "-c", FAKE_TAGGER], "/")
+        self.addCleanup(self.server.quit)
+
+    def test_sentences_are_tagged(self):
+        sentences = [["Some", "sentence", "."], ["And", "some", "other", "one", "."]]
+        result = self.server.tag_sents(sentences)
+        self.assertEqual(result, [
+            [("Some", "4"), ("sentence", "8"), (".", "1")],
+            [("And", "3"), ("some", "4"), ("other", "5"), ("one", "3"), (".", "1")],
+        ])
+
+    def test_process_is_reused(self):
+        self.server.tag_sents([["Hi"]])
+        proc = self.server.proc
+        self.assertEqual(self.server.tag_sents([["Bye", "!"]]), [[("Bye", "3"), ("!", "1")]])
+        self.assertIs(self.server.proc, proc)
+
+    def test_tokens_with_separator_or_spaces(self):
+        result = self.server.tag_sents([["1/2", "New York"]])
+        self.assertEqual(result, [[("1/2", "3"), ("New York", "8")]])
+
+    def test_many_sentences_dont_block(self):
+        sentences = [["word"] * 50] * 2000
+        result = self.server.tag_sents(sentences)
+        self.assertEqual(len(result), len(sentences))
+        self.assertTrue(all(tag == "4" for s in result for _, tag in s))
+
+    def test_process_failing_raises_and_restarts(self):
+        server = StanfordTaggingServer([sys.executable, "-c", "pass"], "/")
+        self.assertRaises(RuntimeError, server.tag_sents, [["Hi"]])
+        self.assertIsNone(server.proc)
+
+    def test_output_not_matching_tokens_raises_and_restarts(self):
+        self.server.tag_sents([["Hi"]])
+        proc = self.server.proc
+        sentences = [["Some", "DROP", "sentence"], ["Bye"]] * 20000
+        self.assertRaises(RuntimeError, self.server.tag_sents, sentences)
+        self.assertIsNone(self.server.proc)
+        self.assertIsNotNone(proc.poll())
+        # tags are not taken from the output of the failed call
+        self.assertEqual(self.server.tag_sents([["Bye", "!"]]), [[("Bye", "3"), ("!", "1")]])
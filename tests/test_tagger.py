@@ -42,3 +42,35 @@ class TestTaggerRunner(ManagerTestCase):
         tag(doc)
         self.assertTrue(all(x == 'B' for x in doc.postags))
 
+    def test_tagger_runner_batch_calls_postagger_once(self):
+        docs = [SentencedIEDocFactory(text='Some sentence. And some other.'),
+                SentencedIEDocFactory(text='Indeed!')]
+        calls = []
+
+        def postagger(sents):
+            calls.append(sents)
+            return [[(x, str(len(x))) for x in sent] for sent in sents]
+        TaggerRunner(postagger).process_batch(docs)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0]), 3)
+        self.assertEqual(docs[0].postags, ['4', '8', '1', '3', '4', '5', '1'])
+        self.assertEqual(docs[1].postags, ['6', '1'])
+
+    def test_tagger_runner_batch_skips_documents_already_tagged(self):
+        docs = [SentencedIEDocFactory(text='Some sentence.'),
+                SentencedIEDocFactory(text='Indeed!')]
+        TaggerRunner(lambda sents: [[(x, 'A') for x in s] for s in sents])(docs[0])
+        TaggerRunner(lambda sents: [[(x, 'B') for x in s] for s in sents]).process_batch(docs)
+        self.assertEqual(docs[0].postags, ['A', 'A'])
+        self.assertEqual(docs[1].postags, ['B', 'B'])
+
+    def test_tagger_runner_batch_failing_sets_no_result(self):
+        docs = [SentencedIEDocFactory(text='Some sentence.'),
+                SentencedIEDocFactory(text='Indeed!')]
+        # second document gets a tag less than its tokens
+        postagger = lambda sents: [[(x, 'A') for x in s] for s in sents][:-1] + [[]]
+        self.assertRaises(AssertionError, TaggerRunner(postagger).process_batch, docs)
+        for doc in docs:
+            self.assertFalse(doc.was_preprocess_step_done(PreProcessSteps.tagging))
+            doc = IEDocument.objects.get(pk=doc.pk)
+            self.assertFalse(doc.was_preprocess_step_done(PreProcessSteps.tagging))